@@ -104,11 +104,13 @@ not hosting multiple courses, your course will run in a default namespace
 Good luck!
 """
 
+import collections
 import logging
 import mimetypes
 import os
 import re
 import threading
+import time
 import urlparse
 
 import appengine_config
@@ -116,7 +118,14 @@ from models.config import ConfigProperty
 from models.config import ConfigPropertyEntity
 from models.config import Registry
 from models.counters import PerfCounter
+from models.counters import PerfHistogram
+from models.counters import PerfRateCounter
+from models.counters import RequestStats
 from models.courses import Course
+from models.import_profiler import ImportProfiler
+from models.models import FleetCounters
+from models.models import MemcacheRpc
+from models.request_cache import RequestCache
 from models.roles import Roles
 from models.vfs import AbstractFileSystem
 from models.vfs import DatastoreBackedFileSystem
@@ -182,29 +191,61 @@ NO_HANDLER_COUNT = PerfCounter(
     'gcb-sites-handler-none',
     'A number of times request was not matched to any handler.')
 
-HTTP_BYTES_IN = PerfCounter(
+HTTP_BYTES_IN = PerfRateCounter(
     'gcb-sites-bytes-in',
     'A number of bytes received from clients by the handler.')
-HTTP_BYTES_OUT = PerfCounter(
+HTTP_BYTES_OUT = PerfRateCounter(
     'gcb-sites-bytes-out',
     'A number of bytes sent out from the handler to clients.')
-
-HTTP_STATUS_200 = PerfCounter(
+HTTP_RESPONSE_BYTES = PerfHistogram(
+    'gcb-sites-response-bytes',
+    'A distribution of sizes of the responses sent to clients (bytes).')
+HTTP_LATENCY_MS = PerfHistogram(
+    'gcb-sites-latency-ms',
+    'A distribution of time spent serving requests (ms).')
+
+HTTP_STATUS_200 = PerfRateCounter(
     'gcb-sites-http-20x',
     'A number of times HTTP status code 20x was returned.')
-HTTP_STATUS_300 = PerfCounter(
+HTTP_STATUS_300 = PerfRateCounter(
     'gcb-sites-http-30x',
     'A number of times HTTP status code 30x was returned.')
-HTTP_STATUS_400 = PerfCounter(
+HTTP_STATUS_400 = PerfRateCounter(
     'gcb-sites-http-40x',
     'A number of times HTTP status code 40x was returned.')
-HTTP_STATUS_500 = PerfCounter(
+HTTP_STATUS_500 = PerfRateCounter(
     'gcb-sites-http-50x',
     'A number of times HTTP status code 50x was returned.')
 COUNTER_BY_HTTP_CODE = {
     200: HTTP_STATUS_200, 300: HTTP_STATUS_300, 400: HTTP_STATUS_400,
     500: HTTP_STATUS_500}
 
+HTTP_NOT_MODIFIED_COUNT = PerfCounter(
+    'gcb-sites-http-not-modified',
+    'A number of times a static file was not sent because client has it.')
+HTTP_PARTIAL_CONTENT_COUNT = PerfCounter(
+    'gcb-sites-http-partial-content',
+    'A number of times a byte range of a static file was sent.')
+
+TEMPLATE_ENVIRON_POOL_HIT = PerfCounter(
+    'gcb-sites-template-environ-pool-hit',
+    'A number of times a pooled jinja environment was reused.')
+TEMPLATE_ENVIRON_POOL_MISS = PerfCounter(
+    'gcb-sites-template-environ-pool-miss',
+    'A number of times a new jinja environment had to be created.')
+
+# a name to record statistics of the requests not matched to any handler under
+NO_HANDLER_NAME = 'none'
+
+# max number of jinja environments kept in the pool
+MAX_TEMPLATE_ENVIRON_POOL_SIZE = 64
+
+# templates compiled by the warmup request for each course
+WARMUP_TEMPLATE_NAMES = [
+    'base.html', 'base_registration.html', 'course.html', 'unit.html',
+    'activity.html', 'assessment.html', 'preview.html', 'register.html',
+    'student_profile.html', 'announcements.html']
+
 
 def count_stats(handler):
     """Records statistics about the request and the response."""
@@ -227,10 +268,21 @@ def count_stats(handler):
         # Record response bytes out.
         if handler.response and handler.response.content_length:
             HTTP_BYTES_OUT.inc(handler.response.content_length)
+            HTTP_RESPONSE_BYTES.add(handler.response.content_length)
     except Exception as e:  # pylint: disable-msg=broad-except
         logging.error('Failed to count_stats(): %s.', str(e))
 
 
+def flush_fleet_counters():
+    """Flushes counters to fleet-wide counters, if it's time to do so."""
+    try:
+        rpc = FleetCounters.flush_if_due()
+        if rpc:
+            rpc.get_result()
+    except Exception as e:  # pylint: disable-msg=broad-except
+        logging.error('Failed to flush_fleet_counters(): %s.', str(e))
+
+
 def has_path_info():
     """Checks if PATH_INFO is defined for the thread local."""
     return hasattr(PATH_INFO_THREAD_LOCAL, 'path')
@@ -276,16 +328,28 @@ def _validate_appcontext_list(contexts, strict=False):
     """Validates a list of application contexts."""
 
     # Check rule order is enforced. If we allowed any order and '/a' was before
-    # '/aa', the '/aa' would never match.
-    for i in range(len(contexts)):
-        for j in range(i + 1, len(contexts)):
-            above = contexts[i]
-            below = contexts[j]
-            if below.get_slug().startswith(above.get_slug()):
-                raise Exception(
-                    'Please reorder course entries to have '
-                    '\'%s\' before \'%s\'.' % (
-                        below.get_slug(), above.get_slug()))
+    # '/aa', the '/aa' would never match. All slugs that start with a given slug
+    # immediately follow it in the sorted order, so we only need to look at
+    # these and not at all possible pairs of rules.
+    ordered = sorted(
+        [(context.get_slug(), index) for index, context in enumerate(contexts)])
+    violation = None
+    for i in range(len(ordered)):
+        above_slug, above_index = ordered[i]
+        for j in range(i + 1, len(ordered)):
+            below_slug, below_index = ordered[j]
+            if not below_slug.startswith(above_slug):
+                break
+            if below_index > above_index:
+                if not violation or (above_index, below_index) < violation:
+                    violation = (above_index, below_index)
+    if violation:
+        above = contexts[violation[0]]
+        below = contexts[violation[1]]
+        raise Exception(
+            'Please reorder course entries to have '
+            '\'%s\' before \'%s\'.' % (
+                below.get_slug(), above.get_slug()))
 
     # Make sure '/' is mapped.
     if strict:
@@ -299,12 +363,17 @@ def _validate_appcontext_list(contexts, strict=False):
                 'Please add an entry with \'/\' as course URL prefix.')
 
 
+def _normalize_rules_text(rules_text):
+    """Reads rules from environment variable if needed and normalizes them."""
+    if not rules_text:
+        rules_text = GCB_COURSES_CONFIG.value
+    return rules_text.replace(',', '\n')
+
+
 def get_all_courses(rules_text=None):
     """Reads all course rewrite rule definitions from environment variable."""
     # Normalize text definition.
-    if not rules_text:
-        rules_text = GCB_COURSES_CONFIG.value
-    rules_text = rules_text.replace(',', '\n')
+    rules_text = _normalize_rules_text(rules_text)
 
     # Use cached value if exists.
     cached = ApplicationContext.ALL_COURSE_CONTEXTS_CACHE.get(rules_text)
@@ -396,6 +465,71 @@ def get_all_courses(rules_text=None):
     return all_contexts
 
 
+class CourseRouter(object):
+    """Maps a request path to a course using a trie of slug path segments.
+
+    A course with a slug '/a/b' handles the path '/a/b' and all the paths that
+    start with '/a/b/'. Each node of the trie corresponds to one '/' separated
+    segment of a slug, so a path is resolved in a single walk over its segments,
+    regardless of how many courses are defined. The course with the slug '/'
+    handles all paths and is kept aside as a fallback.
+
+    The rules are applied in the order of declaration. The rule order validation
+    guarantees that a longer slug is declared before any shorter slug that is
+    its prefix, thus the deepest match found in the trie is also the first
+    matching rule in the declaration order.
+    """
+
+    def __init__(self, contexts):
+        self._root = {}
+        self._default = None
+        for index, context in enumerate(contexts):
+            slug = context.get_slug()
+            if slug == '/':
+                if not self._default:
+                    self._default = (index, context)
+                continue
+            node = self._root
+            for segment in slug.split('/'):
+                node, matches = node.setdefault(segment, ({}, []))
+            matches.append((index, context))
+
+    def resolve(self, path):
+        """Returns the course for the path or None if no course matches."""
+        found = None
+        node = self._root
+        for segment in path.split('/'):
+            entry = node.get(segment)
+            if not entry:
+                break
+            node, matches = entry
+            if matches:
+                found = matches[0]
+
+        # The '/' handles all paths, but may be declared before the others.
+        if self._default and (not found or self._default[0] < found[0]):
+            found = self._default
+
+        if found:
+            return found[1]
+        return None
+
+
+def get_course_router(rules_text=None):
+    """Returns a router for the course rules; it is built once per rules."""
+    all_contexts = get_all_courses(rules_text)
+
+    # Use cached value if it was built for the same contexts; the contexts are
+    # created anew whenever the rules change.
+    cached = ApplicationContext.COURSE_ROUTER_CACHE
+    if cached and cached[0] is all_contexts:
+        return cached[1]
+
+    router = CourseRouter(all_contexts)
+    ApplicationContext.COURSE_ROUTER_CACHE = (all_contexts, router)
+    return router
+
+
 def get_course_for_current_request():
     """Chooses course that matches current request context path."""
 
@@ -404,18 +538,11 @@ def get_course_for_current_request():
         return None
     path = get_path_info()
 
-    # Get all rules.
-    courses = get_all_courses()
-
     # Match a path to a course.
-    # TODO(psimakov): linear search is unacceptable
-    for course in courses:
-        if path == course.get_slug() or path.startswith(
-                '%s/' % course.get_slug()) or course.get_slug() == '/':
-            return course
-
-    debug('No mapping for: %s' % path)
-    return None
+    course = get_course_router().resolve(path)
+    if not course:
+        debug('No mapping for: %s' % path)
+    return course
 
 
 def path_join(base, path):
@@ -512,27 +639,104 @@ class AssetHandler(webapp2.RequestHandler):
             return default
         return guess
 
-    def _can_view(self, fs, stream):
-        """Checks if current user can view stream."""
-        public = not fs.is_draft(stream)
+    def _can_view(self, metadata):
+        """Checks if current user can view a file with this metadata."""
+        public = not metadata.is_draft
         return public or Roles.is_course_admin(self.app_context)
 
+    def _is_not_modified(self, metadata):
+        """Checks if the client already has the current version of a file."""
+
+        # If-None-Match takes precedence over If-Modified-Since.
+        if self.request.headers.get('If-None-Match'):
+            return bool(metadata.etag) and (
+                metadata.etag in self.request.if_none_match)
+
+        if_modified_since = self.request.if_modified_since
+        if if_modified_since and metadata.updated_on:
+            return metadata.updated_on.replace(microsecond=0) <= (
+                if_modified_since.replace(tzinfo=None))
+
+        return False
+
+    def _get_range(self, metadata):
+        """Returns (start, end) of a single byte range requested or None."""
+        if not self.request.headers.get('Range') or metadata.size is None:
+            return None
+
+        # Ignore the range if the client's copy of the file is out of date.
+        if_range = self.request.headers.get('If-Range')
+        if if_range and (
+                not metadata.etag or if_range != '"%s"' % metadata.etag):
+            return None
+
+        # Multiple and malformed ranges are ignored; full file is sent instead.
+        match = re.match(
+            r'^bytes=(\d*)-(\d*)$', self.request.headers['Range'].strip())
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+        if match.group(1):
+            start = int(match.group(1))
+            end = metadata.size
+            if match.group(2):
+                # A range ending before it starts is invalid and is ignored.
+                if int(match.group(2)) < start:
+                    return None
+                end = min(int(match.group(2)) + 1, metadata.size)
+        else:
+            start = max(0, metadata.size - int(match.group(2)))
+            end = metadata.size
+        return start, end
+
     def get(self):
         """Handles GET requests."""
         debug('File: %s' % self.filename)
 
-        if not self.app_context.fs.isfile(self.filename):
+        metadata = self.app_context.fs.get_metadata(self.filename)
+        if not metadata:
             self.error(404)
             return
 
-        stream = self.app_context.fs.open(self.filename)
-        if not self._can_view(self.app_context.fs, stream):
+        if not self._can_view(metadata):
             self.error(403)
             return
 
         set_static_resource_cache_control(self)
+        if metadata.etag:
+            self.response.etag = metadata.etag
+        if metadata.updated_on:
+            self.response.last_modified = metadata.updated_on
+
+        if self._is_not_modified(metadata):
+            HTTP_NOT_MODIFIED_COUNT.inc()
+            self.response.set_status(304)
+            return
+
+        self.response.headers['Accept-Ranges'] = 'bytes'
         self.response.headers['Content-Type'] = self.get_mime_type(
             self.filename)
+
+        byte_range = self._get_range(metadata)
+        if byte_range:
+            start, end = byte_range
+            if start >= end:
+                self.response.headers['Content-Range'] = 'bytes */%s' % (
+                    metadata.size)
+                self.response.set_status(416)
+                return
+            data = self.app_context.fs.read_range(self.filename, start, end)
+            if data is None:
+                # The file was changed or deleted after its metadata was read.
+                self.error(404)
+                return
+            HTTP_PARTIAL_CONTENT_COUNT.inc()
+            self.response.set_status(206)
+            self.response.headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                start, end - 1, metadata.size)
+            self.response.write(data)
+            return
+
+        stream = self.app_context.fs.open(self.filename)
         self.response.write(stream.read())
 
 
@@ -545,6 +749,16 @@ class ApplicationContext(object):
     # definition changes.
     ALL_COURSE_CONTEXTS_CACHE = {}
 
+    # Here we store a tuple of the list of ApplicationContext objects last
+    # returned by get_all_courses() and the router that maps request paths to
+    # them.
+    COURSE_ROUTER_CACHE = None
+
+    # Here we store a map of (namespace, template folders, locale) to a tuple of
+    # a file system object and a jinja2.Environment for loading templates from
+    # it. Most recently used entries are at the end.
+    TEMPLATE_ENVIRON_POOL = collections.OrderedDict()
+
     @classmethod
     def get_namespace_name_for_request(cls):
         """Gets the name of the namespace to use for this request.
@@ -638,15 +852,42 @@ class ApplicationContext(object):
         return path
 
     def get_template_environ(self, locale, additional_dirs):
-        """Create and configure jinja template evaluation environment."""
+        """Returns configured jinja template evaluation environment.
+
+        Environments are pooled by namespace, template folders and locale, so
+        templates compiled by one request are reused by the following ones.
+        The file system loaders check whether the template source is up to date
+        before reusing a compiled template.
+
+        Args:
+            locale: A name of the locale to install translations for.
+            additional_dirs: A list of extra template folders to search.
+
+        Returns:
+            A jinja2.Environment object.
+        """
         template_dir = self.get_template_home()
         dirs = [template_dir]
         if additional_dirs:
             dirs += additional_dirs
-        jinja_environment = self.fs.get_jinja_environ(dirs)
 
         i18n.get_i18n().set_locale(locale)
-        jinja_environment.install_gettext_translations(i18n)
+
+        key = (self.get_namespace_name(), tuple(dirs), locale)
+        cached = self.TEMPLATE_ENVIRON_POOL.pop(key, None)
+        if cached and cached[0] is self.fs:
+            TEMPLATE_ENVIRON_POOL_HIT.inc()
+            jinja_environment = cached[1]
+        else:
+            TEMPLATE_ENVIRON_POOL_MISS.inc()
+            jinja_environment = self.fs.get_jinja_environ(dirs)
+            jinja_environment.install_gettext_translations(
+                i18n.get_i18n().translations)
+
+        # Most recently used environments are kept at the end of the pool.
+        self.TEMPLATE_ENVIRON_POOL[key] = (self.fs, jinja_environment)
+        while len(self.TEMPLATE_ENVIRON_POOL) > MAX_TEMPLATE_ENVIRON_POOL_SIZE:
+            self.TEMPLATE_ENVIRON_POOL.popitem(last=False)
 
         return jinja_environment
 
@@ -721,6 +962,7 @@ def _add_new_course_entry_to_persistent_configuration(raw):
     if final_lines_text:
         entity.value = final_lines_text
         entity.put()
+        Registry.bump_generation()
         return True
     return False
 
@@ -786,9 +1028,22 @@ order they are defined.</p>"""),
 class ApplicationRequestHandler(webapp2.RequestHandler):
     """Handles dispatching of all URL's to proper handlers."""
 
+    # A map of URL to handler class, or to a dotted path of the handler class
+    # if it was not imported yet.
+    urls_map = {}
+
     @classmethod
     def bind_to(cls, urls, urls_map):
-        """Recursively builds a map from a list of (URL, Handler) tuples."""
+        """Recursively builds a map from a list of (URL, Handler) tuples.
+
+        A handler may be given as a dotted path to its class, for example:
+        'controllers.lessons.UnitHandler'. Such handlers are imported, and
+        their child routes are added, when first dispatched to.
+
+        Args:
+            urls: A list of (URL, handler class or dotted path) tuples.
+            urls_map: A map of URL to handler to add the handlers to.
+        """
         for url in urls:
             path_prefix = url[0]
             handler = url[1]
@@ -804,6 +1059,40 @@ class ApplicationRequestHandler(webapp2.RequestHandler):
         cls.bind_to(urls, urls_map)
         cls.urls_map = urls_map
 
+    @classmethod
+    def _import_handler(cls, path):
+        """Imports a handler bound by a dotted path; binds its child routes."""
+        registered_count = len(Registry.registered)
+        dotted_path = cls.urls_map[path]
+        with ImportProfiler.profile(dotted_path):
+            handler = webapp2.import_string(dotted_path)
+        cls.bind_to([(path, handler)], cls.urls_map)
+
+        # Overrides of the properties declared by the newly imported modules
+        # were skipped when the overrides were loaded; reload them.
+        if len(Registry.registered) != registered_count:
+            Registry.get_overrides(force_update=True)
+        return handler
+
+    @classmethod
+    def import_all_handlers(cls):
+        """Imports all handlers that were bound by a dotted path."""
+        for path, handler in cls.urls_map.items():
+            if isinstance(handler, basestring):
+                cls._import_handler(path)
+
+    @classmethod
+    def get_handler_class(cls, path):
+        """Returns a handler class bound to a path; imports it if needed."""
+        handler = cls.urls_map.get(path)
+        if handler is None:
+            # The path may be a child route of a handler not imported yet.
+            cls.import_all_handlers()
+            handler = cls.urls_map.get(path)
+        elif isinstance(handler, basestring):
+            handler = cls._import_handler(path)
+        return handler
+
     def get_handler(self):
         """Finds a course suitable for handling this request."""
         course = get_course_for_current_request()
@@ -843,8 +1132,8 @@ class ApplicationRequestHandler(webapp2.RequestHandler):
             return handler
 
         # Handle all dynamic handlers here.
-        if path in ApplicationRequestHandler.urls_map:
-            factory = ApplicationRequestHandler.urls_map[path]
+        factory = ApplicationRequestHandler.get_handler_class(path)
+        if factory:
             handler = factory()
             handler.app_context = context
             handler.request = self.request
@@ -857,57 +1146,118 @@ class ApplicationRequestHandler(webapp2.RequestHandler):
         NO_HANDLER_COUNT.inc()
         return None
 
-    def get(self, path):
+    def _dispatch(self, path, method_name):
+        """Finds a handler for a path and calls its method_name() method."""
+        handler_name = None
         try:
+            RequestCache.begin()
+            RequestStats.begin()
             set_path_info(path)
             handler = self.get_handler()
             if not handler:
                 self.error(404)
             else:
+                handler_name = handler.__class__.__name__
                 set_default_response_headers(handler)
-                handler.get()
+                getattr(handler, method_name)()
         finally:
+            MemcacheRpc.wait_all()
             count_stats(self)
             unset_path_info()
+            rpc_count = RequestCache.end()
+            HTTP_LATENCY_MS.add(
+                RequestStats.end(handler_name or NO_HANDLER_NAME, rpc_count)
+                * 1000)
+            flush_fleet_counters()
+
+    def get(self, path):
+        self._dispatch(path, 'get')
 
     def post(self, path):
-        try:
-            set_path_info(path)
-            handler = self.get_handler()
-            if not handler:
-                self.error(404)
-            else:
-                set_default_response_headers(handler)
-                handler.post()
-        finally:
-            count_stats(self)
-            unset_path_info()
+        self._dispatch(path, 'post')
 
     def put(self, path):
-        try:
-            set_path_info(path)
-            handler = self.get_handler()
-            if not handler:
-                self.error(404)
-            else:
-                set_default_response_headers(handler)
-                handler.put()
-        finally:
-            count_stats(self)
-            unset_path_info()
+        self._dispatch(path, 'put')
 
     def delete(self, path):
+        self._dispatch(path, 'delete')
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Handles /_ah/warmup by loading what the first requests would load.
+
+    A new instance receives the warmup request before any user requests, so
+    the time spent parsing course definitions, loading configuration and
+    course models, and compiling templates is not added to the latency of
+    the first student request.
+    """
+
+    def _run_stage(self, name, stage, *args):
+        """Calls stage(*args), logs how long it took; never fails."""
+        start = time.time()
         try:
-            set_path_info(path)
-            handler = self.get_handler()
-            if not handler:
-                self.error(404)
-            else:
-                set_default_response_headers(handler)
-                handler.delete()
+            stage(*args)
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.error('Warmup stage %s failed: %s', name, e)
+        logging.info(
+            'Warmup stage %s took %.1f ms.', name,
+            (time.time() - start) * 1000)
+
+    def _warmup_config(self):
+        Registry.get_overrides(force_update=True)
+
+    def _warmup_handlers(self):
+        ApplicationRequestHandler.import_all_handlers()
+
+    def _warmup_courses(self):
+        get_all_courses()
+        get_course_router()
+
+    def _warmup_settings(self, context):
+        context.get_environ()
+
+    def _warmup_model(self, context):
+        Course(None, app_context=context).get_units()
+
+    def _warmup_templates(self, context):
+        environ = context.get_template_environ(
+            context.get_environ()['course']['locale'], None)
+        for name in WARMUP_TEMPLATE_NAMES:
+            try:
+                environ.get_template(name)
+            except Exception as e:  # pylint: disable-msg=broad-except
+                debug('Template %s was not compiled: %s' % (name, e))
+
+    def get(self):
+        """Loads all courses and their settings, models and templates."""
+        start = time.time()
+
+        # The in-process caches shared by requests, like the one of the course
+        # models, are only filled while a request cache is active.
+        RequestCache.begin()
+        old_namespace = namespace_manager.get_namespace()
+        try:
+            self._run_stage('config', self._warmup_config)
+            self._run_stage('handlers', self._warmup_handlers)
+            self._run_stage('courses', self._warmup_courses)
+
+            for context in get_all_courses():
+                namespace_manager.set_namespace(context.get_namespace_name())
+                slug = context.get_slug()
+                self._run_stage(
+                    'settings %s' % slug, self._warmup_settings, context)
+                self._run_stage(
+                    'model %s' % slug, self._warmup_model, context)
+                self._run_stage(
+                    'templates %s' % slug, self._warmup_templates, context)
         finally:
-            count_stats(self)
-            unset_path_info()
+            namespace_manager.set_namespace(old_namespace)
+            MemcacheRpc.wait_all()
+            RequestCache.end()
+
+        logging.info('Warmup took %.1f ms.', (time.time() - start) * 1000)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('OK')
 
 
 def assert_mapped(src, dest):
@@ -1071,10 +1421,51 @@ def test_url_to_rule_mapping():
     assert_mapped('e/f', None)
     assert_mapped('foo', None)
 
+    # Only whole path segments are matched.
+    assert_mapped('/a/bc', None)
+    assert_mapped('/e', None)
+
+    # Nested slugs map to the longest matching prefix.
+    setup_courses('course:/a/b/c:/x, course:/a/b:/c/d, course:/:/')
+    assert_mapped('/a/b/c', '/a/b/c')
+    assert_mapped('/a/b/c/d', '/a/b/c')
+    assert_mapped('/a/b/cd', '/a/b')
+    assert_mapped('/a/b', '/a/b')
+    assert_mapped('/a', '/')
+    assert_mapped('/foo', '/')
+
     # Cleanup.
     reset_courses()
 
 
+def test_course_router():
+    """Tests that router matches courses the same way the rules are applied."""
+
+    def linear_match(contexts, path):
+        for context in contexts:
+            slug = context.get_slug()
+            if path == slug or path.startswith('%s/' % slug) or slug == '/':
+                return context
+        return None
+
+    rules = (
+        'course:/a/b:/c/d, course:/a:/e, course:b/c:/f, course:/:/, '
+        'course:g:/g')
+    contexts = get_all_courses(rules)
+    router = get_course_router(rules)
+    assert router is get_course_router(rules)
+    for path in [
+            '/', '/a', '/a/', '/a/b', '/a/b/', '/a/bc', '/a/b/c', '/ab',
+            'b/c', 'b/c/d', 'b/cd', 'g', 'g/h', '', 'foo', '/foo/bar']:
+        assert linear_match(contexts, path) is router.resolve(path)
+
+    # The router resolves to the contexts now in use even if the contexts were
+    # recreated because other rules were parsed meanwhile.
+    get_all_courses('course:/x:/y')
+    contexts = get_all_courses(rules)
+    assert contexts[0] is get_course_router(rules).resolve('/a/b')
+
+
 def test_url_to_handler_mapping_for_course_type():
     """Tests mapping of a URL to a handler for course type."""
 
@@ -1186,6 +1577,7 @@ def run_all_unit_tests():
     test_unprefix()
     test_rule_definitions()
     test_url_to_rule_mapping()
+    test_course_router()
     test_url_to_handler_mapping_for_course_type()
     test_path_construction()
     test_rule_validations()
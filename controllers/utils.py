@@ -25,8 +25,10 @@ import appengine_config
 from models import transforms
 from models.config import ConfigProperty
 from models.config import ConfigPropertyEntity
+from models.config import Registry
 from models.courses import Course
 from models.models import Student
+from models.request_cache import get_current_user
 from models.roles import Roles
 import webapp2
 from google.appengine.api import namespace_manager
@@ -196,7 +198,7 @@ class BaseHandler(ApplicationHandler):
 
     def get_user(self):
         """Validate user exists."""
-        user = users.get_current_user()
+        user = get_current_user()
         if not user:
             self.redirect(users.create_login_url(self.request.uri))
         else:
@@ -259,7 +261,7 @@ class PreviewHandler(BaseHandler):
 
     def get(self):
         """Handles GET requests."""
-        user = users.get_current_user()
+        user = get_current_user()
         if not user:
             self.template_value['loginUrl'] = (
                 users.create_login_url(self.request.uri))
@@ -457,6 +459,7 @@ class XsrfTokenManager(object):
                 os.urandom(XSRF_SECRET_LENGTH))
             entity.is_draft = False
             entity.put()
+            Registry.bump_generation()
         finally:
             namespace_manager.set_namespace(old_namespace)
 
@@ -471,7 +474,7 @@ class XsrfTokenManager(object):
         # issued.
 
         # Lookup user id.
-        user = users.get_current_user()
+        user = get_current_user()
         if user:
             user_id = user.user_id()
         else:
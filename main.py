@@ -14,36 +14,39 @@
 
 """Main package for Course Builder, which handles URL routing."""
 import os
+
+# Import times are profiled from here on to help track cold-start latency.
+from models.import_profiler import ImportProfiler
+ImportProfiler.start()
+
+# pylint: disable-msg=g-import-not-at-top
 import webapp2
 
 # The following import is needed in order to add third-party libraries.
 import appengine_config  # pylint: disable-msg=unused-import
-from controllers import assessments
-from controllers import lessons
 from controllers import sites
-from controllers import utils
-from modules.admin import admin
-from modules.admin import config
-from modules.announcements import announcements
-from modules.dashboard import dashboard
 
 
+# Handlers are given by a dotted path to their class and are imported on first
+# dispatch, so a new instance doesn't import all of them before serving the
+# first request.
 urls = [
-    ('/', lessons.CourseHandler),
-    ('/activity', lessons.ActivityHandler),
-    ('/announcements', announcements.AnnouncementsHandler),
-    ('/answer', assessments.AnswerHandler),
-    ('/assessment', lessons.AssessmentHandler),
-    ('/course', lessons.CourseHandler),
-    ('/forum', utils.ForumHandler),
-    ('/dashboard', dashboard.DashboardHandler),
-    ('/preview', utils.PreviewHandler),
-    ('/register', utils.RegisterHandler),
-    ('/student/editstudent', utils.StudentEditStudentHandler),
-    ('/student/home', utils.StudentProfileHandler),
-    ('/student/unenroll', utils.StudentUnenrollHandler),
-    ('/unit', lessons.UnitHandler),
-    ('/mentors', utils.Mentors)]
+    ('/', 'controllers.lessons.CourseHandler'),
+    ('/activity', 'controllers.lessons.ActivityHandler'),
+    ('/announcements',
+     'modules.announcements.announcements.AnnouncementsHandler'),
+    ('/answer', 'controllers.assessments.AnswerHandler'),
+    ('/assessment', 'controllers.lessons.AssessmentHandler'),
+    ('/course', 'controllers.lessons.CourseHandler'),
+    ('/forum', 'controllers.utils.ForumHandler'),
+    ('/dashboard', 'modules.dashboard.dashboard.DashboardHandler'),
+    ('/preview', 'controllers.utils.PreviewHandler'),
+    ('/register', 'controllers.utils.RegisterHandler'),
+    ('/student/editstudent', 'controllers.utils.StudentEditStudentHandler'),
+    ('/student/home', 'controllers.utils.StudentProfileHandler'),
+    ('/student/unenroll', 'controllers.utils.StudentUnenrollHandler'),
+    ('/unit', 'controllers.lessons.UnitHandler'),
+    ('/mentors', 'controllers.utils.Mentors')]
 
 sites.ApplicationRequestHandler.bind(urls)
 
@@ -52,9 +55,12 @@ inputex_handler = (
         os.path.join(appengine_config.BUNDLE_ROOT, 'lib/inputex-3.1.0.zip')))
 
 admin_handlers = [
-    ('/admin', admin.AdminHandler),
-    ('/rest/config/item', config.ConfigPropertyItemRESTHandler),
-    ('/rest/courses/item', config.CoursesItemRESTHandler)]
+    ('/admin', 'modules.admin.admin.AdminHandler'),
+    ('/rest/config/item',
+     'modules.admin.config.ConfigPropertyItemRESTHandler'),
+    ('/rest/courses/item', 'modules.admin.config.CoursesItemRESTHandler')]
+
+warmup_handler = ('/_ah/warmup', sites.WarmupHandler)
 
 app_handler = (r'(.*)', sites.ApplicationRequestHandler)
 
@@ -64,5 +70,8 @@ webapp2_i18n_config = {'translations_path': os.path.join(
 debug = not appengine_config.PRODUCTION_MODE
 
 app = webapp2.WSGIApplication(
-    admin_handlers + [inputex_handler] + [app_handler],
+    admin_handlers + [inputex_handler] + [warmup_handler] + [app_handler],
     config={'webapp2_extras.i18n': webapp2_i18n_config}, debug=debug)
+
+ImportProfiler.stop()
+ImportProfiler.log_report('main')
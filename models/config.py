@@ -29,6 +29,7 @@ import time
 import appengine_config
 import entities
 import transforms
+from google.appengine.api import memcache
 from google.appengine.api import namespace_manager
 from google.appengine.ext import db
 
@@ -39,6 +40,12 @@ DEFAULT_UPDATE_INTERVAL_SEC = 60
 # The longest update interval supported.
 MAX_UPDATE_INTERVAL_SEC = 60 * 5
 
+# The memcache key of the stamp changed every time the overrides are edited.
+GENERATION_KEY = 'config:generation'
+
+# How often an instance checks whether the overrides were edited.
+GENERATION_CHECK_INTERVAL_SEC = 1
+
 
 # Allowed property types.
 TYPE_INT = int
@@ -64,6 +71,9 @@ class ConfigProperty(object):
         self._doc_string = doc_string
         self._default_value = value_type(default_value)
 
+        # Names of the environment variables that can override the value.
+        self._environ_names = (name.lower(), name.upper())
+
         errors = []
         if self._validator and self._default_value:
             self._validator(self._default_value, errors)
@@ -101,11 +111,12 @@ class ConfigProperty(object):
 
         # Look for a name in lower or upper case.
         name = None
-        if self._name.lower() in os.environ:
-            name = self._name.lower()
+        lower_name, upper_name = self._environ_names
+        if lower_name in os.environ:
+            name = lower_name
         else:
-            if self._name.upper() in os.environ:
-                name = self._name.upper()
+            if upper_name in os.environ:
+                name = upper_name
 
         if name:
             try:
@@ -140,7 +151,26 @@ class ConfigProperty(object):
 
     @property
     def value(self):
-        return self.get_value(Registry.get_overrides())
+        """Gets the current value; the same as get_value(), but faster.
+
+        The values set by the datastore overrides or the defaults come from a
+        precomputed snapshot. Only the test and the environment overrides,
+        which can change at any time, are looked up on every call.
+
+        Returns:
+            The value of the property.
+        """
+        overrides = Registry.test_overrides
+        if overrides and self._name in overrides:
+            return overrides[self._name]
+
+        values = Registry.get_snapshot()
+        if self._name not in Registry.db_overrides:
+            lower_name, upper_name = self._environ_names
+            if lower_name in os.environ or upper_name in os.environ:
+                return self.get_value(Registry.db_overrides)
+
+        return values[self._name]
 
 
 class Registry(object):
@@ -151,20 +181,82 @@ class Registry(object):
     last_update_time = 0
     update_index = 0
 
+    # the generation stamp seen when the overrides were last loaded
+    generation = None
+    last_generation_check_time = 0
+
+    # a tuple of the db_overrides and a map of all property names to the
+    # values resolved from them or the defaults; never modified once built
+    snapshot = None
+
     @classmethod
-    def get_overrides(cls, force_update=False):
-        """Returns current property overrides, maybe cached."""
+    def _get_generation(cls):
+        """Returns the current generation stamp or None if unavailable."""
+        try:
+            # The stamp is created with a new unique value if it is missing,
+            # so the instances reload even if the stamp was evicted.
+            return memcache.incr(
+                GENERATION_KEY, delta=0,
+                initial_value=long(time.time() * 1000000),
+                namespace=appengine_config.DEFAULT_NAMESPACE_NAME)
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.error('Failed to get config generation: %s.', str(e))
+            return None
+
+    @classmethod
+    def bump_generation(cls):
+        """Makes all instances reload the overrides; call after an edit."""
+        try:
+            memcache.incr(
+                GENERATION_KEY, initial_value=long(time.time() * 1000000),
+                namespace=appengine_config.DEFAULT_NAMESPACE_NAME)
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.error('Failed to bump config generation: %s.', str(e))
+
+    @classmethod
+    def _needs_update(cls, now):
+        """Checks whether the overrides were edited since last loaded.
+
+        The generation stamp in memcache is checked at most once every
+        GENERATION_CHECK_INTERVAL_SEC. The overrides are also reloaded every
+        UPDATE_INTERVAL_SEC: the stamp may be unavailable, and the query
+        loading the overrides is eventually consistent, so a reload right
+        after a bump may still miss the edit.
+
+        Args:
+            now: current time in seconds.
+
+        Returns:
+            True if the overrides need to be reloaded.
+        """
+        age = now - cls.last_generation_check_time
+        if 0 <= age < GENERATION_CHECK_INTERVAL_SEC:
+            return False
+        cls.last_generation_check_time = now
+
+        generation = cls._get_generation()
+        if generation is not None and generation != cls.generation:
+            return True
 
-        now = long(time.time())
         age = now - cls.last_update_time
         max_age = UPDATE_INTERVAL_SEC.get_value(cls.db_overrides)
-        if force_update or age < 0 or age >= max_age:
+        return age < 0 or age >= max_age
+
+    @classmethod
+    def get_overrides(cls, force_update=False):
+        """Returns current property overrides, maybe cached."""
+
+        now = time.time()
+        if force_update or cls._needs_update(now):
             # Value of '0' disables all datastore overrides.
             if UPDATE_INTERVAL_SEC.get_value() == 0:
-                cls.db_overrides = {}
+                if cls.db_overrides:
+                    cls.db_overrides = {}
                 return cls.db_overrides
 
-            # Load overrides from a datastore.
+            # Load overrides from a datastore. The stamp is read first, so
+            # the edits made while loading cause another reload.
+            cls.generation = cls._get_generation()
             try:
                 old_namespace = namespace_manager.get_namespace()
                 try:
@@ -179,11 +271,35 @@ class Registry(object):
                     'Failed to load properties from a database: %s.', str(e))
             finally:
                 # Avoid overload and update timestamp even if we failed.
-                cls.last_update_time = now
+                cls.last_update_time = long(now)
                 cls.update_index += 1
 
         return cls.db_overrides
 
+    @classmethod
+    def get_snapshot(cls):
+        """Returns a map of property names to values without env overrides.
+
+        The map is rebuilt when the datastore overrides are reloaded or new
+        properties are registered; it must not be modified.
+
+        Returns:
+            A dict of property name to its datastore override or default value.
+        """
+        db_overrides = cls.get_overrides()
+        snapshot = cls.snapshot
+        if (snapshot is None or snapshot[0] is not db_overrides or
+            len(snapshot[1]) != len(cls.registered)):
+            values = {}
+            for name, item in cls.registered.items():
+                if name in db_overrides:
+                    values[name] = db_overrides[name]
+                else:
+                    values[name] = item.default_value
+            snapshot = (db_overrides, values)
+            cls.snapshot = snapshot
+        return snapshot[1]
+
     @classmethod
     def load_from_db(cls):
         """Loads dynamic properties from db."""
@@ -266,6 +382,19 @@ def run_all_unit_tests():
     os.environ[int_prop.name] = 'foo bar'
     assert int_prop.value == int_prop.default_value
 
+    # Check datastore overrides take precedence over the environment.
+    old_db_overrides = Registry.db_overrides
+    try:
+        os.environ[int_prop.name] = '12345'
+        Registry.db_overrides = {int_prop.name: 7}
+        assert int_prop.value == 7
+        assert str_prop.value == 'foo'
+        assert Registry.get_snapshot()[int_prop.name] == 7
+    finally:
+        Registry.db_overrides = old_db_overrides
+        del os.environ[int_prop.name]
+    assert int_prop.value == int_prop.default_value
+
 
 def validate_update_interval(value, errors):
     value = int(value)
@@ -282,7 +411,11 @@ UPDATE_INTERVAL_SEC = ConfigProperty(
         'integer between 1 and 300. To completely disable  reloading '
         'properties from a datastore, you must set the value to 0. However, '
         'you can only set the value to 0 by directly modifying the app.yaml '
-        'file. Maximum value is "%s".' % MAX_UPDATE_INTERVAL_SEC),
+        'file. Maximum value is "%s". The edits made in the admin console '
+        'are usually picked up within seconds, as the instances check a '
+        'generation stamp in memcache; the properties are also reloaded '
+        'every this many seconds, in case an edit was missed.' % (
+            MAX_UPDATE_INTERVAL_SEC)),
     default_value=DEFAULT_UPDATE_INTERVAL_SEC,
     validator=validate_update_interval)
 
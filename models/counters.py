@@ -16,6 +16,24 @@
 
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
+import collections
+import threading
+import time
+
+
+# max number of the latest requests used to compute percentiles of a handler
+MAX_REQUEST_SAMPLES = 1000
+
+# number of log-scale buckets of a histogram; the last one holds all values
+# greater than or equal to 2 ** (HISTOGRAM_BUCKETS - 2)
+HISTOGRAM_BUCKETS = 48
+
+# default time window of a rate counter
+DEFAULT_RATE_WINDOW_SEC = 60
+
+# thread local storage for the spans of the current request
+SPANS_THREAD_LOCAL = threading.local()
+
 
 class PerfCounter(object):
     """A generic, in-process integer counter."""
@@ -45,6 +63,287 @@ class PerfCounter(object):
         return self._value
 
 
+class PerfRateCounter(PerfCounter):
+    """An integer counter that also knows its rate over a recent time window.
+
+    The window is divided into one second slots, so the memory used does not
+    depend on how often the counter is incremented.
+    """
+
+    def __init__(self, name, doc_string, window_sec=DEFAULT_RATE_WINDOW_SEC):
+        super(PerfRateCounter, self).__init__(name, doc_string)
+        self._window_sec = window_sec
+        self._slot_times = [0] * window_sec
+        self._slot_counts = [0] * window_sec
+
+    def inc(self, increment=1, context=None):
+        """Increments value and the count of the current second."""
+        super(PerfRateCounter, self).inc(increment=increment, context=context)
+        now = int(time.time())
+        slot = now % self._window_sec
+        if self._slot_times[slot] != now:
+            self._slot_times[slot] = now
+            self._slot_counts[slot] = 0
+        self._slot_counts[slot] += increment
+
+    @property
+    def window_sec(self):
+        return self._window_sec
+
+    def get_rate(self, now=None):
+        """Returns average increments per second over the time window."""
+        if now is None:
+            now = int(time.time())
+        total = 0
+        for slot_time, slot_count in zip(self._slot_times, self._slot_counts):
+            if now - slot_time < self._window_sec:
+                total += slot_count
+        return float(total) / self._window_sec
+
+
+class PerfHistogram(PerfCounter):
+    """A distribution of values in fixed log-scale buckets.
+
+    A bucket with index i > 0 holds values in [2 ** (i - 1), 2 ** i); bucket 0
+    holds values less than 1. The value of the histogram is a number of values
+    added to it.
+    """
+
+    def __init__(self, name, doc_string):
+        super(PerfHistogram, self).__init__(name, doc_string)
+        self._buckets = [0] * HISTOGRAM_BUCKETS
+        self._sum = 0
+        self._max = 0
+
+    @classmethod
+    def get_bucket_index(cls, value):
+        if value < 1:
+            return 0
+        return min(int(value).bit_length(), HISTOGRAM_BUCKETS - 1)
+
+    @classmethod
+    def get_bucket_upper_bound(cls, index):
+        return 2 ** index
+
+    def add(self, value):
+        """Adds a value to the distribution."""
+        self.inc()
+        self._buckets[self.get_bucket_index(value)] += 1
+        self._sum += value
+        self._max = max(self._max, value)
+
+    @property
+    def buckets(self):
+        return list(self._buckets)
+
+    @property
+    def max(self):
+        return self._max
+
+    @property
+    def mean(self):
+        if not self.value:
+            return 0
+        return float(self._sum) / self.value
+
+    def get_percentile(self, percent):
+        """Returns an upper bound of the bucket holding the percentile value."""
+        if not self.value:
+            return 0
+        rank = percent / 100.0 * self.value
+        total = 0
+        for index, count in enumerate(self._buckets):
+            total += count
+            if total >= rank and count:
+                return min(self.get_bucket_upper_bound(index), self._max)
+        return self._max
+
+
+class PerfSpan(object):
+    """Measures time of an operation made while serving the current request.
+
+    Use it as a context manager:
+
+        with PerfSpan('db.get'):
+            entity = db.get(key)
+
+    The time is recorded only between RequestStats.begin() and end().
+    """
+
+    def __init__(self, name, histogram=None):
+        """Creates a new span.
+
+        Args:
+            name: A name of the operation.
+            histogram: A PerfHistogram to add the operation time (ms) to; it is
+                added both during and outside of requests.
+        """
+        self._name = name
+        self._histogram = histogram
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, unused_type, unused_value, unused_traceback):
+        elapsed = time.time() - self._start
+        if self._histogram:
+            self._histogram.add(elapsed * 1000)
+        spans = getattr(SPANS_THREAD_LOCAL, 'spans', None)
+        if spans is not None:
+            count, total = spans.get(self._name, (0, 0))
+            spans[self._name] = (count + 1, total + elapsed)
+        return False
+
+
+class RequestStats(object):
+    """Latency and API call statistics of the requests served by a handler."""
+
+    def __init__(self, name):
+        self._name = name
+        self._count = 0
+        self._latencies = collections.deque(maxlen=MAX_REQUEST_SAMPLES)
+        self._rpc_counts = collections.deque(maxlen=MAX_REQUEST_SAMPLES)
+
+        # A map of span name to a tuple of count and total time of the spans.
+        self._spans = {}
+
+    @classmethod
+    def begin(cls):
+        """Starts recording spans of the current request."""
+        SPANS_THREAD_LOCAL.spans = {}
+        SPANS_THREAD_LOCAL.start = time.time()
+
+    @classmethod
+    def end(cls, name, rpc_count):
+        """Stops recording spans; adds the request to the handler statistics.
+
+        Args:
+            name: A name of the handler that served the request.
+            rpc_count: A number of API calls made by the request.
+
+        Returns:
+            The time in seconds passed since begin().
+        """
+        spans = SPANS_THREAD_LOCAL.spans
+        latency = time.time() - SPANS_THREAD_LOCAL.start
+        del SPANS_THREAD_LOCAL.spans
+        del SPANS_THREAD_LOCAL.start
+
+        stats = Registry.request_stats.get(name)
+        if not stats:
+            stats = RequestStats(name)
+            Registry.request_stats[name] = stats
+        stats.add(latency, rpc_count, spans)
+        return latency
+
+    def add(self, latency, rpc_count, spans):
+        """Adds a request to the statistics."""
+        self._count += 1
+        self._latencies.append(latency)
+        self._rpc_counts.append(rpc_count)
+        for span_name, (count, total) in spans.iteritems():
+            old_count, old_total = self._spans.get(span_name, (0, 0))
+            self._spans[span_name] = (old_count + count, old_total + total)
+
+    @classmethod
+    def _percentile(cls, sorted_values, percent):
+        if not sorted_values:
+            return 0
+        index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+        return sorted_values[index]
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def count(self):
+        return self._count
+
+    def get_latency_percentiles_ms(self, percents=(50, 90, 99)):
+        """Returns latency percentiles over the latest requests."""
+        latencies = sorted(self._latencies)
+        return [self._percentile(latencies, percent) * 1000
+                for percent in percents]
+
+    def get_rpc_count_percentiles(self, percents=(50, 90, 99)):
+        """Returns percentiles of API call count over the latest requests."""
+        rpc_counts = sorted(self._rpc_counts)
+        return [self._percentile(rpc_counts, percent) for percent in percents]
+
+    def get_spans_per_request(self):
+        """Returns a map of span name to average count and time (ms)."""
+        results = {}
+        for span_name, (count, total) in self._spans.iteritems():
+            results[span_name] = (
+                float(count) / self._count, total * 1000 / self._count)
+        return results
+
+
 class Registry(object):
     """Holds all registered counters."""
     registered = {}
+
+    # A map of a handler name to the RequestStats of its requests.
+    request_stats = {}
+
+
+def run_all_unit_tests():
+    """Runs all unit tests for this modules."""
+    stats = RequestStats('test')
+    for index in xrange(100):
+        stats.add(index / 1000.0, index % 10, {'db.get': (2, 0.002)})
+    assert stats.count == 100
+    assert [round(value) for value in (
+        stats.get_latency_percentiles_ms())] == [50, 89, 98]
+    assert stats.get_rpc_count_percentiles((0, 100)) == [0, 9]
+    count, time_ms = stats.get_spans_per_request()['db.get']
+    assert count == 2 and round(time_ms) == 2
+
+    # Check only the latest requests are used to compute percentiles.
+    for index in xrange(MAX_REQUEST_SAMPLES):
+        stats.add(1, 1, {})
+    assert stats.get_latency_percentiles_ms() == [1000, 1000, 1000]
+
+    # Check spans are recorded only within a request.
+    with PerfSpan('db.get'):
+        pass
+    RequestStats.begin()
+    with PerfSpan('db.get'):
+        pass
+    with PerfSpan('db.get'):
+        pass
+    RequestStats.end('test', 3)
+    assert stats.count == 100 + MAX_REQUEST_SAMPLES
+    assert Registry.request_stats['test'].count == 1
+    assert Registry.request_stats['test'].get_spans_per_request()[
+        'db.get'][0] == 2
+    del Registry.request_stats['test']
+
+    # Check histogram buckets and percentiles.
+    histogram = PerfHistogram('gcb-test-histogram', 'test')
+    for value in [0.5, 1, 3, 3, 100, 5000]:
+        histogram.add(value)
+    assert histogram.value == 6
+    assert histogram.buckets[:4] == [1, 1, 2, 0]
+    assert histogram.get_percentile(50) == 4
+    assert histogram.get_percentile(80) == 128
+    assert histogram.get_percentile(100) == 5000
+    assert histogram.max == 5000
+    assert PerfHistogram.get_bucket_index(2 ** 100) == HISTOGRAM_BUCKETS - 1
+
+    # Check rate is computed over the time window only.
+    rate = PerfRateCounter('gcb-test-rate', 'test', window_sec=10)
+    rate.inc(30)
+    rate.inc(20)
+    assert rate.value == 50
+    assert rate.get_rate() == 5.0
+    assert rate.get_rate(now=int(time.time()) + 10) == 0
+    del Registry.registered['gcb-test-histogram']
+    del Registry.registered['gcb-test-rate']
+
+
+if __name__ == '__main__':
+    run_all_unit_tests()
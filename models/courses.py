@@ -17,21 +17,60 @@
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 import copy
+import csv
 import logging
+import marshal
 import os
 import pickle
+from StringIO import StringIO
 import sys
+import time
 from tools import verify
 import yaml
+import zlib
+from counters import PerfCounter
+from models import CAN_USE_MEMCACHE
 from models import MemcacheManager
 import progress
+from request_cache import RequestCache
 import transforms
 import vfs
+from google.appengine.api import memcache
 
 
 COURSE_MODEL_VERSION_1_2 = '1.2'
 COURSE_MODEL_VERSION_1_3 = '1.3'
 
+# Version of the encoding of cached course mementos; it is a part of the
+# memcache key, so values encoded differently are never read back.
+MEMENTO_ENCODING_VERSION = 2
+
+# The first byte of an encoded memento names the codec used for the rest; an
+# upper case codec means the data was also compressed with zlib.
+MEMENTO_CODEC_MARSHAL = 'm'
+MEMENTO_CODEC_PICKLE = 'p'
+
+# Encoded mementos larger than this are compressed.
+MEMENTO_COMPRESSION_MIN_BYTES = 64 * 1024
+
+# A course whose single file representation is larger than this is saved as
+# separate records of a unit and its lessons.
+COURSE_RECORDS_MIN_BYTES = 256 * 1024
+
+# Memcache key of the content version stamp of the course of a namespace.
+COURSE_VERSION_KEY = 'course:version'
+
+# How often an instance checks whether a course model it holds was changed.
+COURSE_MODEL_CACHE_CHECK_SECS = 1
+
+# performance counters
+COURSE_MODEL_CACHE_HIT = PerfCounter(
+    'gcb-models-course-model-cache-hit',
+    'A number of times a course model was found in the in-process cache.')
+COURSE_MODEL_CACHE_MISS = PerfCounter(
+    'gcb-models-course-model-cache-miss',
+    'A number of times a course model was not found in the in-process cache.')
+
 
 def deep_dict_merge(real_values_dict, default_values_dict):
     """Merges default and real value dictionaries recursively."""
@@ -58,6 +97,38 @@ def deep_dict_merge(real_values_dict, default_values_dict):
     return result
 
 
+class ReadOnlyDict(dict):
+    """A dictionary that can't be modified after it was created.
+
+    Use copy.deepcopy() to get a regular mutable copy of it.
+    """
+
+    def _fail(self, *unused_args, **unused_kwargs):
+        raise TypeError('Object is read-only.')
+
+    # pylint: disable-msg=g-bad-name
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = (
+        _fail)
+
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+    def __deepcopy__(self, memo):
+        return dict([
+            (copy.deepcopy(key, memo), copy.deepcopy(value, memo))
+            for key, value in self.iteritems()])
+
+
+def make_read_only(value):
+    """Recursively converts dicts to ReadOnlyDict and lists to tuples."""
+    if isinstance(value, dict):
+        return ReadOnlyDict([
+            (key, make_read_only(item)) for key, item in value.iteritems()])
+    if isinstance(value, list):
+        return tuple([make_read_only(item) for item in value])
+    return value
+
+
 # Here are the defaults for a new course.
 DEFAULT_COURSE_YAML_DICT = {
     'course': {
@@ -84,6 +155,9 @@ DEFAULT_EXISTING_COURSE_YAML_DICT = deep_dict_merge(
         'now_available': True}},
     DEFAULT_COURSE_YAML_DICT)
 
+# Here are the read-only defaults returned when course.yaml is not available.
+READ_ONLY_DEFAULT_COURSE_YAML_DICT = make_read_only(DEFAULT_COURSE_YAML_DICT)
+
 # Here is the default course.yaml for a new course.
 EMPTY_COURSE_YAML = u"""# my new course.yaml
 course:
@@ -109,6 +183,11 @@ def copy_attributes(source, target, converter):
                 target, target_name, target_type(getattr(source, source_name)))
 
 
+# Content hashes of the pairs of CSV course files that passed verification; the
+# files don't need to be verified again while their content is the same.
+VERIFIED_CSV_COURSES = set()
+
+
 def load_csv_course(app_context):
     """Loads course data from the CSV files."""
     logging.info('Initializing datastore from CSV files.')
@@ -121,27 +200,37 @@ def load_csv_course(app_context):
         not app_context.fs.isfile(lesson_file)):
         return None, None
 
-    unit_stream = app_context.fs.open(unit_file)
-    lesson_stream = app_context.fs.open(lesson_file)
-
-    # Verify CSV file integrity.
-    units = verify.read_objects_from_csv_stream(
-        unit_stream, verify.UNITS_HEADER, verify.Unit)
-    lessons = verify.read_objects_from_csv_stream(
-        lesson_stream, verify.LESSONS_HEADER, verify.Lesson)
-    verifier = verify.Verifier()
-    verifier.verify_unit_fields(units)
-    verifier.verify_lesson_fields(lessons)
-    verifier.verify_unit_lesson_relationships(units, lessons)
-    assert verifier.errors == 0
-    assert verifier.warnings == 0
+    unit_bytes = app_context.fs.get(unit_file)
+    lesson_bytes = app_context.fs.get(lesson_file)
+
+    # Parse each file once; rows are used for both verification and loading.
+    unit_names, unit_rows = verify.read_rows_from_csv(
+        csv.reader(StringIO(unit_bytes)), verify.UNITS_HEADER)
+    lesson_names, lesson_rows = verify.read_rows_from_csv(
+        csv.reader(StringIO(lesson_bytes)), verify.LESSONS_HEADER)
+
+    # Verify CSV file integrity, unless the same files were verified before.
+    content_hash = (
+        vfs.compute_etag(unit_bytes), vfs.compute_etag(lesson_bytes))
+    if content_hash not in VERIFIED_CSV_COURSES:
+        units = verify.make_objects_from_rows(
+            unit_names, unit_rows, verify.Unit)
+        lessons = verify.make_objects_from_rows(
+            lesson_names, lesson_rows, verify.Lesson)
+        verifier = verify.Verifier()
+        verifier.verify_unit_fields(units)
+        verifier.verify_lesson_fields(lessons)
+        verifier.verify_unit_lesson_relationships(units, lessons)
+        assert verifier.errors == 0
+        assert verifier.warnings == 0
+        VERIFIED_CSV_COURSES.add(content_hash)
 
     # Load data from CSV files into a datastore.
-    units = verify.read_objects_from_csv_stream(
-        app_context.fs.open(unit_file), verify.UNITS_HEADER, Unit12,
+    units = verify.make_objects_from_rows(
+        unit_names, unit_rows, Unit12,
         converter=verify.UNIT_CSV_TO_DB_CONVERTER)
-    lessons = verify.read_objects_from_csv_stream(
-        app_context.fs.open(lesson_file), verify.LESSONS_HEADER, Lesson12,
+    lessons = verify.make_objects_from_rows(
+        lesson_names, lesson_rows, Lesson12,
         converter=verify.LESSON_CSV_TO_DB_CONVERTER)
     return units, lessons
 
@@ -161,6 +250,16 @@ def index_units_and_lessons(course):
                 lesson_index += 1
 
 
+def make_id_lookup_dict(items, id_name):
+    """Creates an index of str(item.<id_name>) to the first item with it."""
+    lookup = {}
+    for item in items:
+        key = str(getattr(item, id_name))
+        if key not in lookup:
+            lookup[key] = item
+    return lookup
+
+
 class AbstractCachedObject(object):
     """Abstract serializable versioned object that can stored in memcache."""
 
@@ -170,8 +269,9 @@ class AbstractCachedObject(object):
         # reading old cached values by the new version of the application we
         # add deployment version to the key. Now each version of the application
         # can put/get its own version of the course and the deployment.
-        return 'course:model:pickle:%s:%s' % (
-            cls.VERSION, os.environ.get('CURRENT_VERSION_ID'))
+        return 'course:model:v%s:%s:%s' % (
+            MEMENTO_ENCODING_VERSION, cls.VERSION,
+            os.environ.get('CURRENT_VERSION_ID'))
 
     @classmethod
     def new_memento(cls):
@@ -205,10 +305,50 @@ class AbstractCachedObject(object):
                 cls._make_key(), e)
             return None
 
+    @classmethod
+    def load_or_build(cls, app_context, build):
+        """Loads instance from memcache; builds and saves it if missing.
+
+        Of all the requests missing the instance at the same time only one
+        builds it; the others get the previous version.
+
+        Args:
+            app_context: An application context of the course.
+            build: A function returning a new instance or None.
+
+        Returns:
+            A tuple of the instance or None and whether the instance is a
+            previous version, which may be served while another request
+            builds a new one.
+        """
+        built = []
+
+        def compute():
+            instance = build()
+            built.append(instance)
+            if instance is None:
+                return None
+            return cls.memento_from_instance(instance).serialize()
+
+        binary_data, is_stale = MemcacheManager.get_or_compute_with_staleness(
+            cls._make_key(), compute,
+            namespace=app_context.get_namespace_name())
+        if built:
+            return built[0], False
+        try:
+            memento = cls.new_memento()
+            memento.deserialize(binary_data)
+            return cls.instance_from_memento(app_context, memento), is_stale
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.error(
+                'Failed to load object \'%s\' from memcache. %s',
+                cls._make_key(), e)
+            return build(), False
+
     @classmethod
     def save(cls, app_context, instance):
-        """Saves instance to memcache."""
-        MemcacheManager.set(
+        """Saves instance and its stale copy to memcache."""
+        MemcacheManager.set_with_staleness(
             cls._make_key(),
             cls.memento_from_instance(instance).serialize(),
             namespace=app_context.get_namespace_name())
@@ -220,17 +360,201 @@ class AbstractCachedObject(object):
             cls._make_key(),
             namespace=app_context.get_namespace_name())
 
+    # A map of the names of attributes holding lists of objects to the class
+    # of these objects; such lists are encoded column-oriented.
+    OBJECT_LISTS = {}
+
+    @classmethod
+    def _objects_to_columns(cls, objects):
+        """Encodes a list of objects as (attribute names, value rows)."""
+        if not objects:
+            return objects
+        names = tuple(sorted(objects[0].__dict__.keys()))
+        rows = []
+        for item in objects:
+            if len(item.__dict__) != len(names):
+                raise ValueError('Objects have different attributes.')
+            rows.append(tuple([item.__dict__[name] for name in names]))
+        return (names, tuple(rows))
+
+    @classmethod
+    def _columns_to_objects(cls, columns, object_class):
+        """Decodes a list of objects from (attribute names, value rows)."""
+        if not columns:
+            return columns
+        names, rows = columns
+        objects = []
+        for row in rows:
+            item = object_class.__new__(object_class)
+            item.__dict__ = dict(zip(names, row))
+            objects.append(item)
+        return objects
+
+    def to_compact_dict(self):
+        """Returns a dict of instance attributes, with object lists encoded."""
+        adict = dict(self.__dict__)
+        for name in self.OBJECT_LISTS:
+            adict[name] = self._objects_to_columns(adict[name])
+        return adict
+
+    def from_compact_dict(self, adict):
+        """Sets instance attributes from a dict made by to_compact_dict()."""
+        adict = dict(adict)
+        for name, object_class in self.OBJECT_LISTS.items():
+            adict[name] = self._columns_to_objects(adict[name], object_class)
+        self.__dict__.update(adict)
+
     def serialize(self):
-        """Saves instance to a pickle representation."""
-        return pickle.dumps(self.__dict__)
+        """Saves instance to a compact binary representation.
+
+        The attributes are marshalled, which is much faster to load than
+        pickle; object lists are encoded as tuples of attribute values. If an
+        attribute value can't be marshalled, the instance is pickled instead.
+        Large results are compressed.
+
+        Returns:
+            A string with the codec followed by the encoded instance.
+        """
+        try:
+            codec = MEMENTO_CODEC_MARSHAL
+            data = marshal.dumps(self.to_compact_dict())
+        except (KeyError, ValueError):
+            codec = MEMENTO_CODEC_PICKLE
+            data = pickle.dumps(self.__dict__, pickle.HIGHEST_PROTOCOL)
+        if len(data) > MEMENTO_COMPRESSION_MIN_BYTES:
+            codec = codec.upper()
+            data = zlib.compress(data)
+        return codec + data
 
     def deserialize(self, binary_data):
-        """Loads instance from a pickle representation."""
-        adict = pickle.loads(binary_data)
+        """Loads instance from a representation made by serialize()."""
+        codec, data = binary_data[0], binary_data[1:]
+        if codec.isupper():
+            codec = codec.lower()
+            data = zlib.decompress(data)
+        if codec == MEMENTO_CODEC_MARSHAL:
+            adict = marshal.loads(data)
+        elif codec == MEMENTO_CODEC_PICKLE:
+            adict = pickle.loads(data)
+        else:
+            raise Exception('Unknown codec: %s.' % codec)
         if not self.version == adict.get('version'):
             raise Exception('Expected version %s, found %s.' % (
                 self.version, adict.get('version')))
-        self.__dict__.update(adict)
+        if codec == MEMENTO_CODEC_MARSHAL:
+            self.from_compact_dict(adict)
+        else:
+            self.__dict__.update(adict)
+
+
+class CourseModelCache(object):
+    """An in-process cache of course models shared by all requests.
+
+    Cached models are shared, so they must never be modified; Course makes a
+    private copy of its model before the first change. The cache is used only
+    while handling a request and if memcache is enabled.
+
+    Each namespace has a content version stamp in memcache, which is changed
+    every time the course is saved. An instance checks the stamp at most once
+    every COURSE_MODEL_CACHE_CHECK_SECS and drops the model if it changed.
+    """
+
+    # A map of namespace to a tuple of (app_context, version stamp, time of the
+    # last check of the stamp, model).
+    models = {}
+
+    @classmethod
+    def can_cache(cls):
+        return CAN_USE_MEMCACHE.value and RequestCache.is_active()
+
+    @classmethod
+    def _get_version(cls, namespace):
+        """Returns the version stamp of a course or None if unavailable."""
+        try:
+            # A missing stamp is created with a new unique value, so the
+            # instances drop their models even if the stamp was evicted.
+            return memcache.incr(
+                COURSE_VERSION_KEY, delta=0,
+                initial_value=long(time.time() * 1000000),
+                namespace=namespace)
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.error('Failed to get course version: %s.', str(e))
+            return None
+
+    @classmethod
+    def get(cls, app_context, load):
+        """Returns a model of a course; loads it if it is not cached.
+
+        Args:
+            app_context: The context of the course.
+            load: A function returning a tuple of a newly loaded model of the
+                course and whether it is a previous version of the course.
+
+        Returns:
+            A tuple of the model and whether it is shared by other requests.
+        """
+        if not cls.can_cache():
+            return load()[0], False
+
+        namespace = app_context.get_namespace_name()
+        now = time.time()
+        item = cls.models.get(namespace)
+        if item and item[0] is app_context:
+            age = now - item[2]
+            if 0 <= age < COURSE_MODEL_CACHE_CHECK_SECS:
+                COURSE_MODEL_CACHE_HIT.inc()
+                return item[3], True
+            version = cls._get_version(namespace)
+            if version is not None and version == item[1]:
+                cls.models[namespace] = (app_context, version, now, item[3])
+                COURSE_MODEL_CACHE_HIT.inc()
+                return item[3], True
+        else:
+            version = cls._get_version(namespace)
+
+        # The version is read before the model, so a change saved while the
+        # model is loaded makes us load it again on the next check.
+        COURSE_MODEL_CACHE_MISS.inc()
+        model, is_stale = load()
+
+        # A previous version served while the course is being reloaded after a
+        # change must not be kept under the new version stamp. Neither must a
+        # model built from the previous version of the course file, which the
+        # request that rebuilt it may have put to memcache after the change.
+        if version is None or is_stale or not cls._is_current(
+            app_context, model):
+            cls.models.pop(namespace, None)
+            return model, False
+        cls.models[namespace] = (app_context, version, now, model)
+        return model, True
+
+    @classmethod
+    def _is_current(cls, app_context, model):
+        """Checks a model was built from the current version of its file."""
+        if not isinstance(model, CourseModel13):
+            return True
+        metadata = app_context.fs.get_metadata(
+            app_context.fs.impl.physical_to_logical(
+                PersistentCourse13.COURSES_FILENAME))
+        if not metadata:
+            return model.etag is None
+        return not metadata.etag or metadata.etag == model.etag
+
+    @classmethod
+    def invalidate(cls, app_context):
+        """Drops the model of a course here and in all other instances."""
+        namespace = app_context.get_namespace_name()
+        cls.models.pop(namespace, None)
+        try:
+            memcache.incr(
+                COURSE_VERSION_KEY, initial_value=long(time.time() * 1000000),
+                namespace=namespace)
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.error('Failed to change course version: %s.', str(e))
+
+    @classmethod
+    def clear(cls):
+        cls.models.clear()
 
 
 class Unit12(object):
@@ -289,6 +613,7 @@ class CachedCourse12(AbstractCachedObject):
     """A representation of a Course12 optimized for storing in memcache."""
 
     VERSION = COURSE_MODEL_VERSION_1_2
+    OBJECT_LISTS = {'units': Unit12, 'lessons': Lesson12}
 
     def __init__(self, units=None, lessons=None, unit_id_to_lessons=None):
         self.version = self.VERSION
@@ -300,6 +625,13 @@ class CachedCourse12(AbstractCachedObject):
     def new_memento(cls):
         return CachedCourse12()
 
+    def to_compact_dict(self):
+        # The index refers to the same lesson objects as the list of lessons;
+        # it is cheaper to rebuild it after loading than to encode it.
+        adict = super(CachedCourse12, self).to_compact_dict()
+        adict['unit_id_to_lessons'] = None
+        return adict
+
     @classmethod
     def instance_from_memento(cls, app_context, memento):
         return CourseModel12(
@@ -320,15 +652,20 @@ class CourseModel12(object):
 
     @classmethod
     def load(cls, app_context):
-        """Loads course data into a model."""
-        course = CachedCourse12.load(app_context)
-        if not course:
+        """Loads course data into a model.
+
+        Returns:
+            A tuple of the model or None and whether it is a previous version
+            of the course; see AbstractCachedObject.load_or_build().
+        """
+
+        def build():
             units, lessons = load_csv_course(app_context)
             if units and lessons:
-                course = CourseModel12(app_context, units, lessons)
-        if course:
-            CachedCourse12.save(app_context, course)
-        return course
+                return CourseModel12(app_context, units, lessons)
+            return None
+
+        return CachedCourse12.load_or_build(app_context, build)
 
     @classmethod
     def _make_unit_id_to_lessons_lookup_dict(cls, lessons):
@@ -360,6 +697,11 @@ class CourseModel12(object):
             self._unit_id_to_lessons = (
                 self._make_unit_id_to_lessons_lookup_dict(self._lessons))
             index_units_and_lessons(self)
+        self._unit_id_to_unit = make_id_lookup_dict(self._units, 'unit_id')
+
+        # A map of activity filename to a tuple of the entity tag of the
+        # activity content and the ids of its interactive blocks.
+        self._activity_block_ids = {}
 
     @property
     def app_context(self):
@@ -377,6 +719,10 @@ class CourseModel12(object):
     def unit_id_to_lessons(self):
         return self._unit_id_to_lessons
 
+    @property
+    def activity_block_ids(self):
+        return self._activity_block_ids
+
     def get_units(self):
         return self._units[:]
 
@@ -385,10 +731,7 @@ class CourseModel12(object):
 
     def find_unit_by_id(self, unit_id):
         """Finds a unit given its id."""
-        for unit in self._units:
-            if str(unit.unit_id) == str(unit_id):
-                return unit
-        return None
+        return self._unit_id_to_unit.get(str(unit_id))
 
     def get_assessment_filename(self, unit_id):
         """Returns assessment base filename."""
@@ -409,6 +752,8 @@ class CourseModel12(object):
         """Creates JSON representation of this instance."""
         adict = copy.deepcopy(self)
         del adict._app_context
+        del adict._unit_id_to_unit
+        del adict._activity_block_ids
         return transforms.dumps(
             adict,
             indent=4, sort_keys=True,
@@ -475,18 +820,37 @@ class PersistentCourse13(object):
 
     COURSES_FILENAME = 'data/course.json'
 
+    # Records of a large course are stored in this folder; each record file is
+    # named after a hash of its content.
+    RECORDS_FOLDER = 'data/course'
+
     def __init__(self, next_id=None, units=None, lessons=None):
         self.version = CourseModel13.VERSION
         self.next_id = next_id
         self.units = units
         self.lessons = lessons
 
+        # Names of the files with units and lessons; empty if they are stored
+        # in the course file itself.
+        self.records = []
+
+        # Names of the record files of the previous version of the course,
+        # which are kept for the readers still holding that version.
+        self.old_records = []
+
     def to_dict(self):
         """Saves object attributes into a dict."""
         result = {}
         result['version'] = str(self.version)
         result['next_id'] = int(self.next_id)
 
+        if self.old_records:
+            result['old_records'] = self.old_records
+
+        if self.records:
+            result['records'] = self.records
+            return result
+
         units = []
         for unit in self.units:
             units.append(transforms.instance_to_dict(unit))
@@ -499,11 +863,41 @@ class PersistentCourse13(object):
 
         return result
 
+    def to_records(self):
+        """Splits units and lessons into dicts of a unit and its lessons."""
+        unit_id_to_lessons = {}
+        for lesson in self.lessons:
+            unit_id_to_lessons.setdefault(str(lesson.unit_id), []).append(
+                lesson)
+
+        records = []
+        for unit in self.units:
+            records.append(
+                ([unit], unit_id_to_lessons.pop(str(unit.unit_id), [])))
+
+        # Lessons of the units that don't exist are kept in a record too.
+        orphans = [lesson for lesson in self.lessons
+                   if str(lesson.unit_id) in unit_id_to_lessons]
+        if orphans:
+            records.append(([], orphans))
+
+        return [{
+            'units': [transforms.instance_to_dict(unit) for unit in units],
+            'lessons': [
+                transforms.instance_to_dict(lesson) for lesson in lessons]}
+                for units, lessons in records]
+
     def _from_dict(self, adict):
         """Loads instance attributes from the dict."""
         self.next_id = int(adict.get('next_id'))
-
+        self.records = adict.get('records') or []
+        self.old_records = adict.get('old_records') or []
         self.units = []
+        self.lessons = []
+        self._add_record(adict)
+
+    def _add_record(self, adict):
+        """Loads units and lessons from the dict."""
         unit_dicts = adict.get('units')
         if unit_dicts:
             for unit_dict in unit_dicts:
@@ -511,7 +905,6 @@ class PersistentCourse13(object):
                 transforms.dict_to_instance(unit_dict, unit)
                 self.units.append(unit)
 
-        self.lessons = []
         lesson_dicts = adict.get('lessons')
         if lesson_dicts:
             for lesson_dict in lesson_dicts:
@@ -521,15 +914,81 @@ class PersistentCourse13(object):
 
     @classmethod
     def save(cls, app_context, course):
-        """Saves course to datastore."""
+        """Saves course to datastore.
+
+        A large course is saved as records of a unit and its lessons, which
+        the course file lists. A record file is named after a hash of its
+        content, so only the records that changed are written, and they are
+        written before the course file refers to them. The course file is put
+        only if it has not changed since the course was loaded. The records
+        of the version being replaced are deleted only by the next save, so
+        the requests still reading that version can find them.
+
+        Args:
+            app_context: An application context of the course.
+            course: A CourseModel13 to save.
+
+        Returns:
+            A tuple of the entity tag of the new course file, a list of the
+            names of its record files and a list of the names of the record
+            files of the previous version that are still kept.
+
+        Raises:
+            vfs.ConcurrentUpdateError: if someone else saved the course since
+                it was loaded.
+        """
         persistent = PersistentCourse13(
             next_id=course.next_id,
             units=course.units, lessons=course.lessons)
 
         fs = app_context.fs.impl
+        kept = set(course.records) | set(course.old_records)
+        written = []
+        if len(persistent.serialize()) > COURSE_RECORDS_MIN_BYTES:
+            for record in persistent.to_records():
+                record_data = transforms.dumps(record).encode('utf-8')
+                record_filename = '%s/%s.json' % (
+                    cls.RECORDS_FOLDER, vfs.compute_etag(record_data))
+                if (record_filename not in kept and
+                    record_filename not in persistent.records):
+                    app_context.fs.put(
+                        fs.physical_to_logical(record_filename),
+                        vfs.FileStreamWrapped(None, record_data))
+                    written.append(record_filename)
+                persistent.records.append(record_filename)
+        persistent.old_records = [
+            record_filename for record_filename in course.records
+            if record_filename not in persistent.records]
+        data = persistent.serialize()
+
         filename = fs.physical_to_logical(cls.COURSES_FILENAME)
-        app_context.fs.put(filename, vfs.FileStreamWrapped(
-            None, persistent.serialize()))
+        try:
+            app_context.fs.put(
+                filename, vfs.FileStreamWrapped(None, data),
+                expected_etag=course.etag)
+        except vfs.ConcurrentUpdateError:
+            # Nothing refers to the records written above, unless the version
+            # saved meanwhile happens to have the same ones.
+            in_use = set()
+            current_data = app_context.fs.get(filename)
+            if current_data:
+                current = PersistentCourse13()
+                current.deserialize(current_data)
+                in_use = set(current.records) | set(current.old_records)
+            for record_filename in written:
+                if record_filename not in in_use:
+                    app_context.fs.delete(
+                        fs.physical_to_logical(record_filename))
+            raise
+
+        # The records of the version before the previous one are no longer
+        # referred to.
+        unused = kept - set(persistent.records) - set(persistent.old_records)
+        for record_filename in unused:
+            app_context.fs.delete(fs.physical_to_logical(record_filename))
+
+        return (
+            vfs.compute_etag(data), persistent.records, persistent.old_records)
 
     @classmethod
     def load(cls, app_context):
@@ -537,11 +996,22 @@ class PersistentCourse13(object):
         fs = app_context.fs.impl
         filename = fs.physical_to_logical(cls.COURSES_FILENAME)
         if app_context.fs.isfile(filename):
+            data = app_context.fs.get(filename)
             persistent = PersistentCourse13()
-            persistent.deserialize(app_context.fs.get(filename))
+            persistent.deserialize(data)
+            for record_filename in persistent.records:
+                stream = app_context.fs.open(
+                    fs.physical_to_logical(record_filename))
+                if not stream:
+                    raise Exception(
+                        'Course record %s is missing.' % record_filename)
+                persistent._add_record(  # pylint: disable-msg=protected-access
+                    transforms.loads(stream.read().decode('utf-8')))
             return CourseModel13(
                 app_context, next_id=persistent.next_id,
-                units=persistent.units, lessons=persistent.lessons)
+                units=persistent.units, lessons=persistent.lessons,
+                etag=vfs.compute_etag(data), records=persistent.records,
+                old_records=persistent.old_records)
         return None
 
     def serialize(self):
@@ -564,15 +1034,21 @@ class CachedCourse13(AbstractCachedObject):
     """A representation of a Course12 optimized for storing in memcache."""
 
     VERSION = COURSE_MODEL_VERSION_1_3
+    OBJECT_LISTS = {'units': Unit13, 'lessons': Lesson13}
 
     def __init__(
         self, next_id=None, units=None, lessons=None,
-        unit_id_to_lesson_ids=None):
+        unit_id_to_lesson_ids=None, etag=None, records=None,
+        old_records=None, activity_block_ids=None):
 
         self.version = self.VERSION
         self.next_id = next_id
         self.units = units
         self.lessons = lessons
+        self.etag = etag
+        self.records = records
+        self.old_records = old_records
+        self.activity_block_ids = activity_block_ids
 
         # This is almost the same as PersistentCourse13 above, but it also
         # stores additional indexes used for performance optimizations. There
@@ -589,14 +1065,21 @@ class CachedCourse13(AbstractCachedObject):
         return CourseModel13(
             app_context, next_id=memento.next_id,
             units=memento.units, lessons=memento.lessons,
-            unit_id_to_lesson_ids=memento.unit_id_to_lesson_ids)
+            unit_id_to_lesson_ids=memento.unit_id_to_lesson_ids,
+            etag=getattr(memento, 'etag', None),
+            records=getattr(memento, 'records', None),
+            old_records=getattr(memento, 'old_records', None),
+            activity_block_ids=getattr(memento, 'activity_block_ids', None))
 
     @classmethod
     def memento_from_instance(cls, course):
         return CachedCourse13(
             next_id=course.next_id,
             units=course.units, lessons=course.lessons,
-            unit_id_to_lesson_ids=course.unit_id_to_lesson_ids)
+            unit_id_to_lesson_ids=course.unit_id_to_lesson_ids,
+            etag=course.etag, records=course.records,
+            old_records=course.old_records,
+            activity_block_ids=course.activity_block_ids)
 
 
 class CourseModel13(object):
@@ -606,13 +1089,14 @@ class CourseModel13(object):
 
     @classmethod
     def load(cls, app_context):
-        """Loads course from memcache or persistence."""
-        course = CachedCourse13.load(app_context)
-        if not course:
-            course = PersistentCourse13.load(app_context)
-        if course:
-            CachedCourse13.save(app_context, course)
-        return course
+        """Loads course from memcache or persistence.
+
+        Returns:
+            A tuple of the model or None and whether it is a previous version
+            of the course; see AbstractCachedObject.load_or_build().
+        """
+        return CachedCourse13.load_or_build(
+            app_context, lambda: PersistentCourse13.load(app_context))
 
     @classmethod
     def _make_unit_id_to_lessons_lookup_dict(cls, lessons):
@@ -627,14 +1111,28 @@ class CourseModel13(object):
 
     def __init__(
         self, app_context, next_id=None, units=None, lessons=None,
-        unit_id_to_lesson_ids=None):
+        unit_id_to_lesson_ids=None, etag=None, records=None,
+        old_records=None, activity_block_ids=None):
 
         # Init default values.
         self._app_context = app_context
         self._next_id = 1  # a counter for creating sequential entity ids
         self._units = []
         self._lessons = []
+
+        # An entity tag of the persisted course this model was loaded from, if
+        # any, names of the files of its records and of the records of the
+        # previous version, which are still kept.
+        self._etag = etag
+        self._records = records or []
+        self._old_records = old_records or []
+
+        # A map of activity filename to a tuple of the entity tag of the
+        # activity content and the ids of its interactive blocks.
+        self._activity_block_ids = activity_block_ids or {}
         self._unit_id_to_lesson_ids = {}
+        self._unit_id_to_unit = {}
+        self._lesson_id_to_lesson = {}
 
         # These array keep dirty object in current transaction.
         self._dirty_units = []
@@ -642,6 +1140,11 @@ class CourseModel13(object):
         self._deleted_units = []
         self._deleted_lessons = []
 
+        # A map of the name of an activity file written in current transaction
+        # to a tuple of its previous content, or None if it did not exist, and
+        # draft status; the files are restored if the course is not saved.
+        self._replaced_activities = {}
+
         # Set provided values.
         if next_id:
             self._next_id = next_id
@@ -651,6 +1154,7 @@ class CourseModel13(object):
             self._lessons = lessons
         if unit_id_to_lesson_ids:
             self._unit_id_to_lesson_ids = unit_id_to_lesson_ids
+            self._index_ids()
         else:
             self._index()
 
@@ -674,14 +1178,37 @@ class CourseModel13(object):
     def unit_id_to_lesson_ids(self):
         return self._unit_id_to_lesson_ids
 
+    @property
+    def etag(self):
+        return self._etag
+
+    @property
+    def records(self):
+        return self._records
+
+    @property
+    def old_records(self):
+        return self._old_records
+
+    @property
+    def activity_block_ids(self):
+        return self._activity_block_ids
+
     def _get_next_id(self):
         """Allocates next id in sequence."""
         next_id = self._next_id
         self._next_id += 1
         return next_id
 
+    def _index_ids(self):
+        """Indexes units and lessons by their ids."""
+        self._unit_id_to_unit = make_id_lookup_dict(self._units, 'unit_id')
+        self._lesson_id_to_lesson = make_id_lookup_dict(
+            self._lessons, 'lesson_id')
+
     def _index(self):
         """Indexes units and lessons."""
+        self._index_ids()
         self._unit_id_to_lesson_ids = self._make_unit_id_to_lessons_lookup_dict(
             self._lessons)
         index_units_and_lessons(self)
@@ -706,10 +1233,13 @@ class CourseModel13(object):
         units = self._units
         lessons = self._lessons
         unit_id_to_lesson_ids = self._unit_id_to_lesson_ids
+        unit_id_to_unit = self._unit_id_to_unit
+        lesson_id_to_lesson = self._lesson_id_to_lesson
         try:
             self._units = self._deleted_units
             self._lessons = self._deleted_lessons
             self._unit_id_to_lesson_ids = None
+            self._index_ids()
 
             # Delete owned assessments.
             for unit in self._deleted_units:
@@ -724,6 +1254,8 @@ class CourseModel13(object):
             self._units = units
             self._lessons = lessons
             self._unit_id_to_lesson_ids = unit_id_to_lesson_ids
+            self._unit_id_to_unit = unit_id_to_unit
+            self._lesson_id_to_lesson = lesson_id_to_lesson
 
     def _update_dirty_objects(self):
         """Update files owned by course."""
@@ -754,8 +1286,41 @@ class CourseModel13(object):
                     path, None, metadata_only=True,
                     is_draft=not lesson.now_available)
 
+    def _restore_replaced_activities(self):
+        """Restores the activity files written since the last save."""
+        fs = self.app_context.fs
+        for filename, (content, is_draft) in self._replaced_activities.items():
+            self._activity_block_ids.pop(filename, None)
+            path = fs.impl.physical_to_logical(filename)
+            if content is None:
+                fs.delete(path)
+            else:
+                fs.put(
+                    path, vfs.FileStreamWrapped(None, content),
+                    is_draft=is_draft)
+        self._replaced_activities = {}
+
     def save(self):
-        """Saves course to datastore and memcache."""
+        """Saves course to datastore and memcache.
+
+        Raises:
+            vfs.ConcurrentUpdateError: if someone else saved the course since
+                it was loaded; the course is not changed then.
+        """
+        self._index()
+        try:
+            self._etag, self._records, self._old_records = (
+                PersistentCourse13.save(self._app_context, self))
+        except vfs.ConcurrentUpdateError:
+            self._restore_replaced_activities()
+
+            # Whatever version was cached is out of date; make sure the next
+            # attempt starts from the version in the datastore.
+            CachedCourse13.delete(self._app_context)
+            CourseModelCache.invalidate(self._app_context)
+            raise
+
+        # Owned files are only changed once the course itself is saved.
         self._flush_deleted_objects()
         self._update_dirty_objects()
 
@@ -763,21 +1328,23 @@ class CourseModel13(object):
         self._dirty_lessons = []
         self._deleted_units = []
         self._deleted_lessons = []
+        self._replaced_activities = {}
 
-        self._index()
-        PersistentCourse13.save(self._app_context, self)
-        CachedCourse13.delete(self._app_context)
+        # Write the new version through to memcache, so the next load doesn't
+        # have to read it from the datastore.
+        CachedCourse13.save(self._app_context, self)
+        CourseModelCache.invalidate(self._app_context)
 
     def get_units(self):
         return self._units[:]
 
     def get_lessons(self, unit_id):
         lesson_ids = self._unit_id_to_lesson_ids.get(str(unit_id))
-        lessons = []
-        if lesson_ids:
-            for lesson_id in lesson_ids:
-                lessons.append(self.find_lesson_by_id(None, lesson_id))
-        return lessons
+        if not lesson_ids:
+            return []
+        return [
+            self._lesson_id_to_lesson.get(lesson_id)
+            for lesson_id in lesson_ids]
 
     def get_assessment_filename(self, unit_id):
         """Returns assessment base filename."""
@@ -790,23 +1357,22 @@ class CourseModel13(object):
         """Returns activity base filename."""
         lesson = self.find_lesson_by_id(None, lesson_id)
         assert lesson
+        return self._get_activity_filename_of(lesson)
+
+    @classmethod
+    def _get_activity_filename_of(cls, lesson):
+        """Returns activity base filename of a lesson, which may be edited."""
         if lesson.has_activity:
-            return 'assets/js/activity-%s.js' % lesson_id
+            return 'assets/js/activity-%s.js' % lesson.lesson_id
         return None
 
     def find_unit_by_id(self, unit_id):
         """Finds a unit given its id."""
-        for unit in self._units:
-            if str(unit.unit_id) == str(unit_id):
-                return unit
-        return None
+        return self._unit_id_to_unit.get(str(unit_id))
 
     def find_lesson_by_id(self, unused_unit, lesson_id):
         """Finds a lesson given its id."""
-        for lesson in self._lessons:
-            if str(lesson.lesson_id) == str(lesson_id):
-                return lesson
-        return None
+        return self._lesson_id_to_lesson.get(str(lesson_id))
 
     def add_unit(self, unit_type, title):
         """Adds a brand new unit."""
@@ -927,6 +1493,8 @@ class CourseModel13(object):
         existing_lesson.video = lesson.video
         existing_lesson.notes = lesson.notes
         existing_lesson.activity_title = lesson.activity_title
+        existing_lesson.has_activity = lesson.has_activity
+        existing_lesson.now_available = lesson.now_available
 
         self._index()
 
@@ -1012,8 +1580,10 @@ class CourseModel13(object):
         if errors is None:
             errors = []
 
-        path = self._app_context.fs.impl.physical_to_logical(
-            self.get_activity_filename(lesson.unit_id, lesson.lesson_id))
+        # The lesson may be an edited copy of the lesson in this model, which
+        # only gets an activity when the lesson is updated.
+        filename = self._get_activity_filename_of(lesson)
+        path = self._app_context.fs.impl.physical_to_logical(filename)
         root_name = 'activity'
 
         try:
@@ -1035,10 +1605,23 @@ class CourseModel13(object):
             return
 
         fs = self.app_context.fs
+        if filename not in self._replaced_activities:
+            metadata = fs.get_metadata(path)
+            if metadata:
+                self._replaced_activities[filename] = (
+                    fs.get(path), metadata.is_draft)
+            else:
+                self._replaced_activities[filename] = (None, None)
         fs.put(
             path, vfs.string_to_stream(activity_content),
             is_draft=not lesson.now_available)
 
+        # The activity was just parsed; index its blocks while we have it.
+        self._activity_block_ids[filename] = (
+            vfs.compute_etag(activity_content.encode('utf-8')),
+            progress.UnitLessonCompletionTracker.get_activity_block_ids(
+                activity))
+
     def import_from(self, src_course, errors):
         """Imports a content of another course into this course."""
 
@@ -1137,28 +1720,63 @@ class CourseModel13(object):
 class Course(object):
     """Manages a course and all of its components."""
 
+    # Here we store a map of a course namespace name to a tuple of the
+    # course.yaml filename, its entity tag and the settings parsed from it. The
+    # entity tag serves as a version stamp of the settings. Any change to the
+    # file content made via VFS put() is visible here on the next call and
+    # causes the settings to be parsed again; the file is parsed at most once
+    # per content change in each instance. Within a request the settings are
+    # also kept in the request cache.
+    COURSE_SETTINGS_CACHE = {}
+
     @classmethod
-    def get_environ(cls, app_context):
-        """Returns currently defined course settings as a dictionary."""
-        course_yaml = None
+    def _parse_environ(cls, course_data_filename, raw_bytes):
+        """Parses course settings from the raw bytes of a course.yaml file."""
         course_yaml_dict = None
-        course_data_filename = app_context.get_config_filename()
-        if app_context.fs.isfile(course_data_filename):
-            course_yaml = app_context.fs.open(course_data_filename)
-        if not course_yaml:
-            return DEFAULT_COURSE_YAML_DICT
         try:
-            course_yaml_dict = yaml.safe_load(
-                course_yaml.read().decode('utf-8'))
+            course_yaml_dict = yaml.safe_load(raw_bytes.decode('utf-8'))
         except Exception as e:  # pylint: disable-msg=broad-except
             logging.info(
                 'Error: course.yaml file at %s not accessible, '
                 'loading defaults. %s', course_data_filename, e)
 
         if not course_yaml_dict:
-            return DEFAULT_COURSE_YAML_DICT
-        return deep_dict_merge(
-            course_yaml_dict, DEFAULT_EXISTING_COURSE_YAML_DICT)
+            return READ_ONLY_DEFAULT_COURSE_YAML_DICT
+        return make_read_only(deep_dict_merge(
+            course_yaml_dict, DEFAULT_EXISTING_COURSE_YAML_DICT))
+
+    @classmethod
+    def get_environ(cls, app_context):
+        """Returns currently defined course settings as a read-only dict."""
+        course_data_filename = app_context.get_config_filename()
+        metadata = app_context.fs.get_metadata(course_data_filename)
+        if not metadata:
+            return READ_ONLY_DEFAULT_COURSE_YAML_DICT
+        etag = metadata.etag
+        if not etag:
+            # The file was stored before entity tags were introduced.
+            etag = vfs.compute_etag(app_context.fs.get(course_data_filename))
+
+        namespace = app_context.get_namespace_name()
+        return RequestCache.get(
+            ('course_environ', namespace, course_data_filename, etag),
+            lambda: cls._load_environ(
+                namespace, app_context, course_data_filename, etag))
+
+    @classmethod
+    def _load_environ(cls, namespace, app_context, course_data_filename, etag):
+        """Returns settings of a version of course.yaml; parses them once."""
+        cached = cls.COURSE_SETTINGS_CACHE.get(namespace)
+        if cached and cached[0] == course_data_filename and cached[1] == etag:
+            return cached[2]
+
+        stream = app_context.fs.open(course_data_filename)
+        if not stream:
+            return READ_ONLY_DEFAULT_COURSE_YAML_DICT
+        environ = cls._parse_environ(course_data_filename, stream.read())
+        cls.COURSE_SETTINGS_CACHE[namespace] = (
+            course_data_filename, etag, environ)
+        return environ
 
     @property
     def version(self):
@@ -1173,30 +1791,60 @@ class Course(object):
         # There is an expectation in our tests of automatic import
         # of data/*.csv files. This method can be used in tests to achieve
         # exactly that.
-        model = CourseModel12.load(app_context)
+        model = CourseModel12.load(app_context)[0]
         if model:
             return model
         return CourseModel13(app_context)
 
     @classmethod
     def _load(cls, app_context):
-        """Loads course data from persistence storage into this instance."""
+        """Loads course data from persistence storage into this instance.
+
+        Returns:
+            A tuple of the model and whether it is a previous version of the
+            course.
+        """
         if not is_editable_fs(app_context):
-            model = CourseModel12.load(app_context)
+            model, is_stale = CourseModel12.load(app_context)
             if model:
-                return model
+                return model, is_stale
         else:
-            model = CourseModel13.load(app_context)
+            model, is_stale = CourseModel13.load(app_context)
             if model:
-                return model
-        return cls.create_new_default_course(app_context)
+                return model, is_stale
+        return cls.create_new_default_course(app_context), False
 
     def __init__(self, handler, app_context=None):
         self._app_context = app_context if app_context else handler.app_context
         self._namespace = self._app_context.get_namespace_name()
-        self._model = self._load(self._app_context)
+
+        # The model may be shared with other requests and must be copied
+        # before it is modified; see _get_editable_model().
+        self._model, self._is_shared_model = RequestCache.get(
+            ('course_model', self._namespace),
+            lambda: CourseModelCache.get(
+                self._app_context, lambda: self._load(self._app_context)))
         self._tracker = None
 
+    def _get_editable_model(self):
+        """Returns the model; copies it first if it's shared."""
+        if self._is_shared_model:
+            app_context = self._model.app_context
+            self._model = copy.deepcopy(
+                self._model, {id(app_context): app_context})
+            self._is_shared_model = False
+
+            # Other courses created by this request will see the changes.
+            RequestCache.set(
+                ('course_model', self._namespace), (self._model, False))
+        return self._model
+
+    def _copy_if_shared(self, item):
+        """Copies a unit or a lesson of a shared model, so it can be edited."""
+        if item and self._is_shared_model:
+            return copy.copy(item)
+        return item
+
     @property
     def app_context(self):
         return self._app_context
@@ -1204,6 +1852,35 @@ class Course(object):
     def to_json(self):
         return self._model.to_json()
 
+    def get_activity_block_ids(self, unit_id, lesson_id, compute):
+        """Returns ids of the interactive blocks of an activity.
+
+        The ids are kept with the course model along with the entity tag of the
+        activity content they were computed for. They are computed again only
+        if the activity content changes.
+
+        Args:
+            unit_id: An id of the unit of the activity.
+            lesson_id: An id of the lesson of the activity.
+            compute: A function reading the activity and returning the ids.
+
+        Returns:
+            A list of block ids.
+        """
+        filename = self.get_activity_filename(unit_id, lesson_id)
+        metadata = self.app_context.fs.get_metadata(
+            os.path.join(self.app_context.get_home(), filename))
+        etag = metadata.etag if metadata else None
+        if not etag:
+            return compute()
+
+        # This only caches derived data, so it's fine for a shared model.
+        cached = self._model.activity_block_ids.get(filename)
+        if not cached or cached[0] != etag:
+            cached = (etag, compute())
+            self._model.activity_block_ids[filename] = cached
+        return list(cached[1])
+
     def get_progress_tracker(self):
         if not self._tracker:
             self._tracker = progress.UnitLessonCompletionTracker(self)
@@ -1216,13 +1893,14 @@ class Course(object):
         return self._model.get_lessons(unit_id)
 
     def save(self):
-        return self._model.save()
+        return self._get_editable_model().save()
 
     def find_unit_by_id(self, unit_id):
-        return self._model.find_unit_by_id(unit_id)
+        return self._copy_if_shared(self._model.find_unit_by_id(unit_id))
 
     def find_lesson_by_id(self, unit, lesson_id):
-        return self._model.find_lesson_by_id(unit, lesson_id)
+        return self._copy_if_shared(
+            self._model.find_lesson_by_id(unit, lesson_id))
 
     def is_last_assessment(self, unit):
         """Checks whether the given unit is the last of all the assessments."""
@@ -1233,33 +1911,33 @@ class Course(object):
 
     def add_unit(self):
         """Adds new unit to a course."""
-        return self._model.add_unit('U', 'New Unit')
+        return self._get_editable_model().add_unit('U', 'New Unit')
 
     def add_link(self):
         """Adds new link (other) to a course."""
-        return self._model.add_unit('O', 'New Link')
+        return self._get_editable_model().add_unit('O', 'New Link')
 
     def add_assessment(self):
         """Adds new assessment to a course."""
-        return self._model.add_unit('A', 'New Assessment')
+        return self._get_editable_model().add_unit('A', 'New Assessment')
 
     def add_lesson(self, unit):
-        return self._model.add_lesson(unit, 'New Lesson')
+        return self._get_editable_model().add_lesson(unit, 'New Lesson')
 
     def update_unit(self, unit):
-        return self._model.update_unit(unit)
+        return self._get_editable_model().update_unit(unit)
 
     def update_lesson(self, lesson):
-        return self._model.update_lesson(lesson)
+        return self._get_editable_model().update_lesson(lesson)
 
     def move_lesson_to(self, lesson, unit):
-        return self._model.move_lesson_to(lesson, unit)
+        return self._get_editable_model().move_lesson_to(lesson, unit)
 
     def delete_unit(self, unit):
-        return self._model.delete_unit(unit)
+        return self._get_editable_model().delete_unit(unit)
 
     def delete_lesson(self, lesson):
-        return self._model.delete_lesson(lesson)
+        return self._get_editable_model().delete_lesson(lesson)
 
     def get_score(self, student, assessment_id):
         """Gets a student's score for a particular assessment."""
@@ -1343,14 +2021,14 @@ class Course(object):
         return self._model.get_activity_filename(unit_id, lesson_id)
 
     def reorder_units(self, order_data):
-        return self._model.reorder_units(order_data)
+        return self._get_editable_model().reorder_units(order_data)
 
     def set_assessment_content(self, unit, assessment_content, errors=None):
         return self._model.set_assessment_content(
             unit, assessment_content, errors)
 
     def set_activity_content(self, lesson, activity_content, errors=None):
-        return self._model.set_activity_content(
+        return self._get_editable_model().set_activity_content(
             lesson, activity_content, errors)
 
     def is_valid_assessment_id(self, assessment_id):
@@ -1379,12 +2057,12 @@ class Course(object):
         # Import 1.2 -> 1.3
         if (src_course.version == CourseModel12.VERSION and
             self.version == CourseModel13.VERSION):
-            return self._model.import_from(src_course, errors)
+            return self._get_editable_model().import_from(src_course, errors)
 
         # import 1.3 -> 1.3
         if (src_course.version == CourseModel13.VERSION and
             self.version == CourseModel13.VERSION):
-            return self._model.import_from(src_course, errors)
+            return self._get_editable_model().import_from(src_course, errors)
 
         errors.append(
             'Import of '
@@ -17,23 +17,28 @@
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 
-from counters import PerfCounter
+from counters import PerfHistogram
+from counters import PerfRateCounter
+from counters import PerfSpan
 from google.appengine.ext import db
 
 
 # datastore performance counters
-DB_QUERY = PerfCounter(
+DB_QUERY = PerfRateCounter(
     'gcb-models-db-query',
     'A number of times a query()/all() was executed on a datastore.')
-DB_GET = PerfCounter(
+DB_GET = PerfRateCounter(
     'gcb-models-db-get',
     'A number of times an object was fetched from datastore.')
-DB_PUT = PerfCounter(
+DB_PUT = PerfRateCounter(
     'gcb-models-db-put',
     'A number of times an object was put into datastore.')
-DB_DELETE = PerfCounter(
+DB_DELETE = PerfRateCounter(
     'gcb-models-db-delete',
     'A number of times an object was deleted from datastore.')
+DB_LATENCY_MS = PerfHistogram(
+    'gcb-models-db-latency-ms',
+    'A distribution of datastore get()/put()/delete() call latency (ms).')
 
 
 class BaseEntity(db.Model):
@@ -42,22 +47,42 @@ class BaseEntity(db.Model):
     @classmethod
     def all(cls, **kwds):
         DB_QUERY.inc()
-        return super(BaseEntity, cls).all(**kwds)
+        # Query runs lazily; this only records how many queries are made.
+        with PerfSpan('db.query'):
+            return super(BaseEntity, cls).all(**kwds)
 
     @classmethod
     def get(cls, keys):
         DB_GET.inc()
-        return super(BaseEntity, cls).get(keys)
+        with PerfSpan('db.get', DB_LATENCY_MS):
+            return super(BaseEntity, cls).get(keys)
 
     @classmethod
     def get_by_key_name(cls, key_names):
         DB_GET.inc()
-        return super(BaseEntity, cls).get_by_key_name(key_names)
+        with PerfSpan('db.get', DB_LATENCY_MS):
+            return super(BaseEntity, cls).get_by_key_name(key_names)
+
+    @classmethod
+    def put_multi(cls, entities):
+        """Puts a list of entities into datastore in one call."""
+        DB_PUT.inc(len(entities))
+        with PerfSpan('db.put', DB_LATENCY_MS):
+            return db.put(entities)
+
+    @classmethod
+    def delete_multi(cls, keys):
+        """Deletes a list of entities or keys from datastore in one call."""
+        DB_DELETE.inc(len(keys))
+        with PerfSpan('db.delete', DB_LATENCY_MS):
+            db.delete(keys)
 
     def put(self):
         DB_PUT.inc()
-        return super(BaseEntity, self).put()
+        with PerfSpan('db.put', DB_LATENCY_MS):
+            return super(BaseEntity, self).put()
 
     def delete(self):
         DB_DELETE.inc()
-        super(BaseEntity, self).delete()
+        with PerfSpan('db.delete', DB_LATENCY_MS):
+            super(BaseEntity, self).delete()
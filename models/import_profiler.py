@@ -0,0 +1,160 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures time spent importing modules while an instance starts up."""
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+import __builtin__
+import contextlib
+import logging
+import sys
+import time
+
+
+# max number of the slowest modules to report in the log
+MAX_MODULES_TO_LOG = 20
+
+
+class ImportProfiler(object):
+    """Records how long it takes to import each module.
+
+    While the profiler is active, the built-in __import__ is replaced with a
+    wrapper that times all imports loading new modules. For each module we
+    record the total time, which includes importing its own dependencies, and
+    the self time, which does not.
+    """
+
+    # the original built-in __import__ while the profiler is active
+    original_import = None
+
+    # a stack of time spent in the nested imports of the imports in progress
+    nested_time_stack = []
+
+    # a map of module name to a tuple of (total time, self time) in ms
+    module_times = {}
+
+    # names of the modules loaded since the profiler was last started
+    session_modules = []
+
+    @classmethod
+    def is_active(cls):
+        return cls.original_import is not None
+
+    @classmethod
+    def start(cls):
+        """Starts recording imports; does nothing if already active."""
+        if cls.is_active():
+            return
+        cls.session_modules = []
+        cls.original_import = __builtin__.__import__
+        __builtin__.__import__ = cls._import
+
+    @classmethod
+    def stop(cls):
+        """Stops recording imports."""
+        if not cls.is_active():
+            return
+        __builtin__.__import__ = cls.original_import
+        cls.original_import = None
+
+    @classmethod
+    def _import(cls, name, *args, **kwargs):
+        """Imports a module the way __import__() does; records the time."""
+        loaded_count = len(sys.modules)
+        cls.nested_time_stack.append(0)
+        start = time.time()
+        try:
+            module = cls.original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested_time = cls.nested_time_stack.pop()
+            if cls.nested_time_stack:
+                cls.nested_time_stack[-1] += elapsed
+
+        # Only the imports loading new modules are of interest.
+        if len(sys.modules) > loaded_count:
+            if name not in sys.modules:
+                # Relative imports are known to sys.modules by the full name.
+                name = getattr(module, '__name__', name)
+            cls.module_times[name] = (
+                elapsed * 1000, (elapsed - nested_time) * 1000)
+            cls.session_modules.append(name)
+        return module
+
+    @classmethod
+    def get_report(cls, names=None):
+        """Returns a list of (name, total ms, self ms), slowest first."""
+        if names is None:
+            names = cls.module_times.keys()
+        rows = [(name,) + cls.module_times[name] for name in set(names)]
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+    @classmethod
+    def log_report(cls, title):
+        """Logs import times of the modules loaded since the last start()."""
+        rows = cls.get_report(cls.session_modules)
+        total = sum([row[2] for row in rows])
+        logging.info(
+            'Imported %s modules for %s in %.1f ms; slowest (total/self ms): '
+            '%s', len(rows), title, total, ', '.join([
+                '%s %.1f/%.1f' % row for row in rows[:MAX_MODULES_TO_LOG]]))
+
+    @classmethod
+    @contextlib.contextmanager
+    def profile(cls, title):
+        """Records and logs the imports made in the scope of a with block."""
+        if cls.is_active():
+            yield
+            return
+        cls.start()
+        try:
+            yield
+        finally:
+            cls.stop()
+            cls.log_report(title)
+
+
+def test_import_profiler():
+    """Test module import times are recorded."""
+    name = 'colorsys'
+    sys.modules.pop(name, None)
+    old_import = __builtin__.__import__
+    with ImportProfiler.profile('test'):
+        assert ImportProfiler.is_active()
+        __import__(name)
+
+        times = ImportProfiler.module_times[name]
+        assert times[0] >= times[1] >= 0
+
+        # Check modules already loaded are not recorded again.
+        __import__(name)
+        assert times is ImportProfiler.module_times[name]
+
+    assert not ImportProfiler.is_active()
+    assert old_import is __builtin__.__import__
+    assert [name] == ImportProfiler.session_modules
+
+    # Check imports are not recorded after the profiler is stopped.
+    sys.modules.pop(name)
+    __import__(name)
+    assert times is ImportProfiler.module_times[name]
+
+
+def run_all_unit_tests():
+    test_import_profiler()
+
+
+if __name__ == '__main__':
+    run_all_unit_tests()
@@ -16,11 +16,20 @@
 
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
+import collections
 import logging
+import pickle
+import random
+import time
+import zlib
 import appengine_config
 from config import ConfigProperty
-from counters import PerfCounter
+import counters
+from counters import PerfHistogram
+from counters import PerfRateCounter
+from counters import PerfSpan
 from entities import BaseEntity
+from request_cache import RequestCache
 from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import db
@@ -34,6 +43,19 @@ NO_OBJECT = {}
 # The default amount of time to cache the items for in memcache.
 DEFAULT_CACHE_TTL_SECS = 60 * 5
 
+# How often an instance adds its counter deltas to the fleet-wide counters.
+FLEET_COUNTERS_FLUSH_INTERVAL_SEC = 60
+
+# Number of memcache shards of each fleet-wide counter.
+FLEET_COUNTERS_SHARDS = 8
+
+# Memcache namespace of the fleet-wide counters.
+FLEET_COUNTERS_NAMESPACE = 'gcb-fleet-counters'
+
+# How long the per-minute counts of the fleet-wide counters are kept; a count
+# is only read during the minute after the one it was counted in.
+FLEET_COUNTERS_MINUTE_TTL_SECS = 60 * 3
+
 # Global memcache controls.
 CAN_USE_MEMCACHE = ConfigProperty(
     'gcb_can_use_memcache', bool, (
@@ -43,19 +65,322 @@ CAN_USE_MEMCACHE = ConfigProperty(
         'course content instantaneously.'),
     appengine_config.PRODUCTION_MODE)
 
+# The in-process cache in front of memcache holds values of the keys starting
+# with these prefixes; these objects are read often, but rarely change.
+MEMCACHE_L1_KEY_PREFIXES = ('course:model:', 'vfs:dsbfs:', 'announcements')
+
+# The amount of time to keep the items in the in-process cache for.
+MEMCACHE_L1_TTL_SECS = 60
+
+# Max size of a single item and of all items in the in-process cache (bytes).
+MEMCACHE_L1_MAX_ITEM_BYTES = 1000 * 1000
+MEMCACHE_L1_MAX_BYTES = 32 * 1000 * 1000
+
+# Memcache key of the generation of the in-process cached items of a namespace.
+MEMCACHE_L1_GENERATION_KEY = 'memcache:l1:generation'
+
+# Max size of a value stored as a single memcache item; larger values are split
+# into parts. Some room is left for the key and the item overhead.
+MEMCACHE_MAX_VALUE_BYTES = memcache.MAX_VALUE_SIZE - 1000
+
+# Max number of parts of a value; larger values are not cached.
+MEMCACHE_MAX_VALUE_PARTS = 32
+
+# Prefixes of the memcache keys of a lease to recompute a missing item, and of
+# a copy of the item to serve while it is recomputed.
+MEMCACHE_LEASE_KEY_PREFIX = 'memcache:lease:'
+MEMCACHE_STALE_KEY_PREFIX = 'memcache:stale:'
+
+# Max time a lease to recompute a missing item is held for.
+MEMCACHE_LEASE_SECS = 10
+
+# The amount of time to keep a copy of a recomputed item for.
+MEMCACHE_STALE_TTL_SECS = 60 * 60
+
+# Max time to wait for another request to recompute an item, and how often to
+# check whether it did.
+MEMCACHE_LEASE_WAIT_SECS = 0.5
+MEMCACHE_LEASE_POLL_SECS = 0.05
+
+CAN_USE_MEMCACHE_L1 = ConfigProperty(
+    'gcb_can_use_memcache_l1', bool, (
+        'Whether or not to also cache course models, course files and '
+        'announcements in the memory of each instance. This saves a memcache '
+        'call for each of these objects, but adds one call per request to '
+        'check whether any of them changed. Only used if memcache is '
+        'enabled.'),
+    False)
+
 # performance counters
-CACHE_PUT = PerfCounter(
+CACHE_PUT = PerfRateCounter(
     'gcb-models-cache-put',
     'A number of times an object was put into memcache.')
-CACHE_HIT = PerfCounter(
+CACHE_HIT = PerfRateCounter(
     'gcb-models-cache-hit',
     'A number of times an object was found in memcache.')
-CACHE_MISS = PerfCounter(
+CACHE_MISS = PerfRateCounter(
     'gcb-models-cache-miss',
     'A number of times an object was not found in memcache.')
-CACHE_DELETE = PerfCounter(
+CACHE_DELETE = PerfRateCounter(
     'gcb-models-cache-delete',
     'A number of times an object was deleted from memcache.')
+CACHE_LATENCY_MS = PerfHistogram(
+    'gcb-models-cache-latency-ms',
+    'A distribution of memcache call latency (ms).')
+CACHE_RECOMPUTE = PerfRateCounter(
+    'gcb-models-cache-recompute',
+    'A number of times a missing object was recomputed and put into memcache.')
+CACHE_STALE_HIT = PerfRateCounter(
+    'gcb-models-cache-stale-hit',
+    'A number of times a previous version of an object was used while another '
+    'request was recomputing it.')
+CACHE_LEASE_WAIT = PerfRateCounter(
+    'gcb-models-cache-lease-wait',
+    'A number of times a request waited for another request to recompute a '
+    'missing object.')
+CACHE_L1_HIT = PerfRateCounter(
+    'gcb-models-cache-l1-hit',
+    'A number of times an object was found in the in-process cache.')
+CACHE_L1_MISS = PerfRateCounter(
+    'gcb-models-cache-l1-miss',
+    'A number of times an object was not found in the in-process cache.')
+CACHE_L1_EVICT = PerfRateCounter(
+    'gcb-models-cache-l1-evict',
+    'A number of objects evicted from the in-process cache to free memory.')
+
+
+class MemcacheL1Cache(object):
+    """An in-process cache of memcache items kept coherent with memcache.
+
+    Items are kept pickled, so each lookup returns a new copy of the value,
+    just like memcache does, and so their size is known. Items expire after
+    MEMCACHE_L1_TTL_SECS. If all items of all namespaces take more than
+    MEMCACHE_L1_MAX_BYTES, the least recently used ones are evicted.
+
+    Each namespace has a generation number stored in memcache. It is
+    incremented by any instance that sets or deletes a cacheable key in that
+    namespace. An item is used only if it was cached under the current
+    generation, which is read from memcache at most once per request.
+    """
+
+    # A map of (namespace, key) to a tuple of (expiry time, generation, pickled
+    # value). Most recently used items are at the end.
+    items = collections.OrderedDict()
+
+    # Total size of the pickled values of all items.
+    size_bytes = 0
+
+    @classmethod
+    def can_cache(cls, key):
+        return (
+            CAN_USE_MEMCACHE_L1.value and isinstance(key, basestring) and
+            key.startswith(MEMCACHE_L1_KEY_PREFIXES))
+
+    @classmethod
+    def get_generation(cls, namespace):
+        """Returns the current generation of the items of a namespace."""
+        return RequestCache.get(
+            ('memcache_l1_generation', namespace),
+            lambda: cls._load_generation(namespace))
+
+    @classmethod
+    def _load_generation(cls, namespace):
+        with PerfSpan('memcache.get', CACHE_LATENCY_MS):
+            generation = memcache.get(
+                MEMCACHE_L1_GENERATION_KEY, namespace=namespace)
+        if generation is None:
+            # The generation was evicted; start a new one no item was cached
+            # under.
+            generation = long(time.time() * 1000)
+            with PerfSpan('memcache.add', CACHE_LATENCY_MS):
+                memcache.add(
+                    MEMCACHE_L1_GENERATION_KEY, generation,
+                    namespace=namespace)
+        return generation
+
+    @classmethod
+    def _remove(cls, item_key):
+        item = cls.items.pop(item_key, None)
+        if item:
+            cls.size_bytes -= len(item[2])
+        return item
+
+    @classmethod
+    def get(cls, key, namespace, generation):
+        """Returns a cached value or None if the value is not cached."""
+        item = cls._remove((namespace, key))
+        if not item or item[0] < time.time() or item[1] != generation:
+            CACHE_L1_MISS.inc()
+            return None
+        cls.items[(namespace, key)] = item
+        cls.size_bytes += len(item[2])
+        CACHE_L1_HIT.inc()
+        return pickle.loads(item[2])
+
+    @classmethod
+    def put(cls, key, value, namespace, generation):
+        """Caches a value read from memcache under the given generation.
+
+        Args:
+            key: A memcache key.
+            value: A value of the key read from memcache.
+            namespace: A memcache namespace of the key.
+            generation: The generation of the namespace read before the value
+                was read.
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        cls._remove((namespace, key))
+        if len(data) > MEMCACHE_L1_MAX_ITEM_BYTES:
+            return
+        cls.items[(namespace, key)] = (
+            time.time() + MEMCACHE_L1_TTL_SECS, generation, data)
+        cls.size_bytes += len(data)
+        while cls.size_bytes > MEMCACHE_L1_MAX_BYTES:
+            cls.size_bytes -= len(cls.items.popitem(last=False)[1][2])
+            CACHE_L1_EVICT.inc()
+
+    @classmethod
+    def invalidate(cls, keys, namespace):
+        """Removes keys here and makes other instances drop their items."""
+        for key in keys:
+            cls._remove((namespace, key))
+        with PerfSpan('memcache.incr', CACHE_LATENCY_MS):
+            memcache.incr(
+                MEMCACHE_L1_GENERATION_KEY, namespace=namespace,
+                initial_value=long(time.time() * 1000))
+
+    @classmethod
+    def clear(cls):
+        cls.items.clear()
+        cls.size_bytes = 0
+
+
+class PickledValue(object):
+    """A value already pickled, so memcache doesn't have to pickle it again.
+
+    Memcache pickles the wrapper by copying the pickled bytes; unpickling the
+    wrapper returns the original value, so the readers never see it.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce__(self):
+        return (pickle.loads, (self.data,))
+
+
+class ChunkedValue(object):
+    """A header of a value too large to be stored as a single memcache item.
+
+    The pickled value is split into parts stored under their own keys next to
+    the header. Keys of the parts are unique to each version of the value, so
+    parts of different versions are never mixed up. If any of the parts was
+    evicted, or the parts don't match the checksum, the value is missing.
+    """
+
+    def __init__(self, part_keys, checksum):
+        self.part_keys = part_keys
+        self.checksum = checksum
+
+    @classmethod
+    def encode(cls, key, value):
+        """Makes memcache items to store a value under a key.
+
+        Args:
+            key: A memcache key of the value.
+            value: A value to store.
+
+        Returns:
+            A dictionary of memcache keys and values to store, which is empty
+            if the value is too large to be stored even in parts.
+        """
+        if isinstance(value, str) and len(value) <= MEMCACHE_MAX_VALUE_BYTES:
+            return {key: value}
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) <= MEMCACHE_MAX_VALUE_BYTES:
+            return {key: PickledValue(data)}
+
+        part_size = MEMCACHE_MAX_VALUE_BYTES
+        part_count = (len(data) + part_size - 1) // part_size
+        if part_count > MEMCACHE_MAX_VALUE_PARTS:
+            logging.warning(
+                'Value is too large for memcache (%s bytes), key: %s.',
+                len(data), key)
+            return {}
+
+        version = '%x' % random.getrandbits(64)
+        items = {}
+        part_keys = []
+        for index in xrange(part_count):
+            part_key = '%s:part:%s:%s' % (key, version, index)
+            part_keys.append(part_key)
+            items[part_key] = data[index * part_size:(index + 1) * part_size]
+        items[key] = ChunkedValue(part_keys, zlib.crc32(data))
+        return items
+
+    def decode(self, parts):
+        """Makes a value from a dictionary of part keys and parts."""
+        if len(parts) != len(self.part_keys):
+            return None
+        data = ''.join([parts[key] for key in self.part_keys])
+        if zlib.crc32(data) != self.checksum:
+            logging.error('Value parts do not match the checksum.')
+            return None
+        return pickle.loads(data)
+
+
+class MemcacheRpc(object):
+    """An asynchronous memcache operation started by MemcacheManager.
+
+    The result is post-processed (counted, cached in process, etc.) when
+    get_result() is first called. The operations not yet completed by the end
+    of the request are completed by wait_all().
+    """
+
+    # Operations started while handling a request, but not yet completed.
+    pending = []
+
+    def __init__(self, result, span_name=None, rpc=None, on_result=None):
+        """Creates a new operation.
+
+        Args:
+            result: The result of the operation if there is no rpc to wait for.
+            span_name: A name of the span to record the wait for the rpc under.
+            rpc: An asynchronous memcache call or None.
+            on_result: A function to call with the result of the rpc; returns
+                the result of the operation.
+        """
+        self._result = result
+        self._span_name = span_name
+        self._rpc = rpc
+        self._on_result = on_result
+        self._is_pending = bool(rpc) and RequestCache.is_active()
+        if self._is_pending:
+            self.pending.append(self)
+
+    def get_result(self):
+        """Waits for the operation to complete and returns its result."""
+        if self._rpc:
+            rpc = self._rpc
+            self._rpc = None
+            if self._is_pending:
+                self._is_pending = False
+                self.pending.remove(self)
+            with PerfSpan(self._span_name, CACHE_LATENCY_MS):
+                result = rpc.get_result()
+            if self._on_result:
+                result = self._on_result(result)
+            self._result = result
+        return self._result
+
+    @classmethod
+    def wait_all(cls):
+        """Completes all the operations that were not yet completed."""
+        for rpc in list(cls.pending):
+            try:
+                rpc.get_result()
+            except Exception as e:  # pylint: disable-msg=broad-except
+                logging.error('Failed to complete memcache call: %s', e)
 
 
 class MemcacheManager(object):
@@ -68,26 +393,289 @@ class MemcacheManager(object):
             return None
         if not namespace:
             namespace = appengine_config.DEFAULT_NAMESPACE_NAME
-        value = memcache.get(key, namespace=namespace)
+
+        # The generation must be read before the value it is cached under.
+        generation = None
+        if MemcacheL1Cache.can_cache(key):
+            generation = MemcacheL1Cache.get_generation(namespace)
+            value = MemcacheL1Cache.get(key, namespace, generation)
+            if value is not None:
+                return value
+
+        with PerfSpan('memcache.get', CACHE_LATENCY_MS):
+            value = memcache.get(key, namespace=namespace)
+        if isinstance(value, ChunkedValue):
+            value = cls._get_parts([value], namespace)[0]
 
         # We store some objects in memcache that don't evaluate to True, but are
         # real objects, '{}' for example. Count a cache miss only in a case when
         # an object is None.
         if value != None:  # pylint: disable-msg=g-equals-none
             CACHE_HIT.inc()
+            if generation is not None:
+                MemcacheL1Cache.put(key, value, namespace, generation)
         else:
             logging.info('Cache miss, key: %s. %s', key, Exception())
             CACHE_MISS.inc(context=key)
         return value
 
     @classmethod
-    def set(cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None):
-        """Sets an item in memcache if memcache is enabled."""
+    def _get_parts(cls, headers, namespace):
+        """Reads the parts of all values with one call; decodes the values."""
+        keys = []
+        for header in headers:
+            keys += header.part_keys
+        with PerfSpan('memcache.get_multi', CACHE_LATENCY_MS):
+            parts = memcache.get_multi(keys, namespace=namespace)
+        values = []
+        for header in headers:
+            values.append(header.decode(dict([
+                (key, parts[key]) for key in header.part_keys
+                if key in parts])))
+        return values
+
+    @classmethod
+    def get_or_compute(
+        cls, key, compute, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None):
+        """Gets an item from memcache; recomputes the item if it is missing.
+
+        Of all the requests missing the item at the same time only one, the one
+        that acquires a short lease on the key, recomputes it. The others get a
+        copy of the previous value of the item, if there is one. Otherwise they
+        wait briefly for the new value to appear and recompute the item
+        themselves only if it does not.
+
+        Args:
+            key: A memcache key.
+            compute: A function returning a new value of the item. A value of
+                None is returned, but not cached.
+            ttl: The amount of time to cache the new value for.
+            namespace: A memcache namespace to use.
+
+        Returns:
+            The value of the item.
+        """
+        return cls.get_or_compute_with_staleness(
+            key, compute, ttl=ttl, namespace=namespace)[0]
+
+    @classmethod
+    def get_or_compute_with_staleness(
+        cls, key, compute, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None):
+        """Same as get_or_compute(), but also tells if the value is stale.
+
+        Returns:
+            A tuple of the value and whether it is a copy of the previous value
+            of the item, which is served while another request recomputes it.
+        """
+        value = cls.get(key, namespace=namespace)
+        if value is not None:
+            return value, False
+        if not CAN_USE_MEMCACHE.value:
+            return compute(), False
+        if not namespace:
+            namespace = appengine_config.DEFAULT_NAMESPACE_NAME
+
+        lease_key = MEMCACHE_LEASE_KEY_PREFIX + key
+        stale_key = MEMCACHE_STALE_KEY_PREFIX + key
+        with PerfSpan('memcache.add', CACHE_LATENCY_MS):
+            has_lease = memcache.add(
+                lease_key, True, time=MEMCACHE_LEASE_SECS, namespace=namespace)
+        if not has_lease:
+            with PerfSpan('memcache.get', CACHE_LATENCY_MS):
+                value = memcache.get(stale_key, namespace=namespace)
+            if isinstance(value, ChunkedValue):
+                value = cls._get_parts([value], namespace)[0]
+            if value is not None:
+                CACHE_STALE_HIT.inc()
+                return value, True
+
+            CACHE_LEASE_WAIT.inc()
+            deadline = time.time() + MEMCACHE_LEASE_WAIT_SECS
+            while time.time() < deadline:
+                time.sleep(MEMCACHE_LEASE_POLL_SECS)
+                value = cls.get(key, namespace=namespace)
+                if value is not None:
+                    return value, False
+
+        CACHE_RECOMPUTE.inc()
+        try:
+            value = compute()
+            if value is not None:
+                cls.set_with_staleness(
+                    key, value, ttl=ttl, namespace=namespace,
+                    invalidate=False)
+            return value, False
+        finally:
+            if has_lease:
+                with PerfSpan('memcache.delete', CACHE_LATENCY_MS):
+                    memcache.delete(lease_key, namespace=namespace)
+
+    @classmethod
+    def set_with_staleness(
+        cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None,
+        invalidate=True):
+        """Sets an item read by get_or_compute() and its stale copy.
+
+        The stale copy outlives the item and is served while the item is
+        recomputed, so it has to be replaced whenever the item is written.
+        See set() for the meaning of the arguments.
+        """
+        if not CAN_USE_MEMCACHE.value:
+            return
+        rpcs = [
+            cls.set_multi_async(
+                {key: value}, ttl=ttl, namespace=namespace,
+                invalidate=invalidate),
+            cls.set_multi_async(
+                {MEMCACHE_STALE_KEY_PREFIX + key: value},
+                ttl=MEMCACHE_STALE_TTL_SECS, namespace=namespace,
+                invalidate=False)]
+        for rpc in rpcs:
+            rpc.get_result()
+
+    @classmethod
+    def get_multi(cls, keys, namespace=None):
+        """Gets a set of items from memcache if memcache is enabled.
+
+        Args:
+            keys: A list of keys to look up.
+            namespace: A memcache namespace to use.
+
+        Returns:
+            A dictionary of the keys and values that were found in memcache.
+        """
+        return cls.get_multi_async(keys, namespace=namespace).get_result()
+
+    @classmethod
+    def get_multi_async(cls, keys, namespace=None):
+        """Starts getting a set of items; see get_multi() for details.
+
+        Args:
+            keys: A list of keys to look up.
+            namespace: A memcache namespace to use.
+
+        Returns:
+            A MemcacheRpc; its get_result() returns a dictionary of the keys
+            and values that were found in memcache.
+        """
+        if not CAN_USE_MEMCACHE.value:
+            return MemcacheRpc({})
+        if not namespace:
+            namespace = appengine_config.DEFAULT_NAMESPACE_NAME
+
+        values = {}
+        generation = None
+        for key in keys:
+            if MemcacheL1Cache.can_cache(key):
+                if generation is None:
+                    generation = MemcacheL1Cache.get_generation(namespace)
+                value = MemcacheL1Cache.get(key, namespace, generation)
+                if value is not None:
+                    values[key] = value
+        keys = [key for key in keys if key not in values]
+        if not keys:
+            return MemcacheRpc(values)
+
+        def on_result(found):
+            headers = [
+                (key, value) for key, value in found.iteritems()
+                if isinstance(value, ChunkedValue)]
+            if headers:
+                decoded = cls._get_parts(
+                    [value for _, value in headers], namespace)
+                for (key, _), value in zip(headers, decoded):
+                    if value is None:
+                        del found[key]
+                    else:
+                        found[key] = value
+
+            CACHE_HIT.inc(len(found))
+            CACHE_MISS.inc(len(keys) - len(found))
+            if generation is not None:
+                for key, value in found.iteritems():
+                    if MemcacheL1Cache.can_cache(key):
+                        MemcacheL1Cache.put(key, value, namespace, generation)
+            values.update(found)
+            return values
+
+        return MemcacheRpc(
+            values, 'memcache.get_multi',
+            memcache.Client().get_multi_async(keys, namespace=namespace),
+            on_result)
+
+    @classmethod
+    def set(
+        cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None,
+        invalidate=True):
+        """Sets an item in memcache if memcache is enabled.
+
+        Args:
+            key: A memcache key.
+            value: A value to set.
+            ttl: The amount of time to cache the value for.
+            namespace: A memcache namespace to use.
+            invalidate: Whether the value changed, so other instances must
+                drop their in-process copies of the item. Pass False when the
+                item was missing and is filled in with a value just read from
+                its source.
+        """
         if CAN_USE_MEMCACHE.value:
             CACHE_PUT.inc()
             if not namespace:
                 namespace = appengine_config.DEFAULT_NAMESPACE_NAME
-            memcache.set(key, value, ttl, namespace=namespace)
+            items = ChunkedValue.encode(key, value)
+            if len(items) == 1:
+                with PerfSpan('memcache.set', CACHE_LATENCY_MS):
+                    memcache.set(key, items[key], ttl, namespace=namespace)
+            elif items:
+                with PerfSpan('memcache.set_multi', CACHE_LATENCY_MS):
+                    memcache.set_multi(items, time=ttl, namespace=namespace)
+            else:
+                # Don't leave the previous value behind.
+                with PerfSpan('memcache.delete', CACHE_LATENCY_MS):
+                    memcache.delete(key, namespace=namespace)
+            if invalidate and MemcacheL1Cache.can_cache(key):
+                MemcacheL1Cache.invalidate([key], namespace)
+
+    @classmethod
+    def set_multi(
+        cls, mapping, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None,
+        invalidate=True):
+        """Sets a dictionary of items in memcache if memcache is enabled."""
+        cls.set_multi_async(
+            mapping, ttl=ttl, namespace=namespace,
+            invalidate=invalidate).get_result()
+
+    @classmethod
+    def set_multi_async(
+        cls, mapping, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None,
+        invalidate=True):
+        """Starts setting a dictionary of items; returns a MemcacheRpc.
+
+        See set() for the meaning of the arguments.
+        """
+        if not CAN_USE_MEMCACHE.value or not mapping:
+            return MemcacheRpc(None)
+        CACHE_PUT.inc(len(mapping))
+        if not namespace:
+            namespace = appengine_config.DEFAULT_NAMESPACE_NAME
+        items = {}
+        too_large = []
+        for key, value in mapping.iteritems():
+            encoded = ChunkedValue.encode(key, value)
+            if not encoded:
+                too_large.append(key)
+            items.update(encoded)
+        if too_large:
+            # Don't leave the previous values behind.
+            with PerfSpan('memcache.delete_multi', CACHE_LATENCY_MS):
+                memcache.delete_multi(too_large, namespace=namespace)
+        return MemcacheRpc(
+            None, 'memcache.set_multi',
+            memcache.Client().set_multi_async(
+                items, time=ttl, namespace=namespace),
+            cls._make_invalidate_l1(
+                mapping.keys() if invalidate else [], namespace))
 
     @classmethod
     def delete(cls, key, namespace=None):
@@ -96,7 +684,184 @@ class MemcacheManager(object):
             CACHE_DELETE.inc()
             if not namespace:
                 namespace = appengine_config.DEFAULT_NAMESPACE_NAME
-            memcache.delete(key, namespace=namespace)
+            with PerfSpan('memcache.delete', CACHE_LATENCY_MS):
+                memcache.delete(key, namespace=namespace)
+            if MemcacheL1Cache.can_cache(key):
+                MemcacheL1Cache.invalidate([key], namespace)
+
+    @classmethod
+    def delete_multi(cls, keys, namespace=None):
+        """Deletes a set of items from memcache if memcache is enabled."""
+        cls.delete_multi_async(keys, namespace=namespace).get_result()
+
+    @classmethod
+    def delete_multi_async(cls, keys, namespace=None):
+        """Starts deleting a set of items; returns a MemcacheRpc."""
+        if not CAN_USE_MEMCACHE.value or not keys:
+            return MemcacheRpc(None)
+        CACHE_DELETE.inc(len(keys))
+        if not namespace:
+            namespace = appengine_config.DEFAULT_NAMESPACE_NAME
+        return MemcacheRpc(
+            None, 'memcache.delete_multi',
+            memcache.Client().delete_multi_async(keys, namespace=namespace),
+            cls._make_invalidate_l1(keys, namespace))
+
+    @classmethod
+    def _make_invalidate_l1(cls, keys, namespace):
+        """Makes a callback invalidating in-process items once keys changed."""
+        keys = [key for key in keys if MemcacheL1Cache.can_cache(key)]
+
+        def on_result(unused_result):
+            if keys:
+                MemcacheL1Cache.invalidate(keys, namespace)
+            return None
+
+        return on_result
+
+
+class FleetCounters(object):
+    """Aggregates in-process performance counters of all the instances.
+
+    Every FLEET_COUNTERS_FLUSH_INTERVAL_SEC each instance adds the increase of
+    its counters since the previous flush to memcache. Each instance writes to
+    one of FLEET_COUNTERS_SHARDS shards, so instances rarely contend for the
+    same key. The increase is added both to the total and to the count of the
+    current minute, which gives the fleet-wide rate; the minute counts expire
+    after FLEET_COUNTERS_MINUTE_TTL_SECS. The flush is made after the request
+    was handled. An increase is only taken as flushed once memcache confirmed
+    it was added to the total; otherwise it is added by the next flush.
+    Memcache may evict the values, so the totals are a lower bound.
+    """
+
+    last_flush_time = time.time()
+
+    # A map of counter name to its value at the time of the last flush.
+    flushed_values = {}
+
+    # A shard this instance writes to.
+    shard = random.randrange(FLEET_COUNTERS_SHARDS)
+
+    @classmethod
+    def _make_key(cls, name, shard, minute=None):
+        if minute is None:
+            return 'fleet:%s:%s' % (name, shard)
+        return 'fleet:%s:%s:%s' % (name, minute, shard)
+
+    @classmethod
+    def flush_if_due(cls, now=None):
+        """Flushes counter deltas if enough time passed since the last flush."""
+        if now is None:
+            now = time.time()
+        if now - cls.last_flush_time < FLEET_COUNTERS_FLUSH_INTERVAL_SEC:
+            return None
+        return cls.flush(now=now)
+
+    @classmethod
+    def flush(cls, now=None):
+        """Adds counter deltas to the fleet-wide counters in memcache.
+
+        Args:
+            now: Current time in seconds since epoch.
+
+        Returns:
+            A MemcacheRpc, which has to be completed for the flushed increases
+            to be recorded, or None if there was nothing to flush.
+        """
+        if now is None:
+            now = time.time()
+        cls.last_flush_time = now
+        if not CAN_USE_MEMCACHE.value:
+            return None
+
+        minute = int(now / 60)
+        values = {}
+        total_deltas = {}
+        minute_deltas = {}
+        for name, counter in counters.Registry.registered.items():
+            value = counter.value
+            delta = value - cls.flushed_values.get(name, 0)
+            if delta > 0:
+                values[name] = value
+                total_deltas[cls._make_key(name, cls.shard)] = delta
+                minute_deltas[
+                    cls._make_key(name, cls.shard, minute=minute)] = delta
+            else:
+                cls.flushed_values[name] = value
+        if not values:
+            return None
+
+        CACHE_PUT.inc(len(total_deltas) + len(minute_deltas))
+        client = memcache.Client()
+
+        # The missing minute counts are not created by the offset, but added
+        # below, so that they expire.
+        minute_rpc = client.offset_multi_async(
+            minute_deltas, namespace=FLEET_COUNTERS_NAMESPACE)
+
+        def on_result(results):
+            for name, value in values.iteritems():
+                if results.get(cls._make_key(name, cls.shard)) is not None:
+                    cls.flushed_values[name] = value
+
+            minute_results = minute_rpc.get_result()
+            missing = dict([
+                (key, delta) for key, delta in minute_deltas.iteritems()
+                if minute_results.get(key) is None])
+            if missing:
+                not_added = client.add_multi(
+                    missing, time=FLEET_COUNTERS_MINUTE_TTL_SECS,
+                    namespace=FLEET_COUNTERS_NAMESPACE)
+                if not_added:
+                    # Another instance added them meanwhile.
+                    client.offset_multi(
+                        dict([(key, missing[key]) for key in not_added]),
+                        namespace=FLEET_COUNTERS_NAMESPACE)
+            return results
+
+        return MemcacheRpc(
+            None, 'memcache.offset_multi', client.offset_multi_async(
+                total_deltas, initial_value=0,
+                namespace=FLEET_COUNTERS_NAMESPACE),
+            on_result)
+
+    @classmethod
+    def get_totals_and_rates(cls, names, now=None):
+        """Reads fleet-wide counters.
+
+        Args:
+            names: A list of counter names to read.
+            now: Current time in seconds since epoch.
+
+        Returns:
+            A map of counter name to a tuple of its fleet-wide total and its
+            average rate per second during the last complete minute.
+        """
+        if not CAN_USE_MEMCACHE.value:
+            return {}
+        if now is None:
+            now = time.time()
+        minute = int(now / 60) - 1
+
+        keys = []
+        for name in names:
+            for shard in xrange(FLEET_COUNTERS_SHARDS):
+                keys.append(cls._make_key(name, shard))
+                keys.append(cls._make_key(name, shard, minute=minute))
+        with PerfSpan('memcache.get_multi', CACHE_LATENCY_MS):
+            values = memcache.get_multi(
+                keys, namespace=FLEET_COUNTERS_NAMESPACE)
+
+        results = {}
+        for name in names:
+            total = 0
+            last_minute = 0
+            for shard in xrange(FLEET_COUNTERS_SHARDS):
+                total += long(values.get(cls._make_key(name, shard), 0))
+                last_minute += long(values.get(
+                    cls._make_key(name, shard, minute=minute), 0))
+            results[name] = (total, last_minute / 60.0)
+        return results
 
 
 class Student(BaseEntity):
@@ -114,33 +879,50 @@ class Student(BaseEntity):
         """Makes a memcache key from primary key."""
         return 'entity:student:%s' % key
 
+    @classmethod
+    def _request_cache_key(cls, key):
+        """Makes a request cache key from primary key."""
+        return ('student', key)
+
     def put(self):
         """Do the normal put() and also add the object to memcache."""
         result = super(Student, self).put()
         MemcacheManager.set(self._memcache_key(self.key().name()), self)
+        RequestCache.set(self._request_cache_key(self.key().name()), self)
         return result
 
     def delete(self):
         """Do the normal delete() and also remove the object from memcache."""
         super(Student, self).delete()
         MemcacheManager.delete(self._memcache_key(self.key().name()))
+        RequestCache.set(self._request_cache_key(self.key().name()), None)
 
     @classmethod
     def get_by_email(cls, email):
         return Student.get_by_key_name(email.encode('utf8'))
 
     @classmethod
-    def get_enrolled_student_by_email(cls, email):
-        """Returns enrolled student or None."""
+    def _get_cached_by_email(cls, email):
+        """Returns student, enrolled or not, or None; uses memcache."""
         student = MemcacheManager.get(cls._memcache_key(email))
         if NO_OBJECT == student:
             return None
         if not student:
             student = Student.get_by_email(email)
             if student:
-                MemcacheManager.set(cls._memcache_key(email), student)
+                MemcacheManager.set(
+                    cls._memcache_key(email), student, invalidate=False)
             else:
-                MemcacheManager.set(cls._memcache_key(email), NO_OBJECT)
+                MemcacheManager.set(
+                    cls._memcache_key(email), NO_OBJECT, invalidate=False)
+        return student
+
+    @classmethod
+    def get_enrolled_student_by_email(cls, email):
+        """Returns enrolled student or None."""
+        student = RequestCache.get(
+            cls._request_cache_key(email),
+            lambda: cls._get_cached_by_email(email))
         if student and student.is_enrolled:
             return student
         else:
@@ -227,28 +1009,43 @@ class StudentPropertyEntity(BaseEntity):
             key_name=cls.create_key(student.user_id, property_name),
             name=property_name)
 
+    @classmethod
+    def _request_cache_key(cls, key):
+        """Makes a request cache key from primary key."""
+        return ('student_property', key)
+
     def put(self):
         """Do the normal put() and also add the object to memcache."""
         result = super(StudentPropertyEntity, self).put()
         MemcacheManager.set(self._memcache_key(self.key().name()), self)
+        RequestCache.set(self._request_cache_key(self.key().name()), self)
         return result
 
     def delete(self):
         """Do the normal delete() and also remove the object from memcache."""
         super(Student, self).delete()
         MemcacheManager.delete(self._memcache_key(self.key().name()))
+        RequestCache.set(self._request_cache_key(self.key().name()), None)
 
     @classmethod
     def get(cls, student, property_name):
         """Loads student property."""
         key = cls.create_key(student.user_id, property_name)
+        return RequestCache.get(
+            cls._request_cache_key(key), lambda: cls._get_cached(key))
+
+    @classmethod
+    def _get_cached(cls, key):
+        """Loads student property by its primary key; uses memcache."""
         value = MemcacheManager.get(cls._memcache_key(key))
         if NO_OBJECT == value:
             return None
         if not value:
             value = cls.get_by_key_name(key)
             if value:
-                MemcacheManager.set(cls._memcache_key(key), value)
+                MemcacheManager.set(
+                    cls._memcache_key(key), value, invalidate=False)
             else:
-                MemcacheManager.set(cls._memcache_key(key), NO_OBJECT)
+                MemcacheManager.set(
+                    cls._memcache_key(key), NO_OBJECT, invalidate=False)
         return value
@@ -20,13 +20,76 @@ import datetime
 import os
 
 from tools import verify
+from counters import PerfCounter
+from counters import PerfSpan
 from models import StudentPropertyEntity
 
 import transforms
 
 
+# performance counters
+PROGRESS_PARSE = PerfCounter(
+    'gcb-progress-parse',
+    'A number of times a student progress value was decoded from JSON.')
+
+
+class ProgressView(object):
+    """A student progress entity with its JSON value decoded once.
+
+    The value is decoded on first access. Changes are made to the decoded dict
+    and are encoded back into the entity only once, when it is put.
+    """
+
+    def __init__(self, entity):
+        self._entity = entity
+        self._values = None
+        self._dirty_keys = set()
+
+    @property
+    def entity(self):
+        return self._entity
+
+    def _get_values(self):
+        if self._values is None:
+            self._values = {}
+            if self._entity.value:
+                PROGRESS_PARSE.inc()
+                with PerfSpan('progress.parse'):
+                    self._values = transforms.loads(self._entity.value)
+        return self._values
+
+    def get(self, key):
+        return self._get_values().get(key)
+
+    def set(self, key, value):
+        self._get_values()[key] = value
+        self._dirty_keys.add(key)
+
+    def inc(self, key, value=1):
+        values = self._get_values()
+        values[key] = values.get(key, 0) + value
+        self._dirty_keys.add(key)
+
+    def is_dirty(self):
+        return bool(self._dirty_keys)
+
+    def put(self):
+        """Encodes changed values into the entity and puts it."""
+        if self._dirty_keys:
+            self._entity.value = transforms.dumps(self._values)
+            self._dirty_keys = set()
+        self._entity.updated_on = datetime.datetime.now()
+        self._entity.put()
+
+
 class UnitLessonCompletionTracker(object):
-    """Tracks student completion for a unit/lesson-based linear course."""
+    """Tracks student completion for a unit/lesson-based linear course.
+
+    The methods taking a 'progress' argument expect a ProgressView of the
+    student progress entity, such as the one returned by get_progress_view().
+    The status getters also accept the entity itself, but then decode it on
+    every call.
+    """
 
     PROPERTY_KEY = 'linear-course-completion'
 
@@ -118,18 +181,21 @@ class UnitLessonCompletionTracker(object):
     def _get_assessment_key(self, assessment_id):
         return '%s.%s' % (self.EVENT_CODE_MAPPING['assessment'], assessment_id)
 
-    def get_valid_block_ids(self, unit_id, lesson_id):
-        """Returns a list of block ids representing interactive activities."""
-        valid_block_ids = []
+    @classmethod
+    def get_activity_block_ids(cls, activity):
+        """Returns ids of the interactive blocks of an activity."""
+        return [block_id for block_id, block in enumerate(activity['activity'])
+                if isinstance(block, dict)]
 
-        # Get the activity corresponding to this unit/lesson combination.
-        activity = self.get_activity_as_python(unit_id, lesson_id)
-        for block_id in range(len(activity['activity'])):
-            block = activity['activity'][block_id]
-            if isinstance(block, dict):
-                valid_block_ids.append(block_id)
+    def get_valid_block_ids(self, unit_id, lesson_id):
+        """Returns a list of block ids representing interactive activities.
 
-        return valid_block_ids
+        The activity is parsed only if it changed since the ids were last
+        computed; the course keeps them with its model.
+        """
+        return self._get_course().get_activity_block_ids(
+            unit_id, lesson_id, lambda: self.get_activity_block_ids(
+                self.get_activity_as_python(unit_id, lesson_id)))
 
     def _update_unit(self, progress, event_key):
         """Updates a unit's progress if all its lessons have been completed."""
@@ -279,11 +345,8 @@ class UnitLessonCompletionTracker(object):
         if event_entity not in self.EVENT_CODE_MAPPING:
             return
 
-        progress = self.get_or_create_progress(student)
-
+        progress = self.get_progress_view(student)
         self._update_event(student, progress, event_entity, event_key, True)
-
-        progress.updated_on = datetime.datetime.now()
         progress.put()
 
     def _update_event(self, student, progress, event_entity, event_key,
@@ -292,7 +355,7 @@ class UnitLessonCompletionTracker(object):
 
         Args:
           student: the student
-          progress: the StudentProgressEntity for the student
+          progress: the ProgressView of the student progress
           event_entity: the name of the affected entity (unit, video, etc.)
           event_key: the key for the recorded event
           direct_update: True if this event is being updated explicitly; False
@@ -365,10 +428,14 @@ class UnitLessonCompletionTracker(object):
             progress.put()
         return progress
 
+    @classmethod
+    def get_progress_view(cls, student):
+        return ProgressView(cls.get_or_create_progress(student))
+
     def get_unit_progress(self, student):
         """Returns a dict with the states of each unit."""
         units = self._get_course().get_units()
-        progress = self.get_or_create_progress(student)
+        progress = self.get_progress_view(student)
 
         result = {}
         for unit in units:
@@ -386,7 +453,7 @@ class UnitLessonCompletionTracker(object):
     def get_lesson_progress(self, student, unit_id):
         """Returns a dict saying which lessons in this unit are completed."""
         lessons = self._get_course().get_lessons(unit_id)
-        progress = self.get_or_create_progress(student)
+        progress = self.get_progress_view(student)
 
         result = {}
         for lesson in lessons:
@@ -398,47 +465,32 @@ class UnitLessonCompletionTracker(object):
         return result
 
     def _get_entity_value(self, progress, event_key):
-        if not progress.value:
-            return None
-        return transforms.loads(progress.value).get(event_key)
+        if not isinstance(progress, ProgressView):
+            progress = ProgressView(progress)
+        return progress.get(event_key)
 
-    def _set_entity_value(self, student_property, key, value):
+    def _set_entity_value(self, progress, key, value):
         """Sets the integer value of a student property.
 
         Note: this method does not commit the change. The calling method should
-        call put() on the StudentPropertyEntity.
+        call put() on the ProgressView.
 
         Args:
-          student_property: the StudentPropertyEntity
-          key: the student property whose value should be incremented
-          value: the value to increment this property by
+          progress: the ProgressView of the student progress
+          key: the student property whose value should be set
+          value: the value to set this property to
         """
-        try:
-            progress_dict = transforms.loads(student_property.value)
-        except (AttributeError, TypeError):
-            progress_dict = {}
+        progress.set(key, value)
 
-        progress_dict[key] = value
-        student_property.value = transforms.dumps(progress_dict)
-
-    def _inc(self, student_property, key, value=1):
+    def _inc(self, progress, key, value=1):
         """Increments the integer value of a student property.
 
         Note: this method does not commit the change. The calling method should
-        call put() on the StudentPropertyEntity.
+        call put() on the ProgressView.
 
         Args:
-          student_property: the StudentPropertyEntity
+          progress: the ProgressView of the student progress
           key: the student property whose value should be incremented
           value: the value to increment this property by
         """
-        try:
-            progress_dict = transforms.loads(student_property.value)
-        except (AttributeError, TypeError):
-            progress_dict = {}
-
-        if key not in progress_dict:
-            progress_dict[key] = 0
-
-        progress_dict[key] += value
-        student_property.value = transforms.dumps(progress_dict)
+        progress.inc(key, value=value)
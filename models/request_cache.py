@@ -0,0 +1,129 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of the values looked up while handling a single request."""
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+import threading
+from counters import PerfCounter
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+
+
+# performance counters
+REQUEST_CACHE_HIT = PerfCounter(
+    'gcb-models-request-cache-hit',
+    'A number of times a value was found in the request cache.')
+REQUEST_CACHE_MISS = PerfCounter(
+    'gcb-models-request-cache-miss',
+    'A number of times a value was not found in the request cache.')
+REQUEST_RPC_COUNT = PerfCounter(
+    'gcb-models-request-rpc',
+    'A number of API calls (datastore, memcache, etc.) made by requests.')
+
+# A name of the hook counting API calls made by the current request.
+RPC_HOOK_NAME = 'gcb-request-rpc-count'
+
+# thread local storage for the cache of the current request
+REQUEST_CACHE_THREAD_LOCAL = threading.local()
+
+
+def _count_rpc(
+    unused_service, unused_call, unused_request, unused_response):
+    """Counts an API call if it is made while handling a request."""
+    if RequestCache.is_active():
+        REQUEST_CACHE_THREAD_LOCAL.rpc_count += 1
+        REQUEST_RPC_COUNT.inc()
+
+
+class RequestCache(object):
+    """Holds values looked up during a single request.
+
+    The cache exists only between begin() and end(). Outside of a request all
+    lookups are passed to the underlying source, so that code running in tests,
+    map reduce jobs or remote API sessions never sees stale values.
+
+    Keys are tuples; the first element is a name of the kind of the value being
+    cached, for example: ('student', email).
+    """
+
+    @classmethod
+    def begin(cls):
+        """Starts a new empty cache for the current request."""
+        if cls.is_active():
+            raise Exception('Expected no request cache.')
+        REQUEST_CACHE_THREAD_LOCAL.values = {}
+        REQUEST_CACHE_THREAD_LOCAL.rpc_count = 0
+
+        # Test bed replaces the API proxy between tests; the hook is added to
+        # the current one unless it's already there.
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            RPC_HOOK_NAME, _count_rpc)
+
+    @classmethod
+    def end(cls):
+        """Discards the cache of the current request.
+
+        Returns:
+            The number of API calls made while the cache was active.
+        """
+        if not cls.is_active():
+            raise Exception('Expected request cache already set.')
+        rpc_count = REQUEST_CACHE_THREAD_LOCAL.rpc_count
+        del REQUEST_CACHE_THREAD_LOCAL.values
+        del REQUEST_CACHE_THREAD_LOCAL.rpc_count
+        return rpc_count
+
+    @classmethod
+    def is_active(cls):
+        return hasattr(REQUEST_CACHE_THREAD_LOCAL, 'values')
+
+    @classmethod
+    def get_rpc_count(cls):
+        """Returns the number of API calls made by the current request."""
+        if not cls.is_active():
+            return 0
+        return REQUEST_CACHE_THREAD_LOCAL.rpc_count
+
+    @classmethod
+    def get(cls, key, compute):
+        """Returns the value for a key; calls compute() on the first lookup."""
+        if not cls.is_active():
+            return compute()
+        values = REQUEST_CACHE_THREAD_LOCAL.values
+        if key in values:
+            REQUEST_CACHE_HIT.inc()
+            return values[key]
+        REQUEST_CACHE_MISS.inc()
+        value = compute()
+        values[key] = value
+        return value
+
+    @classmethod
+    def set(cls, key, value):
+        """Replaces the value for a key; use after the value is modified."""
+        if cls.is_active():
+            REQUEST_CACHE_THREAD_LOCAL.values[key] = value
+
+    @classmethod
+    def delete(cls, key):
+        """Removes the value for a key so the next lookup recomputes it."""
+        if cls.is_active():
+            REQUEST_CACHE_THREAD_LOCAL.values.pop(key, None)
+
+
+def get_current_user():
+    """Returns users.get_current_user(); computed once per request."""
+    return RequestCache.get(('current_user',), users.get_current_user)
@@ -18,6 +18,8 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 
 import config
+from request_cache import get_current_user
+from request_cache import RequestCache
 from google.appengine.api import users
 
 
@@ -42,7 +44,7 @@ class Roles(object):
     @classmethod
     def is_direct_super_admin(cls):
         """Checks if current user is a super admin, without delegation."""
-        return users.get_current_user() and users.is_current_user_admin()
+        return get_current_user() and users.is_current_user_admin()
 
     @classmethod
     def is_super_admin(cls):
@@ -50,7 +52,7 @@ class Roles(object):
         if cls.is_direct_super_admin():
             return True
 
-        user = users.get_current_user()
+        user = get_current_user()
         if user and '[%s]' % user.email() in GCB_ADMIN_LIST.value:
             return True
         return False
@@ -58,6 +60,12 @@ class Roles(object):
     @classmethod
     def is_course_admin(cls, app_context):
         """Checks if a user is a course admin, possibly via delegation."""
+        return RequestCache.get(
+            ('is_course_admin', app_context.get_namespace_name()),
+            lambda: cls._is_course_admin(app_context))
+
+    @classmethod
+    def _is_course_admin(cls, app_context):
         if cls.is_super_admin():
             return True
 
@@ -65,7 +73,7 @@ class Roles(object):
             environ = app_context.get_environ()[KEY_COURSE]
             if KEY_ADMIN_USER_EMAILS in environ:
                 allowed = environ[KEY_ADMIN_USER_EMAILS]
-                user = users.get_current_user()
+                user = get_current_user()
                 if allowed and user and '[%s]' % user.email() in allowed:
                     return True
 
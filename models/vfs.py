@@ -17,9 +17,12 @@
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 import datetime
+import hashlib
+import logging
 import os
 import jinja2
 from entities import BaseEntity
+from models import MEMCACHE_MAX_VALUE_BYTES
 from models import MemcacheManager
 from google.appengine.api import namespace_manager
 from google.appengine.ext import db
@@ -30,6 +33,28 @@ from google.appengine.ext import db
 # we cache this object below.
 NO_OBJECT = {}
 
+# Files larger than this many bytes are stored in chunks of this size; this is
+# what fits into a single datastore entity and a single memcache item.
+FILE_CHUNK_SIZE = MEMCACHE_MAX_VALUE_BYTES - 1000
+
+# Max number of chunks to write to datastore in a single call.
+MAX_CHUNKS_PER_PUT = 4
+
+
+def compute_etag(raw_bytes):
+    """Computes a strong entity tag of the file content."""
+    return hashlib.sha1(raw_bytes).hexdigest()
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when a file was changed since the content being put was read."""
+
+    def __init__(self, filename, etag):
+        super(ConcurrentUpdateError, self).__init__(
+            'File %s was changed by someone else.' % filename)
+        self.filename = filename
+        self.etag = etag
+
 
 class AbstractFileSystem(object):
     """A generic file system interface that forwards to an implementation."""
@@ -61,6 +86,23 @@ class AbstractFileSystem(object):
         """Returns bytes with the file content, but no metadata."""
         return self._impl.get(filename).read()
 
+    def get_metadata(self, filename):
+        """Returns file metadata without loading file content.
+
+        Args:
+            filename: An absolute name of the file.
+
+        Returns:
+            None if file does not exist, otherwise an object with 'updated_on',
+            'is_draft', 'size' and 'etag' attributes; 'etag' may be None for
+            files stored before entity tags were introduced.
+        """
+        return self._impl.get_metadata(filename)
+
+    def read_range(self, filename, start, end):
+        """Returns bytes of the file content from start up to but not end."""
+        return self._impl.read_range(filename, start, end)
+
     def put(self, filename, stream, **kwargs):
         """Replaces the contents of the file with the bytes in the stream."""
         self._impl.put(filename, stream, **kwargs)
@@ -88,9 +130,24 @@ class AbstractFileSystem(object):
         return stream.metadata.is_draft
 
 
+class LocalFileMetadata(object):
+    """Metadata of a file on a local file system."""
+
+    def __init__(self, updated_on, size, etag):
+        self.updated_on = updated_on
+        self.is_draft = False
+        self.size = size
+        self.etag = etag
+
+
 class LocalReadOnlyFileSystem(object):
     """A read-only file system serving only local files."""
 
+    # Here we store a map of a physical filename to a tuple of the file
+    # modification time, size and the entity tag of its content. We hash the
+    # content of a local file only once, unless the file changes.
+    ETAG_CACHE = {}
+
     def __init__(self, logical_home_folder=None, physical_home_folder=None):
         """Creates a new instance of the disk-backed read-only file system.
 
@@ -130,6 +187,29 @@ class LocalReadOnlyFileSystem(object):
     def get(self, filename):
         return open(self._logical_to_physical(filename), 'rb')
 
+    def get_metadata(self, filename):
+        filename = self._logical_to_physical(filename)
+        if not os.path.isfile(filename):
+            return None
+
+        stat = os.stat(filename)
+        cached = self.ETAG_CACHE.get(filename)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            etag = cached[2]
+        else:
+            with open(filename, 'rb') as stream:
+                etag = compute_etag(stream.read())
+            self.ETAG_CACHE[filename] = (stat.st_mtime, stat.st_size, etag)
+
+        return LocalFileMetadata(
+            datetime.datetime.utcfromtimestamp(stat.st_mtime), stat.st_size,
+            etag)
+
+    def read_range(self, filename, start, end):
+        with open(self._logical_to_physical(filename), 'rb') as stream:
+            stream.seek(start)
+            return stream.read(max(0, end - start))
+
     def put(self, unused_filename, unused_stream):
         raise Exception('Not implemented.')
 
@@ -161,7 +241,6 @@ class LocalReadOnlyFileSystem(object):
 
 class FileMetadataEntity(BaseEntity):
     """An entity to represent a file metadata; absolute file name is a key."""
-    # TODO(psimakov): do we need 'version' to support concurrent updates
     # TODO(psimakov): can we put 'data' here and still have fast isfile/list?
     created_on = db.DateTimeProperty(auto_now_add=True, indexed=False)
     updated_on = db.DateTimeProperty(indexed=True)
@@ -173,12 +252,35 @@ class FileMetadataEntity(BaseEntity):
 
     size = db.IntegerProperty(indexed=False)
 
+    # A strong entity tag of the file content computed when the file is put;
+    # it also serves as a version of the file for optimistic concurrency.
+    etag = db.StringProperty(indexed=False)
+
+    # A manifest of a large file stored as 'chunk_count' FileDataChunkEntity
+    # objects of 'chunk_size' bytes each. If not set, the file content is in a
+    # single FileDataEntity.
+    chunk_count = db.IntegerProperty(indexed=False)
+    chunk_size = db.IntegerProperty(indexed=False)
+
 
 class FileDataEntity(BaseEntity):
     """An entity to represent file content; absolute file name is a key."""
     data = db.BlobProperty()
 
 
+class FileDataChunkEntity(BaseEntity):
+    """An entity to represent a part of the large file content.
+
+    Key name includes entity tag of the whole file, so chunks of different
+    versions of the same file never mix.
+    """
+    data = db.BlobProperty()
+
+    @classmethod
+    def make_key_name(cls, filename, etag, index):
+        return '%s:%s:%s' % (filename, etag, index)
+
+
 class FileStreamWrapped(object):
     """A class that wraps a file stream, but adds extra attributes to it."""
 
@@ -192,6 +294,10 @@ class FileStreamWrapped(object):
         self._data = ''
         return data
 
+    def read_range(self, start, end):
+        """Returns bytes from start up to but not end; does not consume."""
+        return self._data[start:end]
+
     @property
     def metadata(self):
         return self._metadata
@@ -231,13 +337,36 @@ class VirtualFileSystemTemplateLoader(jinja2.BaseLoader):
                 self._dir_names.append(AbstractFileSystem.normpath(dir_name))
 
     def get_source(self, unused_environment, template):
+        filenames = []
         for dir_name in self._dir_names:
-            filename = AbstractFileSystem.normpath(
-                os.path.join(dir_name, template))
-            if self._fs.isfile(filename):
-                return self._fs.get(
-                    filename).read().decode('utf-8'), filename, True
-        raise jinja2.TemplateNotFound(template)
+            filenames.append(AbstractFileSystem.normpath(
+                os.path.join(dir_name, template)))
+        filename, stream = self._fs.get_first(filenames)
+        if not stream:
+            raise jinja2.TemplateNotFound(template)
+        raw_bytes = stream.read()
+        return (
+            raw_bytes.decode('utf-8'), filename,
+            self._make_uptodate(filename, raw_bytes))
+
+    def _make_uptodate(self, filename, raw_bytes):
+        """Makes a check if a compiled template still matches file content.
+
+        The entity tags of the file are compared, which are cached with its
+        metadata; the content is only read for files stored without one.
+        """
+        etag = compute_etag(raw_bytes)
+
+        def uptodate():
+            metadata = self._fs.get_metadata(filename)
+            if not metadata:
+                return False
+            if metadata.etag:
+                return metadata.etag == etag
+            stream = self._fs.get(filename)
+            return bool(stream) and stream.read() == raw_bytes
+
+        return uptodate
 
     def list_templates(self):
         all_templates = []
@@ -253,6 +382,14 @@ class DatastoreBackedFileSystem(object):
     def make_key(cls, filename):
         return 'vfs:dsbfs:%s' % filename
 
+    @classmethod
+    def make_metadata_key(cls, filename):
+        return 'vfs:dsbfs:metadata:%s' % filename
+
+    @classmethod
+    def make_chunk_key(cls, filename, etag, index):
+        return 'vfs:dsbfs:chunk:%s:%s:%s' % (filename, etag, index)
+
     def __init__(
         self, ns, logical_home_folder,
         inherits_from=None, inheritable_folders=None):
@@ -376,12 +513,20 @@ class DatastoreBackedFileSystem(object):
 
         # Load from a datastore.
         metadata = FileMetadataEntity.get_by_key_name(filename)
+        if metadata and metadata.chunk_count:
+            # Large files are too big for memcache; their chunks are cached.
+            data = self._get_chunks(
+                filename, metadata, 0, metadata.chunk_count)
+            if data is None:
+                return None
+            return FileStreamWrapped(metadata, data)
         if metadata:
             data = FileDataEntity.get_by_key_name(filename)
             if data:
                 result = FileStreamWrapped(metadata, data.data)
                 MemcacheManager.set(
-                    self.make_key(filename), result, namespace=self._ns)
+                    self.make_key(filename), result, namespace=self._ns,
+                    invalidate=False)
                 return result
 
         result = None
@@ -395,55 +540,290 @@ class DatastoreBackedFileSystem(object):
         if result:
             result = FileStreamWrapped(metadata, result.read())
             MemcacheManager.set(
-                self.make_key(filename), result, namespace=self._ns)
+                self.make_key(filename), result, namespace=self._ns,
+                invalidate=False)
         else:
             MemcacheManager.set(
-                self.make_key(filename), NO_OBJECT, namespace=self._ns)
+                self.make_key(filename), NO_OBJECT, namespace=self._ns,
+                invalidate=False)
 
         return result
 
-    @db.transactional(xg=True)
-    def put(self, filename, stream, is_draft=False, metadata_only=False):
+    def get_first(self, afilenames):
+        """Gets the first of the files that exists.
+
+        All the files are looked up in memcache in a single call; only the
+        files not found there are then looked up one by one.
+
+        Args:
+            afilenames: A list of logical names of the files.
+
+        Returns:
+            A tuple of the name of the first file that exists and its stream,
+            or (None, None) if none of the files exist.
+        """
+        keys = [
+            self.make_key(self._logical_to_physical(afilename))
+            for afilename in afilenames]
+        cached = MemcacheManager.get_multi(keys, namespace=self._ns)
+        for afilename, key in zip(afilenames, keys):
+            result = cached.get(key)
+            if NO_OBJECT == result:
+                continue
+            if result is None:
+                result = self.get(afilename)
+            if result is not None:
+                return afilename, result
+        return None, None
+
+    def get_metadata(self, afilename):
+        """Gets file metadata from a datastore, but does not load content."""
+        filename = self._logical_to_physical(afilename)
+
+        # Load from cache.
+        result = MemcacheManager.get(
+            self.make_metadata_key(filename), namespace=self._ns)
+        if result:
+            return result
+        if NO_OBJECT == result:
+            return None
+
+        # Load from a datastore or from parent fs.
+        result = FileMetadataEntity.get_by_key_name(filename)
+        if not result and self._inherits_from and self._can_inherit(filename):
+            result = self._inherits_from.get_metadata(afilename)
+
+        # Cache result.
+        if result:
+            MemcacheManager.set(
+                self.make_metadata_key(filename), result, namespace=self._ns,
+                invalidate=False)
+        else:
+            MemcacheManager.set(
+                self.make_metadata_key(filename), NO_OBJECT,
+                namespace=self._ns, invalidate=False)
+
+        return result
+
+    def read_range(self, afilename, start, end):
+        """Gets a part of a file from a datastore. Raw bytes, no encodings."""
+        filename = self._logical_to_physical(afilename)
+
+        # Load only the chunks that overlap with the range.
+        metadata = self.get_metadata(afilename)
+        if metadata and getattr(metadata, 'chunk_count', None):
+            first = start // metadata.chunk_size
+            last = min(
+                metadata.chunk_count, (end - 1) // metadata.chunk_size + 1)
+            if first >= last:
+                return ''
+            data = self._get_chunks(filename, metadata, first, last)
+            if data is None:
+                return None
+            offset = first * metadata.chunk_size
+            return data[start - offset:end - offset]
+
+        stream = self.get(afilename)
+        if not stream:
+            return None
+        return stream.read_range(start, end)
+
+    def _get_chunks(self, filename, metadata, first, last):
+        """Loads content of the chunks [first, last) of a large file.
+
+        Args:
+            filename: A physical name of the file.
+            metadata: A FileMetadataEntity with the manifest of the file.
+            first: An index of the first chunk to load.
+            last: An index of the chunk after the last chunk to load.
+
+        Returns:
+            Bytes of the chunks or None if some of the chunks are missing, which
+            happens if the file was changed after the manifest was read.
+        """
+        indexes = range(first, last)
+        keys = [
+            self.make_chunk_key(filename, metadata.etag, index)
+            for index in indexes]
+        values = MemcacheManager.get_multi(keys, namespace=self._ns)
+
+        missing = [index for index, key in zip(indexes, keys)
+                   if key not in values]
+        if missing:
+            entities = FileDataChunkEntity.get_by_key_name([
+                FileDataChunkEntity.make_key_name(
+                    filename, metadata.etag, index) for index in missing])
+            loaded = {}
+            for index, entity in zip(missing, entities):
+                if not entity:
+                    logging.warning(
+                        'Chunk %s of %s is missing.', index, filename)
+                    return None
+                loaded[self.make_chunk_key(
+                    filename, metadata.etag, index)] = entity.data
+            # The chunks are already loaded; don't wait for memcache.
+            MemcacheManager.set_multi_async(
+                loaded, namespace=self._ns, invalidate=False)
+            values.update(loaded)
+
+        return ''.join([values[key] for key in keys])
+
+    def _put_chunks(self, filename, raw_bytes, etag):
+        """Stores content of a large file as chunks."""
+        chunks = []
+        for index, offset in enumerate(
+                xrange(0, len(raw_bytes), FILE_CHUNK_SIZE)):
+            chunks.append(FileDataChunkEntity(
+                key_name=FileDataChunkEntity.make_key_name(
+                    filename, etag, index),
+                data=raw_bytes[offset:offset + FILE_CHUNK_SIZE]))
+        for offset in xrange(0, len(chunks), MAX_CHUNKS_PER_PUT):
+            FileDataChunkEntity.put_multi(
+                chunks[offset:offset + MAX_CHUNKS_PER_PUT])
+
+    def _delete_chunks(self, filename, manifest):
+        """Deletes chunks of an old version of a large file."""
+        if not manifest:
+            return
+        etag, chunk_count = manifest
+        FileDataChunkEntity.delete_multi([
+            db.Key.from_path(
+                FileDataChunkEntity.kind(),
+                FileDataChunkEntity.make_key_name(filename, etag, index))
+            for index in xrange(chunk_count)])
+
+    def put(
+        self, filename, stream, is_draft=False, metadata_only=False,
+        expected_etag=None):
         """Puts a file stream to a database. Raw bytes stream, no encodings."""
-        self.non_transactional_put(
-            filename, stream, is_draft=is_draft, metadata_only=metadata_only)
+        self._put(
+            filename, stream, is_draft, metadata_only, True, expected_etag)
 
     def non_transactional_put(
         self, filename, stream, is_draft=False, metadata_only=False):
         """Non-transactional put; use only when transactions are impossible."""
+        self._put(filename, stream, is_draft, metadata_only, False, None)
+
+    def _put(
+        self, filename, stream, is_draft, metadata_only, transactional,
+        expected_etag):
+        """Puts a file; the content of a large file is put in chunks.
+
+        Chunks are put before and outside of the transaction that updates the
+        file metadata, because there may be more of them than a transaction can
+        hold. Until the metadata is updated the new chunks aren't visible. The
+        chunks of the old version of the file are deleted after the update.
+
+        Args:
+            filename: A logical name of the file.
+            stream: A stream with the new file content.
+            is_draft: Whether the file is a draft.
+            metadata_only: Whether to update only metadata, but not content.
+            transactional: Whether to update metadata in a transaction.
+            expected_etag: An entity tag of the file content the new content
+                is based on, or None to put the file unconditionally.
+
+        Raises:
+            ConcurrentUpdateError: if the file content was changed since it was
+                read, i.e. its entity tag is no longer the expected one.
+        """
         filename = self._logical_to_physical(filename)
 
+        raw_bytes = None
+        etag = None
+        if not metadata_only:
+            # We operate with raw bytes. The consumer must deal with encoding.
+            raw_bytes = stream.read()
+            etag = compute_etag(raw_bytes)
+            if len(raw_bytes) > FILE_CHUNK_SIZE:
+                self._put_chunks(filename, raw_bytes, etag)
+
+        try:
+            if transactional:
+                stale_manifest = self._transactional_put_metadata(
+                    filename, raw_bytes, etag, is_draft, expected_etag)
+            else:
+                stale_manifest = self._put_metadata(
+                    filename, raw_bytes, etag, is_draft, expected_etag)
+        except ConcurrentUpdateError as e:
+            # Our chunks are not referenced, unless the file already has the
+            # very same content.
+            if raw_bytes and len(raw_bytes) > FILE_CHUNK_SIZE and (
+                    e.etag != etag):
+                self._delete_chunks(filename, (
+                    etag, (len(raw_bytes) - 1) // FILE_CHUNK_SIZE + 1))
+            raise
+
+        self._delete_chunks(filename, stale_manifest)
+
+    @db.transactional(xg=True)
+    def _transactional_put_metadata(
+        self, filename, raw_bytes, etag, is_draft, expected_etag):
+        return self._put_metadata(
+            filename, raw_bytes, etag, is_draft, expected_etag)
+
+    def _put_metadata(self, filename, raw_bytes, etag, is_draft, expected_etag):
+        """Puts file metadata and small file content; returns stale manifest."""
         metadata = FileMetadataEntity.get_by_key_name(filename)
+
+        # Files stored before entity tags were introduced can't be checked.
+        if (expected_etag is not None and metadata and metadata.etag and
+            metadata.etag != expected_etag):
+            raise ConcurrentUpdateError(filename, metadata.etag)
+
         if not metadata:
             metadata = FileMetadataEntity(key_name=filename)
         metadata.updated_on = datetime.datetime.now()
         metadata.is_draft = is_draft
 
-        if not metadata_only:
-            # We operate with raw bytes. The consumer must deal with encoding.
-            raw_bytes = stream.read()
+        stale_manifest = None
+        if raw_bytes is not None:
+            if metadata.chunk_count and metadata.etag != etag:
+                stale_manifest = (metadata.etag, metadata.chunk_count)
 
             metadata.size = len(raw_bytes)
+            metadata.etag = etag
 
             data = FileDataEntity(key_name=filename)
-            data.data = raw_bytes
-            data.put()
+            if len(raw_bytes) > FILE_CHUNK_SIZE:
+                metadata.chunk_size = FILE_CHUNK_SIZE
+                metadata.chunk_count = (
+                    len(raw_bytes) + FILE_CHUNK_SIZE - 1) // FILE_CHUNK_SIZE
+                data.delete()
+            else:
+                metadata.chunk_size = None
+                metadata.chunk_count = None
+                data.data = raw_bytes
+                data.put()
 
         metadata.put()
 
-        MemcacheManager.delete(self.make_key(filename), namespace=self._ns)
+        MemcacheManager.delete_multi(
+            [self.make_key(filename), self.make_metadata_key(filename)],
+            namespace=self._ns)
+
+        return stale_manifest
 
-    @db.transactional(xg=True)
     def delete(self, filename):
         filename = self._logical_to_physical(filename)
+        self._delete_chunks(filename, self._transactional_delete(filename))
 
+    @db.transactional(xg=True)
+    def _transactional_delete(self, filename):
+        """Deletes metadata and small file content; returns stale manifest."""
+        stale_manifest = None
         metadata = FileMetadataEntity.get_by_key_name(filename)
         if metadata:
+            if metadata.chunk_count:
+                stale_manifest = (metadata.etag, metadata.chunk_count)
             metadata.delete()
         data = FileDataEntity(key_name=filename)
         if data:
             data.delete()
-        MemcacheManager.delete(self.make_key(filename), namespace=self._ns)
+        MemcacheManager.delete_multi(
+            [self.make_key(filename), self.make_metadata_key(filename)],
+            namespace=self._ns)
+        return stale_manifest
 
     def isfile(self, afilename):
         """Checks file existence by looking up the datastore row."""
@@ -471,7 +851,8 @@ class DatastoreBackedFileSystem(object):
         # Put NO_OBJECT marker into memcache to avoid repeated lookups.
         if not result:
             MemcacheManager.set(
-                self.make_key(filename), NO_OBJECT, namespace=self._ns)
+                self.make_key(filename), NO_OBJECT, namespace=self._ns,
+                invalidate=False)
 
         return result
 
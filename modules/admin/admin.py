@@ -29,9 +29,12 @@ from controllers.utils import ReflectiveRequestHandler
 import jinja2
 from models import config
 from models import counters
+from models import import_profiler
+from models import models
 from models import roles
 from models.config import ConfigProperty
 from modules.admin.config import ConfigPropertyEditor
+from modules.admin.config import get_all_properties
 import webapp2
 import messages
 from google.appengine.api import users
@@ -218,15 +221,88 @@ class AdminHandler(
             config.Registry.last_update_time)
         perf_counters['gcb-config-update-index'] = config.Registry.update_index
 
-        # add all registered counters
+        # add all registered counters and their fleet-wide values, if known
         all_counters = counters.Registry.registered.copy()
+        fleet_counters = models.FleetCounters.get_totals_and_rates(
+            all_counters.keys())
         for name in all_counters.keys():
             perf_counters[name] = all_counters[name].value
-
-        template_values['main_content'] = self.render_dict(
-            perf_counters, 'In-process Performance Counters')
+            if name in fleet_counters:
+                perf_counters[name] = (
+                    '%s (all instances: %s, %.2f per sec)' % ((
+                        all_counters[name].value,) + fleet_counters[name]))
+
+        # the slowest modules to import
+        import_times = {}
+        for name, total_ms, self_ms in (
+                import_profiler.ImportProfiler.get_report()[
+                    :import_profiler.MAX_MODULES_TO_LOG]):
+            import_times[name] = '%.1f ms (self %.1f ms)' % (total_ms, self_ms)
+
+        template_values['main_content'] = '\n'.join([
+            self.render_request_stats(counters.Registry.request_stats),
+            self.render_histograms_and_rates(all_counters),
+            self.render_dict(perf_counters, 'In-process Performance Counters'),
+            self.render_dict(import_times, 'Slowest Module Imports')])
         self.render_page(template_values)
 
+    def render_histograms_and_rates(self, all_counters):
+        """Renders distributions of histograms and rates of rate counters."""
+        histograms = {}
+        rates = {}
+        for name, counter in all_counters.iteritems():
+            if isinstance(counter, counters.PerfHistogram):
+                histograms[name] = (
+                    'count: %s, mean: %.1f, p50/p90/p99: %s/%s/%s, max: %s' % (
+                        counter.value, counter.mean,
+                        counter.get_percentile(50), counter.get_percentile(90),
+                        counter.get_percentile(99), counter.max))
+            if isinstance(counter, counters.PerfRateCounter):
+                rates[name] = '%.2f per sec over the last %s sec' % (
+                    counter.get_rate(), counter.window_sec)
+        return '%s\n%s' % (
+            self.render_dict(histograms, 'In-process Distributions'),
+            self.render_dict(rates, 'In-process Rates'))
+
+    def render_request_stats(self, request_stats):
+        """Renders latency and API call statistics of the request handlers."""
+        content = []
+        content.append('<h3>In-process Request Handler Statistics</h3>')
+        content.append('<table>')
+        content.append("""
+            <tr>
+              <th>Handler</th>
+              <th>Requests</th>
+              <th>Latency p50/p90/p99, ms</th>
+              <th>API calls p50/p90/p99</th>
+              <th>Operations per request: count, ms</th>
+            </tr>
+            """)
+        for name in sorted(request_stats.keys()):
+            stats = request_stats[name]
+            spans = stats.get_spans_per_request()
+            content.append("""
+                <tr>
+                  <td>%s</td>
+                  <td>%s</td>
+                  <td>%s</td>
+                  <td>%s</td>
+                  <td>%s</td>
+                </tr>
+                """ % (
+                    escape(name), stats.count,
+                    '/'.join(['%.1f' % latency for latency in (
+                        stats.get_latency_percentiles_ms())]),
+                    '/'.join([str(count) for count in (
+                        stats.get_rpc_count_percentiles())]),
+                    '<br>'.join([
+                        '%s: %.1f, %.1f' % (
+                            escape(span_name), spans[span_name][0],
+                            spans[span_name][1])
+                        for span_name in sorted(spans.keys())])))
+        content.append('</table>')
+        return '\n'.join(content)
+
     def get_deployment(self):
         """Shows server environment and deployment information page."""
         template_values = {}
@@ -327,8 +403,8 @@ class AdminHandler(
                 doc_string, escape(default_value))
             return doc_string
 
+        registered = get_all_properties().copy()
         overrides = config.Registry.get_overrides(True)
-        registered = config.Registry.registered.copy()
 
         count = 0
         for name in sorted(registered.keys()):
@@ -31,6 +31,16 @@ from google.appengine.api import users
 from google.appengine.ext import db
 
 
+def get_all_properties():
+    """Returns a map of the names of all the properties to the properties.
+
+    Properties are registered when the modules declaring them are imported, so
+    the handlers not dispatched to yet are imported first.
+    """
+    sites.ApplicationRequestHandler.import_all_handlers()
+    return config.Registry.registered
+
+
 # This is a template because the value type is not yet known.
 SCHEMA_JSON_TEMPLATE = """
     {
@@ -136,7 +146,7 @@ class ConfigPropertyEditor(object):
         if not key:
             self.redirect('/admin?action=settings')
 
-        item = config.Registry.registered[key]
+        item = get_all_properties()[key]
         if not item:
             self.redirect('/admin?action=settings')
 
@@ -164,8 +174,9 @@ class ConfigPropertyEditor(object):
 
         # Find item in registry.
         item = None
-        if name and name in config.Registry.registered.keys():
-            item = config.Registry.registered[name]
+        registered = get_all_properties()
+        if name and name in registered.keys():
+            item = registered[name]
         if not item:
             self.redirect('/admin?action=settings')
 
@@ -179,6 +190,7 @@ class ConfigPropertyEditor(object):
             entity.value = str(item.value)
             entity.is_draft = True
             entity.put()
+            config.Registry.bump_generation()
 
         models.EventEntity.record(
             'override-property', users.get_current_user(), transforms.dumps({
@@ -193,8 +205,9 @@ class ConfigPropertyEditor(object):
 
         # Find item in registry.
         item = None
-        if name and name in config.Registry.registered.keys():
-            item = config.Registry.registered[name]
+        registered = get_all_properties()
+        if name and name in registered.keys():
+            item = registered[name]
         if not item:
             self.redirect('/admin?action=settings')
 
@@ -204,6 +217,7 @@ class ConfigPropertyEditor(object):
             if entity:
                 old_value = entity.value
                 entity.delete()
+                config.Registry.bump_generation()
 
                 models.EventEntity.record(
                     'delete-property', users.get_current_user(),
@@ -317,8 +331,9 @@ class ConfigPropertyItemRESTHandler(BaseRESTHandler):
             return
 
         item = None
-        if key and key in config.Registry.registered.keys():
-            item = config.Registry.registered[key]
+        registered = get_all_properties()
+        if key and key in registered.keys():
+            item = registered[key]
         if not item:
             self.redirect('/admin?action=settings')
 
@@ -359,8 +374,9 @@ class ConfigPropertyItemRESTHandler(BaseRESTHandler):
             return
 
         item = None
-        if key and key in config.Registry.registered.keys():
-            item = config.Registry.registered[key]
+        registered = get_all_properties()
+        if key and key in registered.keys():
+            item = registered[key]
         if not item:
             self.redirect('/admin?action=settings')
 
@@ -388,6 +404,7 @@ class ConfigPropertyItemRESTHandler(BaseRESTHandler):
         entity.value = str(new_value)
         entity.is_draft = json_object['is_draft']
         entity.put()
+        config.Registry.bump_generation()
 
         models.EventEntity.record(
             'put-property', users.get_current_user(), transforms.dumps({
@@ -298,16 +298,17 @@ class AnnouncementEntity(entities.BaseEntity):
 
     memcache_key = 'announcements'
 
+    @classmethod
+    def _fetch_announcements(cls):
+        return AnnouncementEntity.all().order('-date').fetch(1000)
+
     @classmethod
     def get_announcements(cls, allow_cached=True):
-        items = MemcacheManager.get(cls.memcache_key)
-        if not allow_cached or items is None:
-            items = AnnouncementEntity.all().order('-date').fetch(1000)
-
-            # TODO(psimakov): prepare to exceed 1MB max item size
-            # read more here: http://stackoverflow.com
-            #   /questions/5081502/memcache-1-mb-limit-in-google-app-engine
-            MemcacheManager.set(cls.memcache_key, items)
+        if allow_cached:
+            return MemcacheManager.get_or_compute(
+                cls.memcache_key, cls._fetch_announcements)
+        items = cls._fetch_announcements()
+        MemcacheManager.set(cls.memcache_key, items)
         return items
 
     def put(self):
@@ -27,6 +27,7 @@ from controllers.utils import XsrfTokenManager
 from models import courses
 from models import roles
 from models import transforms
+from models import vfs
 from modules.oeditor import oeditor
 from tools import verify
 import filer
@@ -44,6 +45,28 @@ PUBLISHED_TEXT = 'Public'
 # badly :). All in all - using generic schema-based object editor for editing
 # nested arrayable polymorphic attributes is a pain...
 
+# A message shown when a course was saved while it was being edited.
+COURSE_CONFLICT_TEXT = (
+    'The course was changed by someone else. Reload and try again.')
+
+
+def save_course_or_fail(handler, course):
+    """Saves course; sends an error response if it was changed meanwhile.
+
+    Args:
+        handler: A REST handler the request is served by.
+        course: A Course to save.
+
+    Returns:
+        True if the course was saved, False if an error response was sent.
+    """
+    try:
+        course.save()
+        return True
+    except vfs.ConcurrentUpdateError:
+        transforms.send_json_response(handler, 412, COURSE_CONFLICT_TEXT)
+        return False
+
 
 def create_status_annotation():
     return oeditor.create_bool_select_annotation(
@@ -134,7 +157,8 @@ class UnitLessonEditor(ApplicationHandler):
                 break
         if first_unit:
             lesson = course.add_lesson(first_unit)
-            course.save()
+            if not save_course_or_fail(self, course):
+                return
             # TODO(psimakov): complete 'edit_lesson' view
             self.redirect(self.get_action_url(
                 'edit_lesson', key=lesson.lesson_id,
@@ -146,7 +170,8 @@ class UnitLessonEditor(ApplicationHandler):
         """Adds new unit to a course."""
         course = courses.Course(self)
         unit = course.add_unit()
-        course.save()
+        if not save_course_or_fail(self, course):
+            return
         self.redirect(self.get_action_url(
             'edit_unit', key=unit.unit_id, extra_args={'is_newly_created': 1}))
 
@@ -154,7 +179,8 @@ class UnitLessonEditor(ApplicationHandler):
         """Adds new link to a course."""
         course = courses.Course(self)
         link = course.add_link()
-        course.save()
+        if not save_course_or_fail(self, course):
+            return
         self.redirect(self.get_action_url(
             'edit_link', key=link.unit_id, extra_args={'is_newly_created': 1}))
 
@@ -162,7 +188,8 @@ class UnitLessonEditor(ApplicationHandler):
         """Adds new assessment to a course."""
         course = courses.Course(self)
         assessment = course.add_assessment()
-        course.save()
+        if not save_course_or_fail(self, course):
+            return
         self.redirect(self.get_action_url(
             'edit_assessment', key=assessment.unit_id,
             extra_args={'is_newly_created': 1}))
@@ -301,8 +328,8 @@ class CommonUnitRESTHandler(BaseRESTHandler):
         if not errors:
             course = courses.Course(self)
             assert course.update_unit(unit)
-            course.save()
-            transforms.send_json_response(self, 200, 'Saved.')
+            if save_course_or_fail(self, course):
+                transforms.send_json_response(self, 200, 'Saved.')
         else:
             transforms.send_json_response(self, 412, '\n'.join(errors))
 
@@ -327,9 +354,8 @@ class CommonUnitRESTHandler(BaseRESTHandler):
             return
 
         course.delete_unit(unit)
-        course.save()
-
-        transforms.send_json_response(self, 200, 'Deleted.')
+        if save_course_or_fail(self, course):
+            transforms.send_json_response(self, 200, 'Deleted.')
 
 
 class UnitRESTHandler(CommonUnitRESTHandler):
@@ -525,8 +551,8 @@ class ImportCourseRESTHandler(CommonUnitRESTHandler):
             transforms.send_json_response(self, 412, '\n'.join(errors))
             return
 
-        course.save()
-        transforms.send_json_response(self, 200, 'Imported.')
+        if save_course_or_fail(self, course):
+            transforms.send_json_response(self, 200, 'Imported.')
 
 
 class AssessmentRESTHandler(CommonUnitRESTHandler):
@@ -720,9 +746,8 @@ class UnitLessonTitleRESTHandler(BaseRESTHandler):
             transforms.loads(payload), self.SCHEMA_DICT)
         course = courses.Course(self)
         course.reorder_units(payload_dict['outline'])
-        course.save()
-
-        transforms.send_json_response(self, 200, 'Saved.')
+        if save_course_or_fail(self, course):
+            transforms.send_json_response(self, 200, 'Saved.')
 
 
 class LessonRESTHandler(BaseRESTHandler):
@@ -867,21 +892,25 @@ class LessonRESTHandler(BaseRESTHandler):
 
         activity = updates_dict.get('activity', '').strip()
         errors = []
+        old_activity_path = None
         if activity:
             lesson.has_activity = True
             course.set_activity_content(lesson, activity, errors=errors)
-        else:
+        elif lesson.has_activity:
             lesson.has_activity = False
-            fs = self.app_context.fs
-            path = fs.impl.physical_to_logical(course.get_activity_filename(
-                lesson.unit_id, lesson.lesson_id))
-            if fs.isfile(path):
-                fs.delete(path)
+            old_activity_path = self.app_context.fs.impl.physical_to_logical(
+                course.get_activity_filename(
+                    lesson.unit_id, lesson.lesson_id))
 
         if not errors:
             assert course.update_lesson(lesson)
-            course.save()
-            transforms.send_json_response(self, 200, 'Saved.')
+            if save_course_or_fail(self, course):
+                # The activity is only deleted once the course is saved
+                # without it.
+                fs = self.app_context.fs
+                if old_activity_path and fs.isfile(old_activity_path):
+                    fs.delete(old_activity_path)
+                transforms.send_json_response(self, 200, 'Saved.')
         else:
             transforms.send_json_response(self, 412, '\n'.join(errors))
 
@@ -906,6 +935,5 @@ class LessonRESTHandler(BaseRESTHandler):
             return
 
         assert course.delete_lesson(lesson)
-        course.save()
-
-        transforms.send_json_response(self, 200, 'Deleted.')
+        if save_course_or_fail(self, course):
+            transforms.send_json_response(self, 200, 'Deleted.')
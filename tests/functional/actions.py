@@ -24,6 +24,7 @@ from controllers import sites
 from controllers import utils
 import main
 from models import config
+from models import courses
 import suite
 from google.appengine.api import namespace_manager
 
@@ -80,6 +81,9 @@ class TestBase(suite.AppEngineTestBase):
         # Reload all properties now to flush the values modified in other tests.
         config.Registry.get_overrides(True)
 
+        # Drop the course models cached by other tests.
+        courses.CourseModelCache.clear()
+
     def tearDown(self):  # pylint: disable-msg=g-bad-name
         self.assert_default_namespace()
         super(TestBase, self).tearDown()
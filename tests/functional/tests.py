@@ -34,12 +34,14 @@ from controllers import sites
 from controllers import utils
 from controllers.utils import XsrfTokenManager
 from models import config
+from models import counters
 from models import courses
 from models import jobs
 from models import models
 from models import transforms
 from models import vfs
 from models.courses import Course
+from models.request_cache import RequestCache
 import modules.admin.admin
 from modules.announcements.announcements import AnnouncementEntity
 from tools import verify
@@ -247,12 +249,15 @@ class InfrastructureTest(actions.TestBase):
         assert [lesson_b] == course.get_lessons(another_unit.unit_id)
         course.delete_unit(another_unit)
         course.save()
+        assert not course.find_unit_by_id(another_unit.unit_id)
+        assert not course.find_lesson_by_id(None, lesson_b.lesson_id)
+        assert lesson_a == course.find_lesson_by_id(None, lesson_a.lesson_id)
 
         # Make the course available.
         get_environ_old = sites.ApplicationContext.get_environ
 
         def get_environ_new(self):
-            environ = get_environ_old(self)
+            environ = copy.deepcopy(get_environ_old(self))
             environ['course']['now_available'] = True
             return environ
 
@@ -374,7 +379,7 @@ class InfrastructureTest(actions.TestBase):
         get_environ_old = sites.ApplicationContext.get_environ
 
         def get_environ_new(self):
-            environ = get_environ_old(self)
+            environ = copy.deepcopy(get_environ_old(self))
             environ['course']['now_available'] = True
             return environ
 
@@ -493,7 +498,7 @@ class InfrastructureTest(actions.TestBase):
         get_environ_old = sites.ApplicationContext.get_environ
 
         def get_environ_new(self):
-            environ = get_environ_old(self)
+            environ = copy.deepcopy(get_environ_old(self))
             environ['course']['now_available'] = True
             return environ
 
@@ -623,6 +628,38 @@ class InfrastructureTest(actions.TestBase):
         assert not stored.metadata.is_draft
         assert stored.read() == open(src, 'rb').read()
 
+        # Check metadata is available without file content.
+        metadata = fs.get_metadata(dst)
+        assert metadata.size == stored.metadata.size
+        assert metadata.etag == vfs.compute_etag(open(src, 'rb').read())
+        assert not fs.get_metadata('/foo/bar/baz')
+        assert fs.read_range(dst, 5, 15) == open(src, 'rb').read()[5:15]
+
+        # Check large files are stored in chunks.
+        self.swap(vfs, 'FILE_CHUNK_SIZE', 10)
+        large_file = os.path.join('/', 'assets/img/large.bin')
+        large_data = ''.join([chr(index) for index in xrange(35)])
+        fs.put(large_file, vfs.string_to_stream(unicode(large_data)))
+        metadata = fs.get_metadata(large_file)
+        assert 4 == metadata.chunk_count
+        assert 4 == vfs.FileDataChunkEntity.all().count()
+        assert large_data == fs.get(large_file)
+        assert large_data[12:27] == fs.read_range(large_file, 12, 27)
+        assert large_data[30:] == fs.read_range(large_file, 30, 100)
+
+        # Check new chunks replace old ones and small files aren't chunked.
+        fs.put(large_file, vfs.string_to_stream(unicode(large_data[1:])))
+        assert 4 == vfs.FileDataChunkEntity.all().count()
+        assert large_data[1:] == fs.get(large_file)
+        fs.put(large_file, vfs.string_to_stream(u'small'))
+        assert not vfs.FileDataChunkEntity.all().count()
+        assert not fs.get_metadata(large_file).chunk_count
+        assert 'small' == fs.get(large_file)
+        fs.put(large_file, vfs.string_to_stream(unicode(large_data)))
+        fs.delete(large_file)
+        assert not vfs.FileDataChunkEntity.all().count()
+        assert not fs.isfile(large_file)
+
         # Check draft.
         fs.put(dst, open(src, 'rb'), is_draft=True)
         stored = fs.open(dst)
@@ -670,6 +707,534 @@ class InfrastructureTest(actions.TestBase):
             u'/assets/js/foo.js', u'/assets/js/bar.js', u'/assets/js/baz.js'])
         assert not fs.list('/foo/bar')
 
+    def test_lazy_handler_binding(self):
+        """Test handlers bound by a dotted path are imported when needed."""
+        handlers = sites.ApplicationRequestHandler
+        self.swap(handlers, 'urls_map', {})
+        handlers.bind([
+            ('/', 'controllers.lessons.CourseHandler'),
+            ('/preview', 'controllers.utils.PreviewHandler')])
+        assert_equals(
+            'controllers.lessons.CourseHandler', handlers.urls_map['/'])
+        assert '/rest/events' not in handlers.urls_map
+
+        # Check the handler is imported on first dispatch.
+        response = self.testapp.get('/preview')
+        assert_equals(200, response.status_int)
+        assert_equals(utils.PreviewHandler, handlers.urls_map['/preview'])
+
+        # Check child routes of the handlers not yet imported are found.
+        assert_equals(
+            lessons.EventsRESTHandler,
+            handlers.get_handler_class('/rest/events'))
+        assert_equals(lessons.CourseHandler, handlers.urls_map['/'])
+        assert not handlers.get_handler_class('/no/such/handler')
+
+    def test_memcache_multi_and_async(self):
+        """Test batched and asynchronous memcache operations."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        namespace = 'ns_test'
+        mapping = {'a': 1, 'b': 2}
+
+        old_puts = models.CACHE_PUT.value
+        rpc = models.MemcacheManager.set_multi_async(
+            mapping, namespace=namespace)
+        assert_equals(2, models.CACHE_PUT.value - old_puts)
+        rpc.get_result()
+
+        old_hits = models.CACHE_HIT.value
+        old_misses = models.CACHE_MISS.value
+        rpc = models.MemcacheManager.get_multi_async(
+            ['a', 'b', 'c'], namespace=namespace)
+        assert_equals(mapping, rpc.get_result())
+        assert_equals(2, models.CACHE_HIT.value - old_hits)
+        assert_equals(1, models.CACHE_MISS.value - old_misses)
+        assert_equals({}, models.MemcacheManager.get_multi(['a', 'b']))
+
+        models.MemcacheManager.delete_multi(['a', 'b'], namespace=namespace)
+        assert_equals({}, models.MemcacheManager.get_multi(
+            ['a', 'b'], namespace=namespace))
+
+        # Check operations not waited for are completed by the request end.
+        RequestCache.begin()
+        try:
+            models.MemcacheManager.set_multi_async(
+                mapping, namespace=namespace)
+            assert models.MemcacheRpc.pending
+            models.MemcacheRpc.wait_all()
+            assert not models.MemcacheRpc.pending
+        finally:
+            RequestCache.end()
+        assert_equals(mapping, models.MemcacheManager.get_multi(
+            ['a', 'b'], namespace=namespace))
+
+        # Check nothing is looked up if memcache is disabled.
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = False
+        assert_equals({}, models.MemcacheManager.get_multi_async(
+            ['a', 'b'], namespace=namespace).get_result())
+
+    def test_memcache_large_values(self):
+        """Test values too large for one memcache item are stored in parts."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        namespace = 'ns_test'
+
+        # Check a chunk of a large file is stored as a single item.
+        chunk = 'x' * vfs.FILE_CHUNK_SIZE
+        models.MemcacheManager.set('chunk', chunk, namespace=namespace)
+        assert_equals(chunk, memcache.get('chunk', namespace=namespace))
+
+        self.swap(models, 'MEMCACHE_MAX_VALUE_BYTES', 1000)
+        value = ['x' * 1500, 'y' * 1500]
+
+        # Check the value is split and read back.
+        models.MemcacheManager.set('large', value, namespace=namespace)
+        header = memcache.get('large', namespace=namespace)
+        assert isinstance(header, models.ChunkedValue)
+        assert len(header.part_keys) > 1
+        assert_equals(value, models.MemcacheManager.get('large', namespace))
+
+        # Check a new version of the value replaces the old one.
+        new_value = ['z' * 3000]
+        models.MemcacheManager.set_multi(
+            {'large': new_value, 'small': 'small'}, namespace=namespace)
+        assert_equals(
+            {'large': new_value, 'small': 'small'},
+            models.MemcacheManager.get_multi(
+                ['large', 'small'], namespace=namespace))
+
+        # Check the value is missing if any of its parts was evicted.
+        header = memcache.get('large', namespace=namespace)
+        memcache.delete(header.part_keys[-1], namespace=namespace)
+        old_misses = models.CACHE_MISS.value
+        assert not models.MemcacheManager.get('large', namespace)
+        assert_equals({}, models.MemcacheManager.get_multi(
+            ['large'], namespace=namespace))
+        assert_equals(2, models.CACHE_MISS.value - old_misses)
+
+        # Check a small value pickled to be measured is read back as is.
+        models.MemcacheManager.set('small', {'a': [1]}, namespace=namespace)
+        assert_equals({'a': [1]}, memcache.get('small', namespace=namespace))
+
+        # Check values too large even for parts are not cached.
+        models.MemcacheManager.set('large', value, namespace=namespace)
+        self.swap(models, 'MEMCACHE_MAX_VALUE_PARTS', 2)
+        models.MemcacheManager.set('large', new_value, namespace=namespace)
+        assert not models.MemcacheManager.get('large', namespace)
+
+    def test_cached_course_encoding(self):
+        """Test cached courses are encoded compactly and read back."""
+        sites.setup_courses('course:/a::ns_a, course:/:/')
+        dst_app_context, src_app_context = sites.get_all_courses()
+        errors = []
+        src_course, dst_model = courses.Course(
+            None, app_context=dst_app_context).import_from(
+                src_app_context, errors)
+        assert not errors
+
+        # pylint: disable-msg=protected-access
+        for cached_class, course in [
+                (courses.CachedCourse12, src_course._model),
+                (courses.CachedCourse13, dst_model)]:
+            data = cached_class.memento_from_instance(course).serialize()
+            assert courses.MEMENTO_CODEC_MARSHAL == data[0]
+
+            memento = cached_class.new_memento()
+            memento.deserialize(data)
+            model = cached_class.instance_from_memento(
+                course.app_context, memento)
+            units = course.get_units()
+            assert_equals(
+                [unit.__dict__ for unit in units],
+                [unit.__dict__ for unit in model.get_units()])
+            for unit in units:
+                assert_equals(
+                    unit.__dict__,
+                    model.find_unit_by_id(unit.unit_id).__dict__)
+                assert_equals(
+                    [lesson.__dict__ for lesson in course.get_lessons(
+                        unit.unit_id)],
+                    [lesson.__dict__ for lesson in model.get_lessons(
+                        unit.unit_id)])
+
+        # Check large courses are compressed.
+        self.swap(courses, 'MEMENTO_COMPRESSION_MIN_BYTES', 0)
+        data = courses.CachedCourse13.memento_from_instance(
+            dst_model).serialize()
+        assert courses.MEMENTO_CODEC_MARSHAL.upper() == data[0]
+        memento = courses.CachedCourse13.new_memento()
+        memento.deserialize(data)
+        assert_equals(len(dst_model.get_units()), len(memento.units))
+
+    def test_csv_course_verified_once(self):
+        """Test CSV course files are verified once per content."""
+        sites.setup_courses('course:/:/')
+        app_context = sites.get_all_courses()[0]
+        self.swap(courses, 'VERIFIED_CSV_COURSES', set())
+
+        units, lessons = courses.load_csv_course(app_context)
+        assert units and lessons
+        assert_equals(1, len(courses.VERIFIED_CSV_COURSES))
+
+        # Check the same files are loaded again without being verified.
+        def fail():
+            raise Exception('Unexpected verification.')
+
+        self.swap(verify, 'Verifier', fail)
+        other_units, other_lessons = courses.load_csv_course(app_context)
+        assert_equals(
+            [unit.__dict__ for unit in units],
+            [unit.__dict__ for unit in other_units])
+        assert_equals(
+            [lesson.__dict__ for lesson in lessons],
+            [lesson.__dict__ for lesson in other_lessons])
+
+    def test_course_model_cache(self):
+        """Test course models are shared by requests until changed."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.swap(courses, 'COURSE_MODEL_CACHE_CHECK_SECS', 3600)
+        sites.setup_courses('course:/test::ns_test, course:/:/')
+        app_context = sites.get_all_courses()[0]
+
+        def get_course():
+            RequestCache.begin()
+            try:
+                return courses.Course(None, app_context=app_context)
+            finally:
+                RequestCache.end()
+
+        # pylint: disable-msg=protected-access
+        # Check requests share the model.
+        course = get_course()
+        shared_model = course._model
+        assert shared_model is get_course()._model
+
+        # Check the shared model is copied before it is changed.
+        unit = course.add_unit()
+        assert course._model is not shared_model
+        assert not shared_model.find_unit_by_id(unit.unit_id)
+        course.save()
+        course = get_course()
+        assert course._model is not shared_model
+
+        # Check units of a shared model can be changed without affecting it.
+        found_unit = course.find_unit_by_id(unit.unit_id)
+        found_unit.title = 'Changed Title'
+        assert_equals(
+            'New Unit', get_course().find_unit_by_id(unit.unit_id).title)
+
+        # Check a change saved by another instance is picked up.
+        shared_model = course._model
+        memcache.incr(courses.COURSE_VERSION_KEY, namespace='ns_test')
+        assert shared_model is get_course()._model
+        self.swap(courses, 'COURSE_MODEL_CACHE_CHECK_SECS', 0)
+        assert shared_model is not get_course()._model
+
+        # Check a previous version served while another request reloads the
+        # course is not kept.
+        key = courses.CachedCourse13._make_key()
+        models.MemcacheManager.delete(key, namespace='ns_test')
+        memcache.add(
+            models.MEMCACHE_LEASE_KEY_PREFIX + key, True, namespace='ns_test')
+        memcache.incr(courses.COURSE_VERSION_KEY, namespace='ns_test')
+        old_stale_hits = models.CACHE_STALE_HIT.value
+        assert not get_course()._is_shared_model
+        assert_equals(1, models.CACHE_STALE_HIT.value - old_stale_hits)
+        assert 'ns_test' not in courses.CourseModelCache.models
+
+        # Check a model built from the previous version of the course file and
+        # put to memcache after a change is not kept.
+        memento = models.MemcacheManager.get(
+            models.MEMCACHE_STALE_KEY_PREFIX + key, namespace='ns_test')
+        assert memento
+        course = courses.Course(None, app_context=app_context)
+        course.add_unit()
+        course.save()
+        models.MemcacheManager.set_with_staleness(
+            key, memento, namespace='ns_test')
+        assert not get_course()._is_shared_model
+        assert 'ns_test' not in courses.CourseModelCache.models
+
+    def test_course_saves(self):
+        """Test course saves are written through, checked and split."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        sites.setup_courses('course:/test::ns_test, course:/:/')
+        app_context = sites.get_all_courses()[0]
+        fs = app_context.fs
+
+        def load_from_datastore():
+            courses.CachedCourse13.delete(app_context)
+            return courses.Course(None, app_context=app_context)
+
+        # pylint: disable-msg=protected-access
+        # Check a saved course is written through to memcache.
+        course = courses.Course(None, app_context=app_context)
+        first_unit = course.add_unit()
+        course.add_lesson(first_unit)
+        course.save()
+        key = courses.CachedCourse13._make_key()
+        memento = models.MemcacheManager.get(key, namespace='ns_test')
+        assert memento
+        assert_equals(memento, models.MemcacheManager.get(
+            models.MEMCACHE_STALE_KEY_PREFIX + key, namespace='ns_test'))
+
+        # Check a save based on an old version of the course fails.
+        course = courses.Course(None, app_context=app_context)
+        other_course = courses.Course(None, app_context=app_context)
+        second_unit = course.add_unit()
+        course.save()
+        other_course.add_unit()
+        try:
+            other_course.save()
+            raise Exception('Expected a conflict.')
+        except vfs.ConcurrentUpdateError:
+            pass
+        assert_equals(2, len(load_from_datastore().get_units()))
+
+        # Check a large course is saved as records of a unit and its lessons.
+        self.swap(courses, 'COURSE_RECORDS_MIN_BYTES', 0)
+        course = courses.Course(None, app_context=app_context)
+        course.add_lesson(course.find_unit_by_id(second_unit.unit_id))
+        course.save()
+        records = course._model.records
+        assert_equals(2, len(records))
+        assert 'records' in transforms.loads(fs.get(
+            fs.impl.physical_to_logical(
+                courses.PersistentCourse13.COURSES_FILENAME)))
+
+        course = load_from_datastore()
+        assert_equals(records, course._model.records)
+        assert_equals(2, len(course.get_units()))
+        lesson = course.get_lessons(second_unit.unit_id)[0]
+        assert_equals(first_unit.unit_id, course.get_lessons(
+            first_unit.unit_id)[0].unit_id)
+
+        # Check only the changed record is written and the old one is kept
+        # for the readers of the previous version until the next save.
+        lesson.title = 'Changed Title'
+        course.update_lesson(lesson)
+        course.save()
+        new_records = course._model.records
+        assert_equals(records[0], new_records[0])
+        assert records[1] != new_records[1]
+        assert_equals([records[1]], course._model.old_records)
+        assert fs.isfile(fs.impl.physical_to_logical(records[1]))
+        assert_equals('Changed Title', load_from_datastore().find_lesson_by_id(
+            None, lesson.lesson_id).title)
+
+        # Check the records written by a conflicting save are deleted.
+        other_course = load_from_datastore()
+        course = load_from_datastore()
+        course.add_unit()
+        course.save()
+        assert not fs.isfile(fs.impl.physical_to_logical(records[1]))
+        other_course.add_lesson(
+            other_course.find_unit_by_id(first_unit.unit_id))
+        try:
+            other_course.save()
+            raise Exception('Expected a conflict.')
+        except vfs.ConcurrentUpdateError:
+            pass
+        assert_equals(
+            sorted([fs.impl.physical_to_logical(filename) for filename in
+                    course._model.records + course._model.old_records]),
+            fs.list(fs.impl.physical_to_logical(
+                courses.PersistentCourse13.RECORDS_FOLDER)))
+
+        # Check an activity written for a save that failed is restored.
+        course = load_from_datastore()
+        lesson = course.find_lesson_by_id(None, lesson.lesson_id)
+        lesson.has_activity = True
+        course.update_lesson(lesson)
+        course.set_activity_content(lesson, u'var activity = [\'A\'];')
+        course.save()
+        path = fs.impl.physical_to_logical(
+            course.get_activity_filename(None, lesson.lesson_id))
+        other_course = load_from_datastore()
+        course = load_from_datastore()
+        course.add_unit()
+        course.save()
+        lesson = other_course.find_lesson_by_id(None, lesson.lesson_id)
+        other_course.set_activity_content(lesson, u'var activity = [\'B\'];')
+        other_course.update_lesson(lesson)
+        try:
+            other_course.save()
+            raise Exception('Expected a conflict.')
+        except vfs.ConcurrentUpdateError:
+            pass
+        assert_equals('var activity = [\'A\'];', fs.get(path))
+
+    def test_memcache_get_or_compute(self):
+        """Test only one request recomputes a missing memcache item."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.swap(models, 'MEMCACHE_LEASE_WAIT_SECS', 0)
+        get_or_compute = models.MemcacheManager.get_or_compute
+        key = 'test_memcache_get_or_compute'
+        computed = []
+
+        def compute():
+            computed.append(key)
+            return 'value %s' % len(computed)
+
+        # Check a missing item is computed once and then cached.
+        assert_equals('value 1', get_or_compute(key, compute))
+        assert_equals('value 1', get_or_compute(key, compute))
+        assert_equals(1, len(computed))
+
+        # Check others get the previous value while one request recomputes.
+        old_stale_hits = models.CACHE_STALE_HIT.value
+        models.MemcacheManager.delete(key)
+
+        def compute_while_another_request_misses():
+            assert_equals('value 1', get_or_compute(key, compute))
+            return compute()
+
+        assert_equals(
+            'value 2',
+            get_or_compute(key, compute_while_another_request_misses))
+        assert_equals(2, len(computed))
+        assert_equals(1, models.CACHE_STALE_HIT.value - old_stale_hits)
+        assert_equals('value 2', get_or_compute(key, compute))
+
+        # Check others wait, then recompute if there is no previous value.
+        old_waits = models.CACHE_LEASE_WAIT.value
+        other_key = 'test_memcache_get_or_compute_other'
+
+        def compute_outer():
+            assert_equals(
+                'inner', get_or_compute(other_key, lambda: 'inner'))
+            return 'outer'
+
+        assert_equals('outer', get_or_compute(other_key, compute_outer))
+        assert_equals(1, models.CACHE_LEASE_WAIT.value - old_waits)
+        assert_equals('outer', get_or_compute(other_key, compute))
+
+        # Check a previous value stored in parts is read back whole.
+        self.swap(models, 'MEMCACHE_MAX_VALUE_BYTES', 10)
+        large_key = 'test_memcache_get_or_compute_large'
+        large_value = 'large value ' * 10
+        assert_equals(
+            large_value, get_or_compute(large_key, lambda: large_value))
+        models.MemcacheManager.delete(large_key)
+        memcache.add(models.MEMCACHE_LEASE_KEY_PREFIX + large_key, True)
+        assert_equals(large_value, get_or_compute(large_key, compute))
+        memcache.delete(models.MEMCACHE_LEASE_KEY_PREFIX + large_key)
+
+        # Check the course model is recomputed only if it is missing.
+        old_recomputes = models.CACHE_RECOMPUTE.value
+        self.get('preview')
+        self.get('preview')
+        assert_equals(1, models.CACHE_RECOMPUTE.value - old_recomputes)
+
+    def test_memcache_l1_cache(self):
+        """Test in-process cache is kept coherent with memcache."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE_L1.name] = True
+        models.MemcacheL1Cache.clear()
+        namespace = 'ns_test'
+        key = 'announcements'
+
+        # Check a value read from memcache is then served from this instance.
+        models.MemcacheManager.set(key, ['a'], namespace=namespace)
+        old_hits = models.CACHE_HIT.value
+        old_l1_hits = models.CACHE_L1_HIT.value
+        assert_equals(['a'], models.MemcacheManager.get(key, namespace))
+        assert_equals(1, models.CACHE_HIT.value - old_hits)
+        value = models.MemcacheManager.get(key, namespace)
+        assert_equals(['a'], value)
+        assert_equals(1, models.CACHE_HIT.value - old_hits)
+        assert_equals(1, models.CACHE_L1_HIT.value - old_l1_hits)
+
+        # Check each lookup returns a copy of the value.
+        value.append('b')
+        assert_equals(['a'], models.MemcacheManager.get(key, namespace))
+
+        # Check a change made by another instance is seen.
+        memcache.set(key, ['c'], namespace=namespace)
+        memcache.incr(models.MEMCACHE_L1_GENERATION_KEY, namespace=namespace)
+        assert_equals(['c'], models.MemcacheManager.get(key, namespace))
+
+        # Check the generation is read only once per request.
+        RequestCache.begin()
+        try:
+            assert_equals(['c'], models.MemcacheManager.get(key, namespace))
+            memcache.set(key, ['d'], namespace=namespace)
+            memcache.incr(
+                models.MEMCACHE_L1_GENERATION_KEY, namespace=namespace)
+            assert_equals(['c'], models.MemcacheManager.get(key, namespace))
+        finally:
+            RequestCache.end()
+        assert_equals(['d'], models.MemcacheManager.get(key, namespace))
+
+        # Check changes made by this instance are seen.
+        models.MemcacheManager.delete(key, namespace=namespace)
+        assert not models.MemcacheManager.get(key, namespace)
+
+        # Check filling in a missing item doesn't flush other instances.
+        generation = memcache.get(
+            models.MEMCACHE_L1_GENERATION_KEY, namespace=namespace)
+        models.MemcacheManager.set(
+            key, ['e'], namespace=namespace, invalidate=False)
+        assert_equals(generation, memcache.get(
+            models.MEMCACHE_L1_GENERATION_KEY, namespace=namespace))
+        assert_equals(['e'], models.MemcacheManager.get(key, namespace))
+
+        # Check other keys are not cached in process.
+        models.MemcacheManager.set('student:foo', 'bar', namespace=namespace)
+        models.MemcacheManager.get('student:foo', namespace)
+        assert not models.MemcacheL1Cache.items
+
+        # Check least recently used items are evicted to fit the memory budget.
+        self.swap(models, 'MEMCACHE_L1_MAX_BYTES', 100)
+        old_evicts = models.CACHE_L1_EVICT.value
+        mapping = dict([('vfs:dsbfs:%s' % i, 'x' * 40) for i in range(3)])
+        models.MemcacheManager.set_multi(mapping, namespace=namespace)
+        assert_equals(
+            mapping, models.MemcacheManager.get_multi(
+                mapping.keys(), namespace))
+        assert_equals(1, models.CACHE_L1_EVICT.value - old_evicts)
+        assert_equals(2, len(models.MemcacheL1Cache.items))
+        assert models.MemcacheL1Cache.size_bytes <= 100
+
+    def test_fleet_counters(self):
+        """Test counters of all instances are added up in memcache."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.swap(models.FleetCounters, 'flushed_values', {})
+        counter = counters.PerfCounter('gcb-test-fleet-counter', 'test')
+        try:
+            # Check the counter of this instance is flushed as is.
+            now = time.time()
+            counter.inc(5)
+            rpc = models.FleetCounters.flush(now=now)
+            assert counter.name not in models.FleetCounters.flushed_values
+            rpc.get_result()
+            assert_equals(5, models.FleetCounters.flushed_values[counter.name])
+            assert_equals(
+                (5, 0), models.FleetCounters.get_totals_and_rates(
+                    [counter.name], now=now)[counter.name])
+
+            # Check only deltas are flushed and the rate is computed.
+            counter.inc(3)
+            assert not models.FleetCounters.flush_if_due(now=now + 1)
+            models.FleetCounters.flush_if_due(now=now + 60).get_result()
+            total, rate = models.FleetCounters.get_totals_and_rates(
+                [counter.name], now=now + 120)[counter.name]
+            assert_equals(8, total)
+            assert_equals(3 / 60.0, rate)
+
+            # Check counters of another instance are added.
+            self.swap(models.FleetCounters, 'flushed_values', {})
+            self.swap(
+                models.FleetCounters, 'shard',
+                (models.FleetCounters.shard + 1) % (
+                    models.FLEET_COUNTERS_SHARDS))
+            models.FleetCounters.flush(now=now + 60).get_result()
+            total, rate = models.FleetCounters.get_totals_and_rates(
+                [counter.name], now=now + 120)[counter.name]
+            assert_equals(16, total)
+            assert_equals(11 / 60.0, rate)
+        finally:
+            del counters.Registry.registered[counter.name]
+
     def test_utf8_datastore(self):
         """Test writing to and reading from datastore using UTF-8 content."""
         event = models.EventEntity()
@@ -746,8 +1311,15 @@ class InfrastructureTest(actions.TestBase):
         prop.is_draft = False
         prop.put()
 
+        # Check not visible until the config generation is bumped.
+        config.Registry.last_generation_check_time = 0
+        assert (
+            config.UPDATE_INTERVAL_SEC.value ==
+            config.UPDATE_INTERVAL_SEC.default_value)
+        config.Registry.bump_generation()
+
         # Check visible from default namespace.
-        config.Registry.last_update_time = 0
+        config.Registry.last_generation_check_time = 0
         assert config.UPDATE_INTERVAL_SEC.value == new_value
 
         # Check visible from another namespace.
@@ -756,11 +1328,21 @@ class InfrastructureTest(actions.TestBase):
             namespace_manager.set_namespace(
                 'ns-test_config_visible_from_any_namespace')
 
-            config.Registry.last_update_time = 0
+            config.Registry.bump_generation()
+            config.Registry.last_generation_check_time = 0
             assert config.UPDATE_INTERVAL_SEC.value == new_value
         finally:
             namespace_manager.set_namespace(old_namespace)
 
+        # Check an edit missed by a reload is still seen after a while.
+        prop.value = str(new_value + 1)
+        prop.put()
+        config.Registry.last_generation_check_time = 0
+        assert config.UPDATE_INTERVAL_SEC.value == new_value
+        config.Registry.last_update_time -= new_value
+        config.Registry.last_generation_check_time = 0
+        assert config.UPDATE_INTERVAL_SEC.value == new_value + 1
+
 
 class AdminAspectTest(actions.TestBase):
     """Test site from the Admin perspective."""
@@ -996,6 +1578,15 @@ class AdminAspectTest(actions.TestBase):
         response = self.testapp.get('/admin?action=perf')
         assert_contains('gcb-admin-uptime-sec:', response.body)
         assert_contains('In-process Performance Counters', response.body)
+        assert_contains(
+            'In-process Request Handler Statistics', response.body)
+        assert_contains('RegisterHandler', response.body)
+        assert_contains('db.put', response.body)
+        assert_contains('In-process Distributions', response.body)
+        assert_contains('gcb-sites-latency-ms: count:', response.body)
+        assert_contains('In-process Rates', response.body)
+        assert_contains('gcb-sites-bytes-out: ', response.body)
+        assert_contains('Slowest Module Imports', response.body)
 
         response = self.testapp.get('/admin?action=deployment')
         assert_contains('application_id: testbed-test', response.body)
@@ -1283,6 +1874,38 @@ class CourseAuthorAspectTest(actions.TestBase):
 class StudentAspectTest(actions.TestBase):
     """Test the site from the Student perspective."""
 
+    def test_request_cache(self):
+        """Test repeated lookups within a request are served from cache."""
+        email = 'test_request_cache@google.com'
+        name = 'Test Request Cache'
+
+        actions.login(email)
+        actions.register(self, name)
+
+        get_by_email_old = models.Student.get_by_email
+        get_by_email_count = [0]
+
+        def get_by_email_new(email):
+            get_by_email_count[0] += 1
+            return get_by_email_old(email)
+
+        self.swap(models.Student, 'get_by_email', get_by_email_new)
+
+        # Check student is loaded once per request.
+        response = self.get('unit?unit=1&lesson=1')
+        assert_equals(response.status_int, 200)
+        assert_equals(1, get_by_email_count[0])
+        response = self.get('course')
+        assert_equals(response.status_int, 200)
+        assert_equals(2, get_by_email_count[0])
+
+        # Check the cache is gone after request and lookups work without it.
+        assert not RequestCache.is_active()
+        assert RequestCache.get(('foo',), lambda: 'bar') == 'bar'
+        assert RequestCache.get(('foo',), lambda: 'baz') == 'baz'
+        assert models.Student.get_enrolled_student_by_email(email)
+        assert_equals(3, get_by_email_count[0])
+
     def test_view_announcements(self):
         """Test student aspect of announcements."""
 
@@ -1359,7 +1982,7 @@ class StudentAspectTest(actions.TestBase):
         get_environ_old = sites.ApplicationContext.get_environ
 
         def get_environ_new(self):
-            environ = get_environ_old(self)
+            environ = copy.deepcopy(get_environ_old(self))
             environ['course']['now_available'] = False
             return environ
 
@@ -1391,7 +2014,7 @@ class StudentAspectTest(actions.TestBase):
         get_environ_old = sites.ApplicationContext.get_environ
 
         def get_environ_new(self):
-            environ = get_environ_old(self)
+            environ = copy.deepcopy(get_environ_old(self))
             environ['reg_form']['can_register'] = False
             return environ
 
@@ -1588,6 +2211,92 @@ class StaticHandlerTest(actions.TestBase):
         assert_contains('public', response.headers['Cache-Control'])
         assert_does_not_contain('no-cache', response.headers['Cache-Control'])
 
+    def test_static_files_conditional_get(self):
+        """Test static handler answers conditional requests with 304."""
+        response = self.get('/assets/css/main.css')
+        assert_equals(response.status_int, 200)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        assert etag
+        assert last_modified
+
+        # Check matching entity tag.
+        response = self.get(
+            '/assets/css/main.css', headers={'If-None-Match': etag})
+        assert_equals(response.status_int, 304)
+        assert not response.body
+        assert_equals(etag, response.headers['ETag'])
+
+        # Check entity tag that does not match.
+        response = self.get(
+            '/assets/css/main.css', headers={'If-None-Match': '"foo"'})
+        assert_equals(response.status_int, 200)
+        assert response.body
+
+        # Check modification date.
+        response = self.get(
+            '/assets/css/main.css',
+            headers={'If-Modified-Since': last_modified})
+        assert_equals(response.status_int, 304)
+        response = self.get(
+            '/assets/css/main.css',
+            headers={'If-Modified-Since': 'Mon, 01 Jan 1990 00:00:00 GMT'})
+        assert_equals(response.status_int, 200)
+
+    def test_static_files_range(self):
+        """Test static handler serves byte ranges."""
+        response = self.get('/assets/css/main.css')
+        assert_equals(response.status_int, 200)
+        assert_equals('bytes', response.headers['Accept-Ranges'])
+        body = response.body
+        size = len(body)
+
+        # Check first, middle, last and suffix ranges.
+        for header, start, end in [
+                ('bytes=0-9', 0, 10), ('bytes=10-19', 10, 20),
+                ('bytes=%s-' % (size - 5), size - 5, size),
+                ('bytes=-7', size - 7, size),
+                ('bytes=10-%s' % (size * 2), 10, size)]:
+            response = self.get(
+                '/assets/css/main.css', headers={'Range': header})
+            assert_equals(response.status_int, 206)
+            assert_equals(body[start:end], response.body)
+            assert_equals(
+                'bytes %s-%s/%s' % (start, end - 1, size),
+                response.headers['Content-Range'])
+
+        # Check range outside of the file.
+        response = self.testapp.get(
+            '/assets/css/main.css', headers={'Range': 'bytes=%s-' % size},
+            expect_errors=True)
+        assert_equals(response.status_int, 416)
+
+        # Check stale If-Range, multiple and invalid ranges return the whole
+        # file.
+        response = self.get(
+            '/assets/css/main.css',
+            headers={'Range': 'bytes=0-9', 'If-Range': '"foo"'})
+        assert_equals(response.status_int, 200)
+        assert_equals(body, response.body)
+        response = self.get(
+            '/assets/css/main.css', headers={'Range': 'bytes=0-9,20-29'})
+        assert_equals(response.status_int, 200)
+        assert_equals(body, response.body)
+        response = self.get(
+            '/assets/css/main.css', headers={'Range': 'bytes=5-3'})
+        assert_equals(response.status_int, 200)
+        assert_equals(body, response.body)
+
+        # Check a range of a file whose content is gone is not found.
+        def read_range(unused_self, unused_filename, unused_start, unused_end):
+            return None
+
+        self.swap(vfs.AbstractFileSystem, 'read_range', read_range)
+        response = self.testapp.get(
+            '/assets/css/main.css', headers={'Range': 'bytes=0-9'},
+            expect_errors=True)
+        assert_equals(response.status_int, 404)
+
 
 class ActivityTest(actions.TestBase):
     """Test for activities."""
@@ -1707,7 +2416,11 @@ class ActivityTest(actions.TestBase):
         assert tracker.get_lesson_progress(student, 1)[2] == 1
 
         # Submitting block 6 should trigger a completion update for Lesson 1.2.
+        # The cascade of updates decodes the progress only once.
+        parses = counters.Registry.registered['gcb-progress-parse']
+        old_parses = parses.value
         tracker.put_block_completed(student, 1, 2, 6)
+        assert_equals(1, parses.value - old_parses)
         assert tracker.get_unit_progress(student)['1'] == 1
         assert tracker.get_lesson_progress(student, 1)[2] == 2
 
@@ -1778,6 +2491,14 @@ class ActivityTest(actions.TestBase):
         assert not tracker.is_block_completed(
             progress, 5, 2, fake_numeric_id)
 
+        # Check an activity is not parsed again while its content is the same.
+        def fail(unused_unit_id, unused_lesson_id):
+            raise Exception('Unexpected parse.')
+
+        self.swap(tracker, 'get_activity_as_python', fail)
+        assert_equals([3, 6], tracker.get_valid_block_ids(1, 2))
+        tracker.put_block_completed(student, 1, 2, 3)
+
 
 class AssessmentTest(actions.TestBase):
     """Test for assessments."""
@@ -2184,6 +2905,37 @@ class MultipleCoursesTest(MultipleCoursesTestBase):
 
         assert not models.Student.all().fetch(1000)
 
+    def test_warmup(self):
+        """Test warmup request loads settings and templates of all courses."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.swap(Course, 'COURSE_SETTINGS_CACHE', {})
+        self.swap(courses.CourseModelCache, 'models', {})
+        self.swap(
+            sites.ApplicationContext, 'TEMPLATE_ENVIRON_POOL',
+            sites.collections.OrderedDict())
+
+        response = self.testapp.get('/_ah/warmup')
+        assert_equals(200, response.status_int)
+
+        # Check every course was loaded in its own namespace.
+        namespaces = set(['nsa', 'nsb', 'nsru'])
+        assert_equals(
+            namespaces,
+            set(Course.COURSE_SETTINGS_CACHE.keys()))
+        assert_equals(namespaces, set([
+            key[0] for key in sites.ApplicationContext.TEMPLATE_ENVIRON_POOL]))
+        assert_equals(
+            namespaces, set(courses.CourseModelCache.models.keys()))
+        assert_equals(
+            appengine_config.DEFAULT_NAMESPACE_NAME,
+            namespace_manager.get_namespace())
+
+        # Check the first student request reuses the warm environment.
+        old_misses = sites.TEMPLATE_ENVIRON_POOL_MISS.value
+        response = self.testapp.get('/courses/%s/preview' % self.course_a.path)
+        assert_contains(self.course_a.title, response.body)
+        assert_equals(0, sites.TEMPLATE_ENVIRON_POOL_MISS.value - old_misses)
+
     def validate_course_data(self, course):
         """Check course data is valid."""
 
@@ -2513,6 +3265,91 @@ class DatastoreBackedCustomCourseTest(DatastoreBackedCourseTest):
             appengine_config.BUNDLE_ROOT, 'course.yaml')).read(
                 ) == json_dict['content'])
 
+    def test_course_settings_are_cached(self):
+        """Test that course.yaml is parsed once per content change."""
+        self.init_course_data(self.upload_all_sample_course_files)
+
+        parse_count = [0]
+        safe_load_old = courses.yaml.safe_load
+
+        def safe_load_new(stream):
+            parse_count[0] += 1
+            return safe_load_old(stream)
+
+        self.swap(courses.yaml, 'safe_load', safe_load_new)
+        self.swap(courses.Course, 'COURSE_SETTINGS_CACHE', {})
+
+        # Check settings are parsed once and then served from cache.
+        environ = self.app_context.get_environ()
+        assert self.app_context.get_environ() is environ
+        assert_equals(1, parse_count[0])
+
+        # Check settings can't be modified, but a copy can.
+        try:
+            environ['course']['title'] = 'Changed Title'
+            raise Exception('Expected TypeError.')
+        except TypeError:
+            pass
+        environ_copy = copy.deepcopy(environ)
+        environ_copy['course']['title'] = 'Changed Title'
+        assert environ['course']['title'] != 'Changed Title'
+
+        # Check new content of course.yaml is picked up right away.
+        course_yaml = os.path.join(appengine_config.BUNDLE_ROOT, 'course.yaml')
+        old_namespace = namespace_manager.get_namespace()
+        try:
+            namespace_manager.set_namespace(self.namespace)
+            self.app_context.fs.put(course_yaml, vfs.string_to_stream(
+                u'course:\n  title: \'New Title\'\n'))
+        finally:
+            namespace_manager.set_namespace(old_namespace)
+        assert_equals(
+            'New Title', self.app_context.get_environ()['course']['title'])
+        assert_equals(2, parse_count[0])
+
+        # Check repeated lookups in a request are served by the request cache.
+        RequestCache.begin()
+        try:
+            environ = self.app_context.get_environ()
+            courses.Course.COURSE_SETTINGS_CACHE.clear()
+            assert self.app_context.get_environ() is environ
+        finally:
+            RequestCache.end()
+        assert_equals(2, parse_count[0])
+
+    def test_template_environ_is_reused(self):
+        """Test that jinja environments and compiled templates are reused."""
+        self.init_course_data(self.upload_all_sample_course_files)
+        self.swap(
+            sites.ApplicationContext, 'TEMPLATE_ENVIRON_POOL',
+            sites.collections.OrderedDict())
+
+        actions.login('test_template_environ_is_reused@google.com', True)
+
+        # Check the environment is created once and then reused.
+        old_misses = sites.TEMPLATE_ENVIRON_POOL_MISS.value
+        response = self.get('preview')
+        assert_equals(200, response.status_int)
+        response = self.get('preview')
+        assert_equals(200, response.status_int)
+        assert_equals(1, sites.TEMPLATE_ENVIRON_POOL_MISS.value - old_misses)
+        assert_equals(1, len(sites.ApplicationContext.TEMPLATE_ENVIRON_POOL))
+
+        # Check a change to the template is picked up by the pooled environment.
+        preview_html = os.path.join(
+            appengine_config.BUNDLE_ROOT, 'views', 'preview.html')
+        old_namespace = namespace_manager.get_namespace()
+        try:
+            namespace_manager.set_namespace(self.namespace)
+            self.app_context.fs.put(preview_html, vfs.string_to_stream(
+                u'{% extends \'base.html\' %}'
+                u'{% block main_content %}Updated preview{% endblock %}'))
+        finally:
+            namespace_manager.set_namespace(old_namespace)
+        response = self.get('preview')
+        assert_contains('Updated preview', response.body)
+        assert_equals(1, sites.TEMPLATE_ENVIRON_POOL_MISS.value - old_misses)
+
     def test_empty_course(self):
         """Test course with no assets and the simlest possible course.yaml."""
 
@@ -2567,6 +3404,71 @@ class DatastoreBackedCustomCourseTest(DatastoreBackedCourseTest):
         response = self.get('/rest/course/link?key=4')
         assert_equals(response.status_int, 200)
 
+    def test_add_unit_to_changed_course(self):
+        """Test adding a unit to a course changed meanwhile is refused."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        actions.login('test_add_unit@google.com', True)
+        response = self.get('dashboard')
+        response = self.submit(response.forms['add_unit'])
+
+        # Change the course, but leave the old version in memcache.
+        # pylint: disable-msg=protected-access
+        namespace = self.app_context.get_namespace_name()
+        key = courses.CachedCourse13._make_key()
+        memento = models.MemcacheManager.get(key, namespace=namespace)
+        course = courses.Course(None, app_context=self.app_context)
+        course.add_unit()
+        course.save()
+        models.MemcacheManager.set_with_staleness(
+            key, memento, namespace=namespace)
+
+        response = self.get('dashboard')
+        response = response.forms['add_unit'].submit(expect_errors=True)
+        assert_equals(412, response.status_int)
+        assert_contains('changed by someone else', response.body)
+        course = courses.Course(None, app_context=self.app_context)
+        assert_equals(2, len(course.get_units()))
+
+    def test_edit_lesson_of_shared_course_model(self):
+        """Test lesson edits are kept when the course model is shared."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        actions.login('test_edit_lesson@google.com', True)
+
+        response = self.get('dashboard')
+        response = self.submit(response.forms['add_unit'])
+        response = self.get('dashboard')
+        response = self.submit(response.forms['add_lesson'])
+
+        # Publish the lesson and give it an activity.
+        response = self.get('/rest/course/lesson?key=2')
+        json_dict = transforms.loads(response.body)
+        payload_dict = transforms.loads(json_dict['payload'])
+        payload_dict['is_draft'] = False
+        payload_dict['activity'] = (
+            u'var activity = [\'Intro\', {questionType: \'multiple choice\', '
+            u'choices: [[\'Yes\', true, \'Right.\'], '
+            u'[\'No\', false, \'Wrong.\']]}];')
+        request = {}
+        request['key'] = '2'
+        request['payload'] = transforms.dumps(payload_dict)
+        request['xsrf_token'] = json_dict['xsrf_token']
+        response = self.put('rest/course/lesson?%s' % urllib.urlencode(
+            {'request': transforms.dumps(request)}), {})
+        assert_contains('"status": 200', response.body)
+
+        # Check all the edits were saved.
+        course = courses.Course(None, app_context=self.app_context)
+        lesson = course.find_lesson_by_id(None, 2)
+        assert lesson.now_available
+        assert lesson.has_activity
+        filename = course.get_activity_filename(None, 2)
+        assert_equals('assets/js/activity-2.js', filename)
+        assert self.app_context.fs.isfile(
+            self.app_context.fs.impl.physical_to_logical(filename))
+        response = self.get('/rest/course/lesson?key=2')
+        assert_contains(
+            'multiple choice', transforms.loads(response.body)['payload'])
+
     def import_sample_course(self):
         """Imports a sample course."""
         # Setup courses.
@@ -2606,7 +3508,7 @@ class DatastoreBackedCustomCourseTest(DatastoreBackedCourseTest):
         get_environ_old = sites.ApplicationContext.get_environ
 
         def get_environ_new(self):
-            environ = get_environ_old(self)
+            environ = copy.deepcopy(get_environ_old(self))
             environ['course']['now_available'] = True
             return environ
 
@@ -2986,11 +3888,21 @@ class MemcacheTest(MemcacheTestBase):
     """Executes all tests with memcache enabled."""
 
 
+class MemcacheL1Test(MemcacheTestBase):
+    """Executes all tests with memcache and the in-process cache enabled."""
+
+    def setUp(self):  # pylint: disable-msg=g-bad-name
+        super(MemcacheL1Test, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE_L1.name] = True
+        models.MemcacheL1Cache.clear()
+
+
 ALL_COURSE_TESTS = (
     StudentAspectTest, AssessmentTest, CourseAuthorAspectTest,
     StaticHandlerTest, AdminAspectTest)
 
 MemcacheTest.__bases__ += (InfrastructureTest,) + ALL_COURSE_TESTS
+MemcacheL1Test.__bases__ += ALL_COURSE_TESTS
 CourseUrlRewritingTest.__bases__ += ALL_COURSE_TESTS
 VirtualFileSystemTest.__bases__ += ALL_COURSE_TESTS
 DatastoreBackedSampleCourseTest.__bases__ += ALL_COURSE_TESTS
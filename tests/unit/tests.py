@@ -22,7 +22,9 @@ import unittest
 import appengine_config
 from controllers import sites
 from models import config
+from models import counters
 from models import courses
+from models import import_profiler
 from models import transforms
 import suite
 from tools import verify
@@ -102,6 +104,8 @@ class InvokeExistingUnitTest(suite.TestBase):
         """Run all units tests declared elsewhere."""
         sites.run_all_unit_tests()
         config.run_all_unit_tests()
+        counters.run_all_unit_tests()
+        import_profiler.run_all_unit_tests()
         verify.run_all_unit_tests()
         transforms.run_all_unit_tests()
 
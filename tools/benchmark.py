@@ -0,0 +1,354 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks of the Course Builder request hot paths.
+
+Example use:
+
+$ python tools/benchmark.py routing --sdk_path=/path/to/my/appengine/sdk
+
+This will print the average latency of the operation being benchmarked for
+each of the problem sizes measured. The benchmarks run in process and do not
+need a running server; the App Engine SDK is needed only to import Course
+Builder modules.
+
+Pass --help for additional usage information.
+"""
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+import argparse
+import os
+import pickle
+import sys
+import threading
+import time
+
+# Placeholders for modules we'll import after setting up sys.path. This allows
+# us to avoid lint suppressions at every callsite.
+config = None
+courses = None
+db = None
+models = None
+sites = None
+testbed = None
+
+# String. Identifier for the course routing benchmark.
+_BENCHMARK_ROUTING = 'routing'
+# String. Identifier for the cache stampede load test.
+_BENCHMARK_STAMPEDE = 'stampede'
+# String. Identifier for the cached course encoding benchmark.
+_BENCHMARK_MEMENTOS = 'mementos'
+# String. Identifier for the config property read benchmark.
+_BENCHMARK_CONFIG = 'config'
+# List of all benchmarks.
+_BENCHMARKS = [
+    _BENCHMARK_ROUTING, _BENCHMARK_STAMPEDE, _BENCHMARK_MEMENTOS,
+    _BENCHMARK_CONFIG]
+# List of course counts to benchmark the course routing with.
+_COURSE_COUNTS = [10, 100, 1000]
+# List of numbers of concurrent requests to run the cache stampede test with.
+_CONCURRENT_REQUEST_COUNTS = [10, 50, 200]
+# Time it takes to read an item from the datastore in the cache stampede test.
+_DATASTORE_READ_SECS = 0.2
+# List of lesson counts to benchmark the cached course encoding with.
+_LESSON_COUNTS = [10, 100, 1000]
+# Number of lessons in each unit of the courses used in the benchmarks.
+_LESSONS_PER_UNIT = 10
+
+# Command-line argument configuration.
+_PARSER = argparse.ArgumentParser()
+_PARSER.add_argument(
+    'benchmark', choices=_BENCHMARKS, help='benchmark to run', type=str)
+_PARSER.add_argument(
+    '--iterations', help='number of times to repeat each operation',
+    default=10000, type=int)
+_PARSER.add_argument(
+    '--sdk_path', help='absolute path of the App Engine SDK', required=True,
+    type=str)
+
+
+def _import_modules_into_global_scope():
+    """Import helper; run after _set_up_sys_path() for imports to resolve."""
+    # pylint: disable-msg=g-import-not-at-top,global-variable-not-assigned,
+    # pylint: disable-msg=redefined-outer-name,unused-variable
+    global config, courses, db, models, sites, testbed
+    import appengine_config
+    from controllers import sites
+    from google.appengine.ext import db
+    from google.appengine.ext import testbed
+    from models import config
+    from models import courses
+    from models import models
+
+
+def _set_up_sys_path(sdk_path):
+    """Sets up sys.path so App Engine/Course Builder imports work."""
+    assert os.path.exists(sdk_path)
+    for path in [
+            # Find course builder root by navigating up one folder from here.
+            os.path.abspath(__file__).rsplit(os.sep, 2)[0],
+            sdk_path]:
+        if path not in sys.path:
+            # Have to insert at head or app engine imports won't resolve.
+            sys.path.insert(0, path)
+
+    # pylint: disable-msg=g-import-not-at-top
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def _time_per_call_usec(func, args_list, iterations):
+    """Calls func with each of the args repeatedly; returns average latency."""
+    start = time.time()
+    for index in xrange(iterations):
+        func(*args_list[index % len(args_list)])
+    return (time.time() - start) * 1000000 / iterations
+
+
+def _report(title, rows):
+    """Prints a table of results."""
+    print title
+    for row in rows:
+        print '  %s' % '\t'.join([str(item) for item in row])
+
+
+def benchmark_routing(iterations):
+    """Measures dispatch latency of a request path to a course."""
+
+    def linear_scan(contexts, path):
+        """Matches a path to a course the way it was done before the router."""
+        for context in contexts:
+            slug = context.get_slug()
+            if path == slug or path.startswith('%s/' % slug) or slug == '/':
+                return context
+        return None
+
+    rows = [('courses', 'linear scan, usec', 'router, usec')]
+    for count in _COURSE_COUNTS:
+        rules = ['course:/course%04d::ns_course%04d' % (index, index)
+                 for index in xrange(count)]
+        rules.append('course:/:/')
+        rules_text = '\n'.join(rules)
+
+        contexts = sites.get_all_courses(rules_text)
+        router = sites.get_course_router(rules_text)
+
+        # Spread the requests evenly over all the courses.
+        paths = []
+        for index in xrange(count):
+            paths.append('/course%04d/unit' % index)
+        paths.append('/unit')
+
+        for path in paths:
+            assert linear_scan(contexts, path) is router.resolve(path)
+
+        rows.append((
+            count,
+            '%.2f' % _time_per_call_usec(
+                linear_scan, [(contexts, path) for path in paths], iterations),
+            '%.2f' % _time_per_call_usec(
+                router.resolve, [(path,) for path in paths], iterations)))
+
+    _report('Course routing latency per request', rows)
+
+
+def benchmark_stampede(unused_iterations):
+    """Counts datastore reads made by requests missing the same cached item.
+
+    Runs a number of concurrent requests right after an item was invalidated.
+    Without leases each of these requests reads the datastore; with leases
+    only the first one does, while the others get the previous version of the
+    item.
+    """
+
+    class BenchmarkEntity(db.Model):
+        value = db.StringProperty()
+
+    bed = testbed.Testbed()
+    bed.activate()
+    try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        BenchmarkEntity(key_name='item', value='value').put()
+
+        def get_without_lease(key, compute):
+            value = models.MemcacheManager.get(key)
+            if value is None:
+                value = compute()
+                models.MemcacheManager.set(key, value)
+            return value
+
+        def run_requests(key, get_value, count):
+            """Runs count requests; returns the number of datastore reads."""
+            reads = []
+
+            def compute():
+                reads.append(key)
+                value = BenchmarkEntity.get_by_key_name('item').value
+
+                # Other requests arrive while the datastore is being read.
+                time.sleep(_DATASTORE_READ_SECS)
+                return value
+
+            threads = [
+                threading.Thread(target=get_value, args=(key, compute))
+                for unused_index in xrange(count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return len(reads)
+
+        rows = [(
+            'requests', 'datastore reads without lease',
+            'datastore reads with lease')]
+        for count in _CONCURRENT_REQUEST_COUNTS:
+            key = 'benchmark:stampede:%s' % count
+
+            # Cache the item and then invalidate it, as a course edit would.
+            models.MemcacheManager.get_or_compute(key, lambda: 'value')
+            models.MemcacheManager.delete(key)
+            without_lease = run_requests(key, get_without_lease, count)
+
+            models.MemcacheManager.delete(key)
+            with_lease = run_requests(
+                key, models.MemcacheManager.get_or_compute, count)
+
+            rows.append((count, without_lease, with_lease))
+    finally:
+        config.Registry.test_overrides = {}
+        bed.deactivate()
+
+    _report('Datastore reads by concurrent requests missing an item', rows)
+
+
+def benchmark_mementos(iterations):
+    """Compares the size and decoding latency of cached course encodings."""
+
+    def make_memento(lesson_count):
+        units = []
+        lessons = []
+        for index in xrange(lesson_count):
+            if not index % _LESSONS_PER_UNIT:
+                unit = courses.Unit13()
+                unit.unit_id = len(units) + 1
+                unit.type = 'U'
+                unit.title = 'Unit %s' % unit.unit_id
+                unit.now_available = True
+                unit._index = (  # pylint: disable-msg=protected-access
+                    unit.unit_id)
+                units.append(unit)
+            lesson = courses.Lesson13()
+            lesson.lesson_id = lesson_count + index + 1
+            lesson.unit_id = unit.unit_id
+            lesson.title = u'Lesson %s' % lesson.lesson_id
+            lesson.objectives = u'<p>Objectives of lesson %s.</p>' % index
+            lesson.video = 'video%s' % index
+            lesson.now_available = True
+            lesson._index = (  # pylint: disable-msg=protected-access
+                index % _LESSONS_PER_UNIT + 1)
+            lessons.append(lesson)
+        return courses.CachedCourse13(
+            next_id=2 * lesson_count + 1, units=units, lessons=lessons,
+            unit_id_to_lesson_ids=dict([
+                (str(unit.unit_id), [
+                    lesson.lesson_id for lesson in lessons
+                    if lesson.unit_id == unit.unit_id])
+                for unit in units]))
+
+    def decode_pickle(data):
+        memento = courses.CachedCourse13()
+        memento.__dict__.update(pickle.loads(data))
+
+    def decode_compact(data):
+        courses.CachedCourse13().deserialize(data)
+
+    rows = [(
+        'lessons', 'pickle, bytes', 'compact, bytes', 'pickle, usec',
+        'compact, usec')]
+    for count in _LESSON_COUNTS:
+        memento = make_memento(count)
+        old_data = pickle.dumps(memento.__dict__)
+        new_data = memento.serialize()
+        runs = max(1, iterations / count)
+        rows.append((
+            count, len(old_data), len(new_data),
+            '%.2f' % _time_per_call_usec(decode_pickle, [(old_data,)], runs),
+            '%.2f' % _time_per_call_usec(
+                decode_compact, [(new_data,)], runs)))
+
+    _report('Size and decoding latency of a cached course', rows)
+
+
+def benchmark_config(iterations):
+    """Measures the latency of reading a config property value."""
+
+    def resolve(prop):
+        """Resolves a value the way it was done before the snapshot."""
+        db_overrides = config.Registry.get_overrides()
+        overrides = config.Registry.test_overrides
+        if overrides and prop.name in overrides:
+            return overrides[prop.name]
+        if db_overrides and prop.name in db_overrides:
+            return db_overrides[prop.name]
+        for name in [prop.name.lower(), prop.name.upper()]:
+            if name in os.environ:
+                return config.transforms.string_to_value(
+                    os.environ[name], prop.value_type)
+        return prop.default_value
+
+    def read(prop):
+        return prop.value
+
+    bed = testbed.Testbed()
+    bed.activate()
+    try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        config.Registry.get_overrides(force_update=True)
+
+        props = [models.CAN_USE_MEMCACHE, config.UPDATE_INTERVAL_SEC]
+        os.environ[config.UPDATE_INTERVAL_SEC.name] = '30'
+        rows = [('property', 'resolved, usec', 'snapshot, usec')]
+        for prop in props:
+            assert resolve(prop) == prop.value
+            rows.append((
+                prop.name,
+                '%.2f' % _time_per_call_usec(resolve, [(prop,)], iterations),
+                '%.2f' % _time_per_call_usec(read, [(prop,)], iterations)))
+    finally:
+        os.environ.pop(config.UPDATE_INTERVAL_SEC.name, None)
+        bed.deactivate()
+
+    _report('Latency of reading a config property value', rows)
+
+
+def main(parsed_args):
+    """Runs the requested benchmark."""
+    _set_up_sys_path(parsed_args.sdk_path)
+    _import_modules_into_global_scope()
+    if parsed_args.benchmark == _BENCHMARK_ROUTING:
+        benchmark_routing(parsed_args.iterations)
+    elif parsed_args.benchmark == _BENCHMARK_STAMPEDE:
+        benchmark_stampede(parsed_args.iterations)
+    elif parsed_args.benchmark == _BENCHMARK_MEMENTOS:
+        benchmark_mementos(parsed_args.iterations)
+    elif parsed_args.benchmark == _BENCHMARK_CONFIG:
+        benchmark_config(parsed_args.iterations)
+
+
+if __name__ == '__main__':
+    main(_PARSER.parse_args())
@@ -798,6 +798,16 @@ def read_objects_from_csv_file(fname, header, new_object):
 
 def read_objects_from_csv(value_rows, header, new_object, converter=None):
     """Reads objects from the rows of a CSV file."""
+    names, rows = read_rows_from_csv(value_rows, header)
+    return make_objects_from_rows(names, rows, new_object, converter=converter)
+
+
+def read_rows_from_csv(value_rows, header):
+    """Reads the rows of a CSV file; returns column names and decoded rows.
+
+    The rows can be turned into objects of several kinds with
+    make_objects_from_rows() without parsing the file again.
+    """
 
     values = []
     for row in value_rows:
@@ -813,7 +823,7 @@ def read_objects_from_csv(value_rows, header, new_object, converter=None):
             'Expected header row with %s element(s): %s' % (
                 len(values[0]), values[0], len(names), names))
 
-    items = []
+    rows = []
     for i in range(1, len(values)):
         if len(names) != len(values[i]):
             raise SchemaException(
@@ -830,9 +840,16 @@ def read_objects_from_csv(value_rows, header, new_object, converter=None):
             if isinstance(value, basestring):
                 value = unicode(value.decode('utf-8'))
             decoded_values.append(value)
+        rows.append(decoded_values)
+    return names, rows
+
 
+def make_objects_from_rows(names, rows, new_object, converter=None):
+    """Makes objects from the rows returned by read_rows_from_csv()."""
+    items = []
+    for row in rows:
         item = new_object()
-        set_object_attributes(item, names, decoded_values, converter=converter)
+        set_object_attributes(item, names, row, converter=converter)
         items.append(item)
     return items
 